@@ -1,8 +1,15 @@
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
 from experiments.experiment_counters import ExperimentCounter
-from experiments.significance import chi_square_p_value, mann_whitney
+from experiments.significance import chi_square_p_value, chi_square_p_values, chi_square_contingency, kruskal_wallis, mann_whitney, mann_whitney_many
 from experiments.utils import participant
-from experiments import conf
+from experiments import bayesian, conf, sequential
 
+import threading
+import hashlib
+import time
 import json
 
 
@@ -21,17 +28,45 @@ def improvement(a, b):
     return (a - b) * 100. / b
 
 
-def chi_squared_confidence(a_count, a_conversion, b_count, b_conversion):
-    contingency_table = [[a_count - a_conversion, a_conversion],
-                         [b_count - b_conversion, b_conversion]]
+def _contingency_row(count, conversion):
+    # Estimated (HLL) conversions can come out slightly above the participant count
+    conversion = min(conversion, count)
+    return [count - conversion, conversion]
+
 
-    chi_square, p_value = chi_square_p_value(contingency_table)
+def _chi_squared_confidence(p_value):
     if p_value is not None:
         return (1 - p_value) * 100
     else:
         return None
 
 
+def chi_squared_confidence(a_count, a_conversion, b_count, b_conversion):
+    chi_square, p_value = chi_square_p_value([_contingency_row(a_count, a_conversion), _contingency_row(b_count, b_conversion)])
+    return _chi_squared_confidence(p_value)
+
+
+def chi_squared_confidences(tables):
+    """chi_squared_confidence() of each 2 x 2 table of [non conversions, conversions] rows, computed in one batch"""
+    return [_chi_squared_confidence(p_value) for chi_square, p_value in chi_square_p_values(tables)]
+
+
+def omnibus_confidences(rows, distributions=None):
+    """
+    Confidence that any of the alternatives differ, from their [non conversions, conversions]
+    rows (k x 2 chi-square) and, if given, their goal distributions (Kruskal-Wallis)
+    """
+    chi_square, p_value = chi_square_contingency(rows)
+    if distributions is not None:
+        h, kruskal_wallis_p_value = kruskal_wallis(distributions)
+    else:
+        kruskal_wallis_p_value = None
+    return {
+        'confidence': _chi_squared_confidence(p_value),
+        'kruskal_wallis_confidence': _chi_squared_confidence(kruskal_wallis_p_value),
+    }
+
+
 def average_actions(distribution):
     total_users = 0
     total_actions = 0
@@ -44,20 +79,32 @@ def average_actions(distribution):
         return 0
 
 
+def total_actions(distribution):
+    return sum(actions * frequency for actions, frequency in distribution.items())
+
+
 def fixup_distribution(distribution, count):
     zeros = count - sum(distribution.values())
     distribution[0] = zeros + distribution.get(0, 0)
     return distribution
 
 
-def mann_whitney_confidence(a_distribution, b_distribution):
-    p_value = mann_whitney(a_distribution, b_distribution)[1]
+def _mann_whitney_confidence(p_value):
     if p_value is not None:
         return (1 - p_value * 2) * 100  # Two tailed probability
     else:
         return None
 
 
+def mann_whitney_confidence(a_distribution, b_distribution):
+    return _mann_whitney_confidence(mann_whitney(a_distribution, b_distribution)[1])
+
+
+def mann_whitney_confidences(distribution_pairs):
+    """mann_whitney_confidence() of each (a_distribution, b_distribution), computed in one batch"""
+    return [_mann_whitney_confidence(p_value) for u, p_value in mann_whitney_many(distribution_pairs)]
+
+
 def points_with_surrounding_gaps(points):
     """
     This function makes sure that any gaps in the sequence provided have stopper points at their beginning
@@ -107,8 +154,9 @@ def conversion_distributions_to_graph_table(conversion_distributions):
     return json.dumps(graph_table)
 
 
-def get_result_context(request, experiment):
-    experiment_counter = ExperimentCounter()
+def compute_result_context(experiment, experiment_counter=None):
+    """Compute the results shown on the experiment's admin page straight from the counters"""
+    experiment_counter = experiment_counter or ExperimentCounter()
 
     try:
         chi2_goals = experiment.relevant_chi2_goals.replace(" ", "").split(",")
@@ -120,51 +168,71 @@ def get_result_context(request, experiment):
         mwu_goals = [u'']
     relevant_goals = set(chi2_goals + mwu_goals)
 
+    # Everything the page needs from the counter store, fetched in a single round trip
+    snapshot = experiment_counter.experiment_snapshot(experiment, conf.ALL_GOALS, distribution_goals=[goal for goal in conf.ALL_GOALS if goal in mwu_goals])
+
     alternatives = {}
     for alternative_name in experiment.alternatives.keys():
-        alternatives[alternative_name] = experiment_counter.participant_count(experiment, alternative_name)
+        alternatives[alternative_name] = snapshot.participant_count(alternative_name)
     alternatives = sorted(alternatives.items())
 
-    control_participants = experiment_counter.participant_count(experiment, conf.CONTROL_GROUP)
+    control_participants = snapshot.participant_count(conf.CONTROL_GROUP)
 
     results = {}
+    # The significance tests of all goals and alternatives are run in one batch at the end
+    chi2_comparisons = []
+    mwu_comparisons = []
+    sequential_comparisons = []
+    bayesian_comparisons = []
 
     for goal in conf.ALL_GOALS:
-        show_mwu = goal in mwu_goals
+        # HLL goals have no distributions to compare
+        show_mwu = goal in mwu_goals and goal not in conf.HLL_GOALS
 
         alternatives_conversions = {}
-        control_conversions = experiment_counter.goal_count(experiment, conf.CONTROL_GROUP, goal)
+        control_conversions = snapshot.goal_count(conf.CONTROL_GROUP, goal)
         control_conversion_rate = rate(control_conversions, control_participants)
+        # Each alternative's row is shared by its comparison with control and the omnibus test
+        control_row = _contingency_row(control_participants, control_conversions)
+        rows = [control_row]
 
         if show_mwu:
             mwu_histogram = {}
-            control_conversion_distribution = fixup_distribution(experiment_counter.goal_distribution(experiment, conf.CONTROL_GROUP, goal), control_participants)
+            control_conversion_distribution = fixup_distribution(snapshot.goal_distribution(conf.CONTROL_GROUP, goal), control_participants)
             control_average_goal_actions = average_actions(control_conversion_distribution)
+            control_goal_actions = total_actions(control_conversion_distribution)
             mwu_histogram['control'] = control_conversion_distribution
         else:
             control_average_goal_actions = None
         for alternative_name in experiment.alternatives.keys():
             if not alternative_name == conf.CONTROL_GROUP:
-                alternative_conversions = experiment_counter.goal_count(experiment, alternative_name, goal)
-                alternative_participants = experiment_counter.participant_count(experiment, alternative_name)
+                alternative_conversions = snapshot.goal_count(alternative_name, goal)
+                alternative_participants = snapshot.participant_count(alternative_name)
                 alternative_conversion_rate = rate(alternative_conversions, alternative_participants)
-                alternative_confidence = chi_squared_confidence(alternative_participants, alternative_conversions, control_participants, control_conversions)
-                if show_mwu:
-                    alternative_conversion_distribution = fixup_distribution(experiment_counter.goal_distribution(experiment, alternative_name, goal), alternative_participants)
-                    alternative_average_goal_actions = average_actions(alternative_conversion_distribution)
-                    alternative_distribution_confidence = mann_whitney_confidence(alternative_conversion_distribution, control_conversion_distribution)
-                    mwu_histogram[alternative_name] = alternative_conversion_distribution
-                else:
-                    alternative_average_goal_actions = None
-                    alternative_distribution_confidence = None
                 alternative = {
                     'conversions': alternative_conversions,
                     'conversion_rate': alternative_conversion_rate,
                     'improvement': improvement(alternative_conversion_rate, control_conversion_rate),
-                    'confidence': alternative_confidence,
-                    'average_goal_actions': alternative_average_goal_actions,
-                    'mann_whitney_confidence': alternative_distribution_confidence,
+                    'confidence': None,
+                    'average_goal_actions': None,
+                    'mann_whitney_confidence': None,
+                    'sequential_confidence': None,
+                    'probability_to_beat_control': None,
+                    'expected_loss': None,
+                    'actions_probability_to_beat_control': None,
+                    'actions_expected_loss': None,
                 }
+                row = _contingency_row(alternative_participants, alternative_conversions)
+                rows.append(row)
+                chi2_comparisons.append((alternative, [row, control_row]))
+                sequential_comparisons.append((alternative, (goal, alternative_name, alternative_participants, alternative_conversions, control_participants, control_conversions)))
+                bayesian_comparisons.append((alternative, '', (bayesian.CONVERSION, alternative_participants, alternative_conversions, control_participants, control_conversions)))
+                if show_mwu:
+                    alternative_conversion_distribution = fixup_distribution(snapshot.goal_distribution(alternative_name, goal), alternative_participants)
+                    alternative['average_goal_actions'] = average_actions(alternative_conversion_distribution)
+                    mwu_comparisons.append((alternative, (alternative_conversion_distribution, control_conversion_distribution)))
+                    bayesian_comparisons.append((alternative, 'actions_', (bayesian.ACTIONS, alternative_participants, total_actions(alternative_conversion_distribution), control_participants, control_goal_actions)))
+                    mwu_histogram[alternative_name] = alternative_conversion_distribution
                 alternatives_conversions[alternative_name] = alternative
 
         control = {
@@ -177,15 +245,95 @@ def get_result_context(request, experiment):
             "control": control,
             "alternatives": sorted(alternatives_conversions.items()),
             "relevant": goal in relevant_goals or relevant_goals == {u''},
-            "mwu": goal in mwu_goals,
-            "mwu_histogram": conversion_distributions_to_graph_table(mwu_histogram) if show_mwu else None
+            "mwu": show_mwu,
+            "count_error": experiment_counter.goal_count_error(goal) * 100,
+            "mwu_histogram": conversion_distributions_to_graph_table(mwu_histogram) if show_mwu else None,
+            # Whether the alternatives differ at all, when there are several to compare with control
+            "omnibus": omnibus_confidences(rows, list(mwu_histogram.values()) if show_mwu else None) if len(rows) > 2 else None,
         }
 
+    confidences = chi_squared_confidences([comparison for alternative, comparison in chi2_comparisons])
+    for (alternative, comparison), confidence in zip(chi2_comparisons, confidences):
+        alternative['confidence'] = confidence
+    counter_version = experiment_counter.counter_version(experiment)
+    confidences = mann_whitney_confidences([comparison for alternative, comparison in mwu_comparisons])
+    for (alternative, comparison), confidence in zip(mwu_comparisons, confidences):
+        alternative['mann_whitney_confidence'] = confidence
+    # Always-valid confidence, which unlike the one above may be acted on whenever it's looked at
+    p_values = sequential.always_valid_p_values(experiment, counter_version, [comparison for alternative, comparison in sequential_comparisons],
+                                              experiment_counter.counters)
+    for alternative, comparison in sequential_comparisons:
+        alternative['sequential_confidence'] = _chi_squared_confidence(p_values[comparison[:2]])
+    if conf.BAYESIAN_RESULTS:
+        analysis = bayesian.analyse([comparison for alternative, prefix, comparison in bayesian_comparisons])
+        for (alternative, prefix, comparison), (probability, expected_loss) in zip(bayesian_comparisons, analysis):
+            alternative[prefix + 'probability_to_beat_control'] = probability * 100
+            # In percentage points of conversion rate, or in goal actions per participant
+            alternative[prefix + 'expected_loss'] = expected_loss * 100 if comparison[0] == bayesian.CONVERSION else expected_loss
+
     return {
         'experiment': experiment.to_dict(),
         'alternatives': alternatives,
         'control_participants': control_participants,
         'results': results,
         'column_count': len(alternatives_conversions) * 3 + 2,  # Horrible coupling with template design
-        'user_alternative': participant(request).get_alternative(experiment.name),
     }
+
+
+def _results_cache_key(experiment, experiment_counter):
+    # Any change to the experiment's configuration, the goals or a reset of its counters gives a new key
+    fingerprint = json.dumps([
+        experiment.name,
+        experiment.state,
+        experiment.alternatives,
+        experiment.relevant_chi2_goals,
+        experiment.relevant_mwu_goals,
+        conf.ALL_GOALS,
+        experiment_counter.counter_version(experiment),
+    ], sort_keys=True, cls=DjangoJSONEncoder)
+    return 'experiments:results:%s' % hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+
+
+def refresh_result_context(experiment):
+    """Recompute the experiment's results and store them in the results cache"""
+    experiment_counter = ExperimentCounter()
+    cache_key = _results_cache_key(experiment, experiment_counter)
+    context = compute_result_context(experiment, experiment_counter)
+    caches[conf.RESULTS_CACHE].set(cache_key, (time.time(), context), conf.RESULTS_CACHE_TIMEOUT + conf.RESULTS_CACHE_STALE_TIMEOUT)
+    return context
+
+
+def _refresh_in_background(experiment):
+    try:
+        refresh_result_context(experiment)
+    finally:
+        # Django opened a connection for this thread, nothing else will close it
+        connection.close()
+
+
+def cached_result_context(experiment):
+    """
+    Return the experiment's results from the results cache. Results older than RESULTS_CACHE_TIMEOUT
+    are still returned, but trigger a single recomputation in a background thread.
+    """
+    if not conf.RESULTS_CACHE_TIMEOUT:
+        return compute_result_context(experiment)
+
+    cache = caches[conf.RESULTS_CACHE]
+    cache_key = _results_cache_key(experiment, ExperimentCounter())
+    cached = cache.get(cache_key)
+    if cached is None:
+        return refresh_result_context(experiment)
+
+    computed_at, context = cached
+    if time.time() - computed_at > conf.RESULTS_CACHE_TIMEOUT and cache.add(cache_key + ':refreshing', True, conf.RESULTS_CACHE_TIMEOUT):
+        refresh = threading.Thread(target=_refresh_in_background, args=(experiment,))
+        refresh.daemon = True
+        refresh.start()
+    return context
+
+
+def get_result_context(request, experiment):
+    context = dict(cached_result_context(experiment))
+    context['user_alternative'] = participant(request).get_alternative(experiment.name)
+    return context
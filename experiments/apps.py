@@ -6,8 +6,17 @@ class ExperimentsConfig(AppConfig):
     label = 'experiments'
 
     def ready(self):
+        from django.core import checks
+        from experiments.manager import check_registry_cache
+        checks.register(check_registry_cache)
+
         from django.contrib.auth.signals import user_logged_in, user_logged_out
-        from experiments.signal_handlers import transfer_enrollments_to_user, handle_user_logged_out
+        from django.db.models.signals import post_save, post_delete
+        from experiments.models import Enrollment, Experiment
+        from experiments.signal_handlers import transfer_enrollments_to_user, handle_user_logged_out, handle_enrollment_changed, handle_experiment_deleted
 
         user_logged_in.connect(transfer_enrollments_to_user, dispatch_uid="experiments_user_logged_in")
         user_logged_out.connect(handle_user_logged_out, dispatch_uid="experiments_user_logged_out")
+        post_save.connect(handle_enrollment_changed, sender=Enrollment, dispatch_uid="experiments_enrollment_saved")
+        post_delete.connect(handle_enrollment_changed, sender=Enrollment, dispatch_uid="experiments_enrollment_deleted")
+        post_delete.connect(handle_experiment_deleted, sender=Experiment, dispatch_uid="experiments_experiment_deleted")
@@ -0,0 +1,157 @@
+"""
+Bayesian results: probability to beat control and expected loss of each alternative.
+
+Conversion goals use a Beta-Binomial model of the conversion rate, goals with distributions
+(relevant_mwu_goals) also get a Gamma-Poisson model of the goal actions per participant, from
+the total of their frequency histogram.
+
+The probability to beat control comes in closed form (Evan Miller's sums) while that takes
+at most CLOSED_FORM_MAX_TERMS terms, expected losses and larger probabilities are estimated
+from posterior samples. All posteriors of an experiment are sampled in one batch (vectorized
+with numpy when it is installed), sharing control's posterior among the alternatives.
+EXPERIMENTS_BAYESIAN_SEED makes the samples reproducible, and results are memoized in the
+results cache by the counts they were computed from.
+"""
+from math import exp, lgamma, log
+import hashlib
+import json
+import random
+
+from django.core.cache import caches
+
+from experiments import conf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Uniform prior on conversion rates: Beta(1, 1)
+BETA_PRIOR = (1, 1)
+# Prior on the goal actions per participant: Gamma(shape 1, rate 1), worth one participant
+GAMMA_PRIOR = (1, 1)
+
+CLOSED_FORM_MAX_TERMS = 1000
+
+CONVERSION = 'conversion'
+ACTIONS = 'actions'
+
+
+def _log_beta(a, b):
+    return lgamma(a) + lgamma(b) - lgamma(a + b)
+
+
+def beta_probability_to_beat(a_alpha, a_beta, b_alpha, b_beta):
+    """P(rate of b > rate of a) for Beta(alpha, beta) posteriors, b_alpha being an integer"""
+    total = 0.0
+    for i in range(int(b_alpha)):
+        total += exp(_log_beta(a_alpha + i, a_beta + b_beta) - log(b_beta + i) - _log_beta(1 + i, b_beta) - _log_beta(a_alpha, a_beta))
+    return total
+
+
+def gamma_probability_to_beat(a_shape, a_rate, b_shape, b_rate):
+    """P(rate of b > rate of a) for Gamma(shape, rate) posteriors, b_shape being an integer"""
+    total = 0.0
+    for k in range(int(b_shape)):
+        total += exp(k * log(b_rate) + a_shape * log(a_rate) - (k + a_shape) * log(a_rate + b_rate) -
+                     log(k + a_shape) - _log_beta(k + 1, a_shape))
+    return total
+
+
+def posterior(kind, count, total):
+    """The posterior of a side with `count` participants and `total` conversions or goal actions"""
+    if kind == CONVERSION:
+        conversions = min(total, count)
+        return 'beta', BETA_PRIOR[0] + conversions, BETA_PRIOR[1] + count - conversions
+    return 'gamma', GAMMA_PRIOR[0] + total, GAMMA_PRIOR[1] + count
+
+
+def analyse(comparisons, draws=None, seed=None):
+    """
+    Compare each (kind, alternative participants, alternative total, control participants,
+    control total) with `kind` CONVERSION or ACTIONS. Returns a list of
+    (probability to beat control, expected loss) pairs, the expected loss being what would be
+    lost in conversion rate or actions per participant by picking the alternative over control.
+    """
+    draws = draws or conf.BAYESIAN_DRAWS
+    seed = conf.BAYESIAN_SEED if seed is None else seed
+    comparisons = [tuple(comparison) for comparison in comparisons]
+    if not comparisons:
+        return []
+
+    cache = caches[conf.RESULTS_CACHE]
+    fingerprint = hashlib.md5(json.dumps([comparisons, draws, seed, BETA_PRIOR, GAMMA_PRIOR]).encode('utf-8')).hexdigest()
+    cache_key = 'experiments:bayesian:%s' % fingerprint
+    results = cache.get(cache_key)
+    if results is None:
+        # Without a seed the same counts still give the same results, whichever process samples them
+        results = _analyse(comparisons, draws, int(fingerprint[:8], 16) if seed is None else seed)
+        cache.set(cache_key, results, conf.BAYESIAN_CACHE_TIMEOUT)
+    return results
+
+
+def _analyse(comparisons, draws, seed):
+    # Posteriors are sampled once however many comparisons they are in, e.g. control's. The two
+    # sides of a comparison never share samples, even when their posteriors are the same.
+    posteriors = []
+    posterior_rows = {}
+    rows = []
+    for kind, a_count, a_total, b_count, b_total in comparisons:
+        pair = []
+        for side, count, total in (('a', a_count, a_total), ('b', b_count, b_total)):
+            parameters = posterior(kind, count, total)
+            if (side, parameters) not in posterior_rows:
+                posterior_rows[(side, parameters)] = len(posteriors)
+                posteriors.append(parameters)
+            pair.append(posterior_rows[(side, parameters)])
+        rows.append(pair)
+
+    sampled = _sample(posteriors, rows, draws, seed)
+
+    results = []
+    for (a_row, b_row), (probability, expected_loss) in zip(rows, sampled):
+        distribution, a_first, a_second = posteriors[a_row]
+        distribution, b_first, b_second = posteriors[b_row]
+        # Closed form of the probability that the alternative (a) beats control (b)
+        if a_first <= CLOSED_FORM_MAX_TERMS:
+            if distribution == 'beta':
+                probability = beta_probability_to_beat(b_first, b_second, a_first, a_second)
+            else:
+                probability = gamma_probability_to_beat(b_first, b_second, a_first, a_second)
+        results.append((probability, expected_loss))
+    return results
+
+
+def _sample(posteriors, rows, draws, seed):
+    """Monte Carlo estimate of P(a > b) and E[max(b - a, 0)] for each (a, b) pair of posterior rows"""
+    if numpy is not None:
+        random_state = numpy.random.RandomState(seed)
+        samples = numpy.empty((len(posteriors), draws))
+        for distribution in ('beta', 'gamma'):
+            indexes = [i for i, parameters in enumerate(posteriors) if parameters[0] == distribution]
+            if not indexes:
+                continue
+            first = numpy.array([posteriors[i][1] for i in indexes], dtype=float)[:, None]
+            second = numpy.array([posteriors[i][2] for i in indexes], dtype=float)[:, None]
+            if distribution == 'beta':
+                samples[indexes] = random_state.beta(first, second, size=(len(indexes), draws))
+            else:
+                samples[indexes] = random_state.gamma(first, 1.0 / second, size=(len(indexes), draws))
+        a_samples = samples[[a_row for a_row, b_row in rows]]
+        b_samples = samples[[b_row for a_row, b_row in rows]]
+        probabilities = (a_samples > b_samples).mean(axis=1)
+        expected_losses = numpy.maximum(b_samples - a_samples, 0).mean(axis=1)
+        return [(float(probability), float(loss)) for probability, loss in zip(probabilities, expected_losses)]
+
+    generator = random.Random(seed)
+    samples = []
+    for distribution, first, second in posteriors:
+        if distribution == 'beta':
+            samples.append([generator.betavariate(first, second) for _ in range(draws)])
+        else:
+            samples.append([generator.gammavariate(first, 1.0 / second) for _ in range(draws)])
+    results = []
+    for a_row, b_row in rows:
+        pairs = list(zip(samples[a_row], samples[b_row]))
+        results.append((sum(1 for a, b in pairs if a > b) / float(draws), sum(max(b - a, 0) for a, b in pairs) / draws))
+    return results
@@ -14,13 +14,83 @@ BUILT_IN_GOALS = (
 
 SESSION_LENGTH = getattr(settings, 'EXPERIMENTS_SESSION_LENGTH', 6)
 
+# last_seen is stored rounded down to this many seconds
+LAST_SEEN_GRANULARITY = getattr(settings, 'EXPERIMENTS_LAST_SEEN_GRANULARITY', 60)
+
+# Keep authenticated users' last_seen in redis until the flush_last_seen command stores it
+LAST_SEEN_BUFFER = getattr(settings, 'EXPERIMENTS_LAST_SEEN_BUFFER', False)
+
 USER_GOALS = getattr(settings, 'EXPERIMENTS_GOALS', [])
 ALL_GOALS = tuple(chain(USER_GOALS, BUILT_IN_GOALS))
 
+# Goals that only count converted participants, approximately (a HyperLogLog with the redis
+# backends), instead of every participant's goal count. Their distributions are unavailable.
+HLL_GOALS = frozenset(getattr(settings, 'EXPERIMENTS_HLL_GOALS', []))
+
+# Store participants in the counters as an 8 byte hash of their identifier instead of
+# e.g. 'session:<session key>'. Existing counters are converted by the compact_participant_ids command.
+COMPACT_PARTICIPANT_IDS = getattr(settings, 'EXPERIMENTS_COMPACT_PARTICIPANT_IDS', False)
+
 VERIFY_HUMAN = getattr(settings, 'EXPERIMENTS_VERIFY_HUMAN', True)
 
 CONFIRM_HUMAN = getattr(settings, 'EXPERIMENTS_CONFIRM_HUMAN', True)
 
 CONFIRM_HUMAN_SESSION_KEY = getattr(settings, 'EXPERIMENTS_CONFIRM_HUMAN_SESSION_KEY', 'experiments_verified_human')
 
+# Experiments are held in an in-process registry. Other processes' changes are picked up
+# through a version key in REGISTRY_CACHE (which must be shared by all processes), checked at most
+# once every REGISTRY_POLL_INTERVAL seconds.
+REGISTRY_CACHE = getattr(settings, 'EXPERIMENTS_REGISTRY_CACHE', 'default')
+REGISTRY_POLL_INTERVAL = getattr(settings, 'EXPERIMENTS_REGISTRY_POLL_INTERVAL', 5)
+
+# Name of the cache holding authenticated users' enrollments between requests, None to disable
+ENROLLMENT_CACHE = getattr(settings, 'EXPERIMENTS_ENROLLMENT_CACHE', None)
+ENROLLMENT_CACHE_TIMEOUT = getattr(settings, 'EXPERIMENTS_ENROLLMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Results shown in the admin are computed from the counters at most once every
+# RESULTS_CACHE_TIMEOUT seconds. For RESULTS_CACHE_STALE_TIMEOUT seconds after that the
+# old results are still served while they are recomputed in the background.
+RESULTS_CACHE = getattr(settings, 'EXPERIMENTS_RESULTS_CACHE', 'default')
+RESULTS_CACHE_TIMEOUT = getattr(settings, 'EXPERIMENTS_RESULTS_CACHE_TIMEOUT', 60)
+RESULTS_CACHE_STALE_TIMEOUT = getattr(settings, 'EXPERIMENTS_RESULTS_CACHE_STALE_TIMEOUT', 60 * 60)
+
+# Ended experiments (in the control state) are archived by the archive_experiments command
+# this many days after their end_date: their counts are kept in the database and their
+# per participant counters are removed from the counter store.
+ARCHIVE_AFTER_DAYS = getattr(settings, 'EXPERIMENTS_ARCHIVE_AFTER_DAYS', 30)
+
+# Where participant and goal events go, see experiments.events
+EVENT_SINKS = getattr(settings, 'EXPERIMENTS_EVENT_SINKS', [{'BACKEND': 'experiments.events.LoggingSink'}])
+# Events waiting for the background thread; the oldest are dropped beyond this
+EVENT_BUFFER_SIZE = getattr(settings, 'EXPERIMENTS_EVENT_BUFFER_SIZE', 10000)
+EVENT_BATCH_SIZE = getattr(settings, 'EXPERIMENTS_EVENT_BATCH_SIZE', 500)
+EVENT_FLUSH_INTERVAL = getattr(settings, 'EXPERIMENTS_EVENT_FLUSH_INTERVAL', 1)
+# Ship events from a background thread, or right away on the calling thread
+EVENT_BACKGROUND = getattr(settings, 'EXPERIMENTS_EVENT_BACKGROUND', True)
+
+# Goals are added to the GOAL_STREAM redis stream and counted by the process_goal_stream
+# command, see experiments.goal_stream. Applied entries are remembered for
+# GOAL_STREAM_APPLIED_TIMEOUT seconds so redelivered ones aren't counted twice.
+ASYNC_GOALS = getattr(settings, 'EXPERIMENTS_ASYNC_GOALS', False)
+GOAL_STREAM = getattr(settings, 'EXPERIMENTS_GOAL_STREAM', 'experiments:goals')
+GOAL_STREAM_APPLIED_TIMEOUT = getattr(settings, 'EXPERIMENTS_GOAL_STREAM_APPLIED_TIMEOUT', 60 * 60 * 24)
+
+# Sequential testing, see experiments.sequential. The standard deviation of the normal prior
+# on the difference of conversion rates of an alternative with control: smaller values
+# detect small differences sooner and large ones later.
+SEQUENTIAL_MIXTURE_SD = getattr(settings, 'EXPERIMENTS_SEQUENTIAL_MIXTURE_SD', 0.01)
+# Participants each side needs before its p-values are tracked (the normal approximation is poor before)
+SEQUENTIAL_MIN_PARTICIPANTS = getattr(settings, 'EXPERIMENTS_SEQUENTIAL_MIN_PARTICIPANTS', 100)
+# The stop_experiments command ends an experiment once a relevant goal is significant at this level
+SEQUENTIAL_ALPHA = getattr(settings, 'EXPERIMENTS_SEQUENTIAL_ALPHA', 0.05)
+SEQUENTIAL_STATE_TIMEOUT = getattr(settings, 'EXPERIMENTS_SEQUENTIAL_STATE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# Add the Bayesian probability to beat control and expected loss to the results, see experiments.bayesian
+BAYESIAN_RESULTS = getattr(settings, 'EXPERIMENTS_BAYESIAN_RESULTS', False)
+# Posterior samples per alternative, and the random seed to draw them with (None for one derived from the counts)
+BAYESIAN_DRAWS = getattr(settings, 'EXPERIMENTS_BAYESIAN_DRAWS', 20000)
+BAYESIAN_SEED = getattr(settings, 'EXPERIMENTS_BAYESIAN_SEED', None)
+# Seconds for which results are memoized (in RESULTS_CACHE) for the same counts
+BAYESIAN_CACHE_TIMEOUT = getattr(settings, 'EXPERIMENTS_BAYESIAN_CACHE_TIMEOUT', 60 * 60 * 24)
+
 BOT_REGEX = re.compile("(Baidu|Gigabot|Googlebot|YandexBot|AhrefsBot|TVersity|libwww-perl|Yeti|lwp-trivial|msnbot|bingbot|facebookexternalhit|Twitterbot|Twitmunin|SiteUptime|TwitterFeed|Slurp|WordPress|ZIBB|ZyBorg)", re.IGNORECASE)
@@ -1,74 +1,772 @@
+import bisect
+import fnmatch
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q
+from django.utils.encoding import force_text
 from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 
 import redis
-from redis.sentinel import Sentinel
+from redis.sentinel import Sentinel, SentinelConnectionPool
 from redis.exceptions import ConnectionError, ResponseError
 
+from experiments.models import Counter
+
 
 COUNTER_CACHE_KEY = 'experiments:participants:%s'
 COUNTER_FREQ_CACHE_KEY = 'experiments:freq:%s'
+COUNTER_VERSION_CACHE_KEY = 'experiments:version:%s'
+COUNTER_INDEX_CACHE_KEY = 'experiments:keys:%s'
+COUNTER_HLL_CACHE_KEY = 'experiments:hll:%s'
+COUNTER_MINIMUM_CACHE_KEY = 'experiments:minimum:%s'
+
+# Relative standard error of redis' HyperLogLog counts (16384 registers)
+HLL_STANDARD_ERROR = 1.04 / math.sqrt(16384)
+
+# Key names used by ShardedCounters. The {hash tag} keeps both keys of a counter on one server.
+SHARDED_COUNTER_CACHE_KEY = 'experiments:participants:{%s}'
+SHARDED_COUNTER_FREQ_CACHE_KEY = 'experiments:freq:{%s}'
+SHARDED_COUNTER_HLL_CACHE_KEY = 'experiments:hll:{%s}'
+SHARDED_COUNTER_MINIMUM_CACHE_KEY = 'experiments:minimum:{%s}'
+
+# Points per server on the consistent hashing ring
+HASH_RING_REPLICAS = 160
+
+# Number of keys handled per SCAN/SSCAN/UNLINK call
+SCAN_BATCH_SIZE = 500
+
+# KEYS: participant hash, frequency histogram[, index set]
+# ARGV: participant identifier, count
+# Bumps the participant's count and moves them to their new histogram bucket
+# in a single atomic step. Empty buckets are removed so the histogram never
+# holds zero or negative frequencies. Both keys are recorded in the index set
+# when one is given, so they can be deleted later without scanning the keyspace.
+INCREMENT_SCRIPT = """
+if KEYS[3] then
+    redis.call('SADD', KEYS[3], KEYS[1], KEYS[2])
+end
+local count = tonumber(ARGV[2])
+local new_value = redis.call('HINCRBY', KEYS[1], ARGV[1], count)
+local old_value = new_value - count
+if old_value > 0 then
+    if redis.call('HINCRBY', KEYS[2], old_value, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], old_value)
+    end
+end
+if new_value > 0 then
+    redis.call('HINCRBY', KEYS[2], new_value, 1)
+end
+return new_value
+"""
+
+# KEYS: participant hash, frequency histogram
+# ARGV: participant identifier
+# Removes the participant and takes them out of their histogram bucket.
+CLEAR_SCRIPT = """
+local value = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+if not value then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+if value > 0 then
+    if redis.call('HINCRBY', KEYS[2], value, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], value)
+    end
+end
+return value
+"""
+
+# KEYS: participant hash, frequency histogram
+# ARGV: pairs of old and new participant identifiers
+# Moves each participant's count to their new identifier. If the new identifier already has a
+# count the two are added up and the histogram is corrected accordingly.
+RENAME_SCRIPT = """
+local renamed = 0
+for i = 1, #ARGV, 2 do
+    local value = tonumber(redis.call('HGET', KEYS[1], ARGV[i]))
+    if value then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        local existing = tonumber(redis.call('HGET', KEYS[1], ARGV[i + 1]))
+        if existing then
+            for _, bucket in ipairs({value, existing}) do
+                if bucket > 0 and redis.call('HINCRBY', KEYS[2], bucket, -1) <= 0 then
+                    redis.call('HDEL', KEYS[2], bucket)
+                end
+            end
+            value = value + existing
+            if value > 0 then
+                redis.call('HINCRBY', KEYS[2], value, 1)
+            end
+        end
+        redis.call('HSET', KEYS[1], ARGV[i + 1], value)
+        renamed = renamed + 1
+    end
+end
+return renamed
+"""
+
+# KEYS: minimums hash
+# ARGV: version, timeout, then pairs of field and value
+# Keeps the lowest value seen for each field and returns them. The hash starts over when
+# the version changes (e.g. the counters it was computed from were reset).
+MINIMUM_SCRIPT = """
+if redis.call('HGET', KEYS[1], '_version') ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], '_version', ARGV[1])
+end
+local result = {}
+for i = 3, #ARGV, 2 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    if current and tonumber(current) <= tonumber(ARGV[i + 1]) then
+        table.insert(result, current)
+    else
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        table.insert(result, ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return result
+"""
+
+
+_connection_pool = None
+_shard_connection_pools = None
+_connection_pool_lock = threading.Lock()
+
+
+def _connection_kwargs(options=None):
+    options = options or {}
+    return {
+        'password': options.get('password', getattr(settings, 'EXPERIMENTS_REDIS_PASSWORD', None)),
+        'db': options.get('db', getattr(settings, 'EXPERIMENTS_REDIS_DB', 0)),
+        'max_connections': getattr(settings, 'EXPERIMENTS_REDIS_MAX_CONNECTIONS', None),
+        'socket_timeout': getattr(settings, 'EXPERIMENTS_REDIS_SOCKET_TIMEOUT', None),
+        'socket_connect_timeout': getattr(settings, 'EXPERIMENTS_REDIS_SOCKET_CONNECT_TIMEOUT', None),
+    }
+
+
+def _create_connection_pool():
+    kwargs = _connection_kwargs()
+    if getattr(settings, 'EXPERIMENTS_REDIS_SENTINELS', None):
+        sentinel = Sentinel(settings.EXPERIMENTS_REDIS_SENTINELS, socket_timeout=settings.EXPERIMENTS_REDIS_SENTINELS_TIMEOUT)
+        # Connections look the master up when they connect, and reconnect (asking the
+        # sentinels again) when the master goes away or turns out to have been demoted
+        return SentinelConnectionPool(settings.EXPERIMENTS_REDIS_MASTER_NAME, sentinel, **kwargs)
+
+    return redis.ConnectionPool(
+        host=getattr(settings, 'EXPERIMENTS_REDIS_HOST', 'localhost'),
+        port=getattr(settings, 'EXPERIMENTS_REDIS_PORT', 6379),
+        **kwargs
+    )
+
+
+def connection_pool():
+    """
+    Process-wide pool for the server configured in the EXPERIMENTS_REDIS_* settings.
+    redis-py pools notice when the process has forked and drop the parent's connections.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = _create_connection_pool()
+    return _connection_pool
+
+
+def shard_name(shard):
+    """Identifies a server in EXPERIMENTS_REDIS_SHARDS on the hash ring, independently of its position in the list"""
+    return shard.get('name') or '%s:%s/%s' % (shard.get('host', 'localhost'), shard.get('port', 6379), shard.get('db', 0))
+
+
+def shard_connection_pools():
+    """Process-wide pools for the servers in EXPERIMENTS_REDIS_SHARDS"""
+    global _shard_connection_pools
+    if _shard_connection_pools is None:
+        with _connection_pool_lock:
+            if _shard_connection_pools is None:
+                _shard_connection_pools = [
+                    redis.ConnectionPool(host=shard.get('host', 'localhost'), port=shard.get('port', 6379), **_connection_kwargs(shard))
+                    for shard in settings.EXPERIMENTS_REDIS_SHARDS
+                ]
+    return _shard_connection_pools
+
+
+def reset_connection_pool():
+    """Disconnect and forget the shared pools, e.g. after changing the EXPERIMENTS_REDIS_* settings"""
+    global _connection_pool, _shard_connection_pools
+    with _connection_pool_lock:
+        for pool in [_connection_pool] + list(_shard_connection_pools or []):
+            if pool is not None:
+                pool.disconnect()
+        _connection_pool = None
+        _shard_connection_pools = None
+
 
+def redis_client():
+    """Redis client using the shared connection pool"""
+    return redis.Redis(connection_pool=connection_pool())
 
-class Counters(object):
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes, each placed on the ring at HASH_RING_REPLICAS points"""
+
+    def __init__(self, nodes, names, replicas=HASH_RING_REPLICAS):
+        points = []
+        for node, name in zip(nodes, names):
+            for i in range(replicas):
+                points.append((self._hash('%s-%s' % (name, i)), node))
+        points.sort()
+        self._points = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        position = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[position]
+
+
+class BaseCounters(object):
+    """
+    Interface of the counter backends. A counter (`key`) holds a count per participant; its
+    value is the number of participants and its frequencies the histogram of their counts.
+    `index` groups keys (e.g. of one experiment) so they can be deleted with reset_index.
+
+    Unique counters (add_unique/get_unique) only count distinct participants. Backends may
+    estimate them, with a relative standard error of `unique_error`.
+
+    Pick the backend ExperimentCounter uses with the EXPERIMENTS_COUNTER_BACKEND setting.
+    """
+
+    unique_error = 0
+    # Whether participant identifiers may be arbitrary bytes rather than text
+    binary_participants = True
+
+    def increment(self, key, participant_identifier, count=1, index=None):
+        raise NotImplementedError
+
+    def increment_many(self, increments, unique=(), markers=(), raise_errors=False):
+        """
+        Apply several (key, participant_identifier, count, index) increments and (key, participant_identifier, index)
+        unique additions.
+
+        `markers` are (redis key, timeout) pairs set on the default redis server once the increments are
+        written, within the same transaction where the backend allows it; see experiments.goal_stream.
+        With `raise_errors` a failed write raises instead of being ignored, and no marker is set.
+        """
+        for key, participant_identifier, count, index in increments:
+            self.increment(key, participant_identifier, count, index=index)
+        for key, participant_identifier, index in unique:
+            self.add_unique(key, participant_identifier, index=index)
+        self._set_markers(markers, raise_errors)
+
+    def _set_markers(self, markers, raise_errors):
+        if not markers:
+            return
+        try:
+            pipe = redis_client().pipeline()
+            for marker, timeout in markers:
+                pipe.set(marker, 1, ex=timeout)
+            pipe.execute()
+        except (ConnectionError, ResponseError):
+            if raise_errors:
+                raise
+
+    def add_unique(self, key, participant_identifier, index=None):
+        # Exact by default: a unique counter is a regular counter whose frequencies are ignored
+        self.increment(key, participant_identifier, index=index)
+
+    def get_unique(self, key):
+        return self.get(key)
+
+    def clear(self, key, participant_identifier):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_multi(self, keys, frequency_keys=(), unique_keys=()):
+        """
+        Returns a (counts, frequencies) tuple of dicts for `keys` and `frequency_keys`.
+        The counts of `unique_keys` are included in counts.
+        """
+        counts = dict((key, self.get(key)) for key in keys)
+        counts.update((key, self.get_unique(key)) for key in unique_keys)
+        frequencies = dict((key, self.get_frequencies(key)) for key in frequency_keys)
+        return counts, frequencies
+
+    def get_frequency(self, key, participant_identifier):
+        raise NotImplementedError
+
+    def get_frequencies(self, key):
+        raise NotImplementedError
+
+    def scan_participants(self, key, match=None):
+        """
+        Iterate over the counter's (participant_identifier, count) pairs a batch at a time, optionally
+        only those whose identifier matches the glob pattern `match`
+        """
+        raise NotImplementedError
+
+    def get_participant_counts(self, keys, participant_identifiers):
+        """Returns {key: [count of each participant]} for the given counters"""
+        return dict((key, [self.get_frequency(key, participant_identifier) for participant_identifier in participant_identifiers]) for key in keys)
+
+    def get_version(self, key):
+        raise NotImplementedError
+
+    def bump_version(self, key):
+        raise NotImplementedError
+
+    def reset(self, key):
+        raise NotImplementedError
+
+    def reset_pattern(self, pattern_key):
+        raise NotImplementedError
+
+    def index_keys(self, index):
+        """Returns the set of keys incremented with this index"""
+        raise NotImplementedError
+
+    def update_minimums(self, key, version, values, timeout):
+        """
+        Running minimums of floats (e.g. p-values): lower each of the key's fields to the one in
+        `values` ({field: value}) if it is smaller and return the resulting {field: value}. They
+        start over when `version` differs from the last call's, and expire after `timeout` seconds
+        without updates where the backend supports it. reset(key) removes them.
+        """
+        raise NotImplementedError
+
+    def reset_index(self, index, keys=()):
+        """Delete every key incremented with this index, plus `keys`"""
+        raise NotImplementedError
+
+
+# Store of LocalCounters, shared by all its instances in the process. See reset_local_counters.
+_local_lock = threading.RLock()
+_local_counters = {}
+_local_frequencies = {}
+_local_indexes = {}
+_local_versions = {}
+_local_minimums = {}
+
+
+def reset_local_counters():
+    """Empty the counters of every LocalCounters instance, e.g. between tests"""
+    with _local_lock:
+        for store in (_local_counters, _local_frequencies, _local_indexes, _local_versions, _local_minimums):
+            store.clear()
+
+
+class LocalCounters(BaseCounters):
+    """
+    Counters held in the memory of the current process, shared by all its threads and instances.
+    For tests and single process deployments; nothing is persisted.
+    """
+    def __init__(self):
+        self._lock = _local_lock
+        self._counters = _local_counters
+        self._frequencies = _local_frequencies
+        self._indexes = _local_indexes
+        self._minimums = _local_minimums
+        self._versions = _local_versions
+
+    def increment(self, key, participant_identifier, count=1, index=None):
+        if count == 0:
+            return
+        with self._lock:
+            if index is not None:
+                self._indexes.setdefault(index, set()).add(key)
+            participants = self._counters.setdefault(key, {})
+            new_value = participants.get(participant_identifier, 0) + count
+            participants[participant_identifier] = new_value
+            self._move(key, new_value - count, new_value)
+            return new_value
+
+    def _move(self, key, old_value, new_value):
+        histogram = self._frequencies.setdefault(key, {})
+        if old_value > 0:
+            histogram[old_value] -= 1
+            if histogram[old_value] <= 0:
+                del histogram[old_value]
+        if new_value > 0:
+            histogram[new_value] = histogram.get(new_value, 0) + 1
+
+    def clear(self, key, participant_identifier):
+        with self._lock:
+            value = self._counters.get(key, {}).pop(participant_identifier, None)
+            if value is not None:
+                self._move(key, value, 0)
+
+    def get(self, key):
+        return len(self._counters.get(key, ()))
+
+    def get_frequency(self, key, participant_identifier):
+        return self._counters.get(key, {}).get(participant_identifier, 0)
+
+    def get_frequencies(self, key):
+        with self._lock:
+            return dict(self._frequencies.get(key, {}))
+
+    def scan_participants(self, key, match=None):
+        with self._lock:
+            participants = list(self._counters.get(key, {}).items())
+        for participant_identifier, count in participants:
+            if match is None or fnmatch.fnmatchcase(participant_identifier, match):
+                yield participant_identifier, count
+
+    def get_version(self, key):
+        return self._versions.get(key, 0)
+
+    def bump_version(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def reset(self, key):
+        with self._lock:
+            self._counters.pop(key, None)
+            self._frequencies.pop(key, None)
+            self._minimums.pop(key, None)
+        return True
+
+    def reset_pattern(self, pattern_key):
+        with self._lock:
+            for key in fnmatch.filter(list(self._counters), pattern_key):
+                self.reset(key)
+        return True
+
+    def index_keys(self, index):
+        with self._lock:
+            return set(self._indexes.get(index, ()))
+
+    def update_minimums(self, key, version, values, timeout):
+        with self._lock:
+            minimums = self._minimums.get(key)
+            if minimums is None or minimums['_version'] != version:
+                minimums = self._minimums[key] = {'_version': version}
+            for field, value in values.items():
+                minimums[field] = min(value, minimums.get(field, value))
+            return dict((field, minimums[field]) for field in values)
+
+    def reset_index(self, index, keys=()):
+        with self._lock:
+            for key in set(keys) | self._indexes.pop(index, set()):
+                self.reset(key)
+        return True
+
+
+def _encode_minimum(value):
+    # -log10 of values in (0, 1] in micro-units, within Counter.count's range. See DatabaseCounters.update_minimums
+    largest = 2 ** 31 - 1
+    if value <= 0:
+        return largest
+    return min(largest, max(0, int(math.floor(-math.log10(value) * 1e6))))
+
+
+def _glob_regex(pattern):
+    # Only the * and ? wildcards of redis patterns are supported
+    return '^%s$' % ''.join('.*' if part == '*' else '.' if part == '?' else re.escape(part) for part in re.split(r'([*?])', pattern))
+
+
+class DatabaseCounters(BaseCounters):
+    """
+    Counters stored in the experiments_counter table, one row per participant and counter.
+    Increments are written with batched upserts; see CounterManager.bulk_increment.
+    """
+    binary_participants = False
+
+    def increment(self, key, participant_identifier, count=1, index=None):
+        if count == 0:
+            return
+        self.increment_many([(key, participant_identifier, count, index)])
+
+    def increment_many(self, increments, unique=(), markers=(), raise_errors=False):
+        increments = list(increments) + [(key, participant_identifier, 1, index) for key, participant_identifier, index in unique]
+        Counter.objects.bulk_increment(increments)
+        self._set_markers(markers, raise_errors)
+
+    def clear(self, key, participant_identifier):
+        Counter.objects.filter(key=key, participant=participant_identifier).delete()
+
+    def get(self, key):
+        return Counter.objects.filter(key=key).count()
+
+    def get_multi(self, keys, frequency_keys=(), unique_keys=()):
+        keys = list(keys) + list(unique_keys)
+        frequency_keys = list(frequency_keys)
+        counts = dict((key, 0) for key in keys)
+        frequencies = dict((key, {}) for key in frequency_keys)
+        if keys:
+            counts.update(Counter.objects.filter(key__in=keys).values_list('key').annotate(Count('id')))
+        if frequency_keys:
+            histograms = Counter.objects.filter(key__in=frequency_keys, count__gt=0).values_list('key', 'count').annotate(Count('id'))
+            for key, value, participants in histograms:
+                frequencies[key][value] = participants
+        return counts, frequencies
+
+    def get_frequency(self, key, participant_identifier):
+        values = Counter.objects.filter(key=key, participant=participant_identifier).values_list('count', flat=True)
+        return values[0] if values else 0
+
+    def get_frequencies(self, key):
+        return dict(Counter.objects.filter(key=key, count__gt=0).values_list('count').annotate(Count('id')))
+
+    def scan_participants(self, key, match=None):
+        counters = Counter.objects.filter(key=key).order_by('pk')
+        if match is not None:
+            counters = counters.filter(participant__regex=_glob_regex(match))
+        last_pk = None
+        while True:
+            # Paging by primary key keeps every query cheap however far into the table it is
+            batch = counters.filter(pk__gt=last_pk) if last_pk is not None else counters
+            batch = list(batch.values_list('pk', 'participant', 'count')[:SCAN_BATCH_SIZE])
+            for last_pk, participant_identifier, count in batch:
+                yield participant_identifier, count
+            if len(batch) < SCAN_BATCH_SIZE:
+                break
+
+    def get_participant_counts(self, keys, participant_identifiers):
+        participant_identifiers = list(participant_identifiers)
+        found = {}
+        rows = Counter.objects.filter(key__in=list(keys), participant__in=participant_identifiers).values_list('key', 'participant', 'count')
+        for key, participant_identifier, count in rows:
+            found[(key, participant_identifier)] = count
+        return dict((key, [found.get((key, participant_identifier), 0) for participant_identifier in participant_identifiers]) for key in keys)
+
+    def get_version(self, key):
+        return self.get_frequency(COUNTER_VERSION_CACHE_KEY % key, '')
+
+    def bump_version(self, key):
+        self.increment(COUNTER_VERSION_CACHE_KEY % key, '')
+        return self.get_version(key)
+
+    def reset(self, key):
+        Counter.objects.filter(key=key).delete()
+        return True
+
+    def reset_pattern(self, pattern_key):
+        Counter.objects.filter(key__regex=_glob_regex(pattern_key)).delete()
+        return True
+
+    def index_keys(self, index):
+        return set(Counter.objects.filter(index_name=index).values_list('key', flat=True).distinct())
+
+    def update_minimums(self, key, version, values, timeout):
+        # Rows hold integers, so values must lie in (0, 1] and are stored as micro-units of -log10(value).
+        # Rounding down makes the stored value at most 0.0003% larger. There is no expiry: reset(key) removes them.
+        try:
+            return self._update_minimums(key, version, values)
+        except IntegrityError:
+            # Another process created the rows meanwhile, the new values are the best known
+            return dict(values)
+
+    def _update_minimums(self, key, version, values):
+        with transaction.atomic():
+            stored = dict(Counter.objects.select_for_update().filter(key=key).values_list('participant', 'count'))
+            if stored.get('_version') != version:
+                Counter.objects.filter(key=key).delete()
+                Counter.objects.create(key=key, participant='_version', count=version)
+                stored = {}
+            minimums = {}
+            for field, value in values.items():
+                encoded = _encode_minimum(value)
+                if field not in stored:
+                    Counter.objects.create(key=key, participant=field, count=encoded)
+                elif stored[field] < encoded:
+                    Counter.objects.filter(key=key, participant=field).update(count=encoded)
+                else:
+                    encoded = stored[field]
+                minimums[field] = 10 ** (-encoded / 1e6)
+            return minimums
+
+    def reset_index(self, index, keys=()):
+        Counter.objects.filter(Q(index_name=index) | Q(key__in=list(keys))).delete()
+        return True
+
+
+class Counters(BaseCounters):
+    counter_cache_key = COUNTER_CACHE_KEY
+    freq_cache_key = COUNTER_FREQ_CACHE_KEY
+    hll_cache_key = COUNTER_HLL_CACHE_KEY
+    minimum_cache_key = COUNTER_MINIMUM_CACHE_KEY
+    # Unique counters are HyperLogLogs: about 12kB per key, however many participants they hold
+    unique_error = HLL_STANDARD_ERROR
+    # Cleared on servers older than redis 4, which don't know UNLINK
+    _supports_unlink = True
 
     @cached_property
     def _redis(self):
-        if getattr(settings, 'EXPERIMENTS_REDIS_SENTINELS', None):
-            sentinel = Sentinel(settings.EXPERIMENTS_REDIS_SENTINELS, socket_timeout=settings.EXPERIMENTS_REDIS_SENTINELS_TIMEOUT)
-            host, port = sentinel.discover_master(settings.EXPERIMENTS_REDIS_MASTER_NAME)
-        else:
-            host = getattr(settings, 'EXPERIMENTS_REDIS_HOST', 'localhost')
-            port = getattr(settings, 'EXPERIMENTS_REDIS_PORT', 6379)
+        return redis_client()
 
-        password = getattr(settings, 'EXPERIMENTS_REDIS_PASSWORD', None)
-        db = getattr(settings, 'EXPERIMENTS_REDIS_DB', 0)
+    def _clients(self):
+        return [self._redis]
 
-        return redis.Redis(host=host, port=port, password=password, db=db)
+    def _client_for(self, key):
+        return self._redis
 
-    def increment(self, key, participant_identifier, count=1):
+    def _marker_client(self):
+        # The default server, where markers are looked up (e.g. by experiments.goal_stream)
+        return self._redis
+
+    def _group_by_client(self, items, key=lambda item: item):
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(self._client_for(key(item)), []).append(item)
+        return groups
+
+    @cached_property
+    def _increment_script(self):
+        # register_script runs EVALSHA and reloads the script on NOSCRIPT
+        return self._redis.register_script(INCREMENT_SCRIPT)
+
+    @cached_property
+    def _clear_script(self):
+        return self._redis.register_script(CLEAR_SCRIPT)
+
+    @cached_property
+    def _rename_script(self):
+        return self._redis.register_script(RENAME_SCRIPT)
+
+    @cached_property
+    def _minimum_script(self):
+        return self._redis.register_script(MINIMUM_SCRIPT)
+
+    def _increment_keys(self, key, index):
+        keys = [self.counter_cache_key % key, self.freq_cache_key % key]
+        if index is not None:
+            keys.append(COUNTER_INDEX_CACHE_KEY % index)
+        return keys
+
+    def increment(self, key, participant_identifier, count=1, index=None):
+        """
+        Add `count` to the participant's counter. `index` names a group of keys (e.g. an experiment)
+        that can later be deleted together with reset_index.
+        """
         if count == 0:
             return
 
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            new_value = self._redis.hincrby(cache_key, participant_identifier, count)
+            # Updates the participant hash and the histogram of per-user counts in one round trip
+            return self._increment_script(keys=self._increment_keys(key, index), args=[participant_identifier, count],
+                                          client=self._client_for(key))
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            pass
 
-            # Maintain histogram of per-user counts
-            if new_value > count:
-                self._redis.hincrby(freq_cache_key, new_value - count, -1)
-            self._redis.hincrby(freq_cache_key, new_value, 1)
+    def increment_many(self, increments, unique=(), markers=(), raise_errors=False):
+        """
+        Apply several (key, participant_identifier, count, index) increments and (key, participant_identifier, index)
+        unique additions in a single transaction per server. The (key, timeout) `markers` are set in the
+        transaction of the default server, after those of the other servers (ShardedCounters).
+        """
+        operations = [(increment[0], False, increment) for increment in increments if increment[2] != 0]
+        operations += [(addition[0], True, addition) for addition in unique]
+        groups = self._group_by_client(operations, key=lambda operation: operation[0])
+        marker_client = self._marker_client() if markers else None
+        if markers:
+            groups[marker_client] = groups.pop(marker_client, [])
+        try:
+            results = []
+            for client, group in groups.items():
+                pipe = client.pipeline()
+                for _, is_unique, operation in group:
+                    if is_unique:
+                        self._add_unique(pipe, *operation)
+                    else:
+                        key, participant_identifier, count, index = operation
+                        self._increment_script(keys=self._increment_keys(key, index), args=[participant_identifier, count], client=pipe)
+                if client is marker_client:
+                    for marker, timeout in markers:
+                        pipe.set(marker, 1, ex=timeout)
+                results.extend(pipe.execute())
+            return results
+        except (ConnectionError, ResponseError):
+            if raise_errors:
+                raise
+            # Handle Redis failures gracefully
+
+    def _add_unique(self, pipe, key, participant_identifier, index):
+        hll_cache_key = self.hll_cache_key % key
+        pipe.pfadd(hll_cache_key, participant_identifier)
+        if index is not None:
+            pipe.sadd(COUNTER_INDEX_CACHE_KEY % index, hll_cache_key)
+
+    def add_unique(self, key, participant_identifier, index=None):
+        try:
+            pipe = self._client_for(key).pipeline()
+            self._add_unique(pipe, key, participant_identifier, index)
+            pipe.execute()
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
             pass
 
-    def clear(self, key, participant_identifier):
+    def get_unique(self, key):
         try:
-            # Remove the direct entry
-            cache_key = COUNTER_CACHE_KEY % key
-            pipe = self._redis.pipeline()
-            freq, _ = pipe.hget(cache_key, participant_identifier).hdel(cache_key, participant_identifier).execute()
+            return self._client_for(key).pfcount(self.hll_cache_key % key)
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            return 0
 
-            # Remove from the histogram
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            self._redis.hincrby(freq_cache_key, freq, -1)
+    def clear(self, key, participant_identifier):
+        try:
+            cache_key = self.counter_cache_key % key
+            freq_cache_key = self.freq_cache_key % key
+            self._clear_script(keys=[cache_key, freq_cache_key], args=[participant_identifier], client=self._client_for(key))
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
             pass
 
     def get(self, key):
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            return self._redis.hlen(cache_key)
+            cache_key = self.counter_cache_key % key
+            return self._client_for(key).hlen(cache_key)
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
             return 0
 
+    def get_multi(self, keys, frequency_keys=(), unique_keys=()):
+        """
+        Fetch the participant count of every key in `keys`, the histogram of every key in
+        `frequency_keys` and the estimated count of every key in `unique_keys` in a single pipeline
+        per server. Returns a (counts, frequencies) tuple of dicts.
+        """
+        requests = [(key, 'count') for key in keys] + [(key, 'frequency') for key in frequency_keys] + [(key, 'unique') for key in unique_keys]
+        counts = {}
+        frequencies = {}
+        try:
+            for client, group in self._group_by_client(requests, key=lambda request: request[0]).items():
+                pipe = client.pipeline(transaction=False)
+                for key, kind in group:
+                    if kind == 'frequency':
+                        pipe.hgetall(self.freq_cache_key % key)
+                    elif kind == 'unique':
+                        pipe.pfcount(self.hll_cache_key % key)
+                    else:
+                        pipe.hlen(self.counter_cache_key % key)
+                for (key, kind), result in zip(group, pipe.execute()):
+                    if kind == 'frequency':
+                        frequencies[key] = dict((int(k), int(v)) for (k, v) in result.items() if int(v) > 0)
+                    else:
+                        counts[key] = result
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            return {}, {}
+        return counts, frequencies
+
     def get_frequency(self, key, participant_identifier):
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            freq = self._redis.hget(cache_key, participant_identifier)
+            cache_key = self.counter_cache_key % key
+            freq = self._client_for(key).hget(cache_key, participant_identifier)
             return int(freq) if freq else 0
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
@@ -76,22 +774,83 @@ class Counters(object):
 
     def get_frequencies(self, key):
         try:
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            # In some cases when there are concurrent updates going on, there can
-            # briefly be a negative result for some frequency count. We discard these
-            # as they shouldn't really affect the result, and they are about to become
-            # zero anyway.
-            return dict((int(k), int(v)) for (k, v) in self._redis.hgetall(freq_cache_key).items() if int(v) > 0)
+            freq_cache_key = self.freq_cache_key % key
+            # The increment script keeps the histogram consistent, but histograms written
+            # by older versions may still hold empty or negative buckets, so skip those.
+            return dict((int(k), int(v)) for (k, v) in self._client_for(key).hgetall(freq_cache_key).items() if int(v) > 0)
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
             return tuple()
 
+    def scan_participants(self, key, match=None):
+        """
+        Iterate over the counter's (participant_identifier, count) pairs in SCAN_BATCH_SIZE steps.
+
+        HSCAN may return a participant more than once if the hash is resized meanwhile. Unlike the
+        other methods, redis errors are raised: a scan that was cut short mustn't look complete.
+        """
+        for participant_identifier, count in self._client_for(key).hscan_iter(self.counter_cache_key % key, match=match, count=SCAN_BATCH_SIZE):
+            yield participant_identifier, int(count)
+
+    def get_participant_counts(self, keys, participant_identifiers):
+        participant_identifiers = list(participant_identifiers)
+        counts = dict((key, [0] * len(participant_identifiers)) for key in keys)
+        if not participant_identifiers:
+            return counts
+        try:
+            for client, group in self._group_by_client(keys).items():
+                pipe = client.pipeline(transaction=False)
+                for key in group:
+                    pipe.hmget(self.counter_cache_key % key, participant_identifiers)
+                for key, values in zip(group, pipe.execute()):
+                    counts[key] = [int(value) if value else 0 for value in values]
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            pass
+        return counts
+
+    def rename_participants(self, key, renames):
+        """Give participants new identifiers, from a list of (old, new) pairs. Returns the number renamed"""
+        args = [identifier for pair in renames for identifier in pair]
+        if not args:
+            return 0
+        return self._rename_script(keys=[self.counter_cache_key % key, self.freq_cache_key % key], args=args, client=self._client_for(key))
+
+    def update_minimums(self, key, version, values, timeout):
+        fields = sorted(values)
+        args = [version, timeout]
+        for field in fields:
+            args.extend([field, repr(float(values[field]))])
+        try:
+            results = self._minimum_script(keys=[self.minimum_cache_key % key], args=args, client=self._client_for(key))
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully: without the stored minimums, the new values are the best known
+            return dict(values)
+        return dict((field, float(result)) for field, result in zip(fields, results))
+
+    def get_version(self, key):
+        try:
+            return int(self._client_for(key).get(COUNTER_VERSION_CACHE_KEY % key) or 0)
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            return 0
+
+    def bump_version(self, key):
+        try:
+            return self._client_for(key).incr(COUNTER_VERSION_CACHE_KEY % key)
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            return None
+
     def reset(self, key):
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            self._redis.delete(cache_key)
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            self._redis.delete(freq_cache_key)
+            client = self._client_for(key)
+            cache_key = self.counter_cache_key % key
+            client.delete(cache_key)
+            freq_cache_key = self.freq_cache_key % key
+            client.delete(freq_cache_key)
+            client.delete(self.hll_cache_key % key)
+            client.delete(self.minimum_cache_key % key)
             return True
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
@@ -99,14 +858,116 @@ class Counters(object):
 
     def reset_pattern(self, pattern_key):
         #similar to above, but can pass pattern as arg instead
+        #SCAN walks the keyspace in small steps so redis keeps serving other clients meanwhile
         try:
-            cache_key = COUNTER_CACHE_KEY % pattern_key
-            for key in self._redis.keys(cache_key):
-                self._redis.delete(key)
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % pattern_key
-            for key in self._redis.keys(freq_cache_key):
-                self._redis.delete(key)
+            for client in self._clients():
+                for pattern in (self.counter_cache_key % pattern_key, self.freq_cache_key % pattern_key, self.hll_cache_key % pattern_key):
+                    self._unlink_batches(client, client.scan_iter(match=pattern, count=SCAN_BATCH_SIZE))
             return True
         except (ConnectionError, ResponseError):
             # Handle Redis failures gracefully
             return False
+
+    def index_keys(self, index):
+        # The index set holds redis key names, each counter is recorded under its hash or its HyperLogLog
+        index_key = COUNTER_INDEX_CACHE_KEY % index
+        keys = set()
+        try:
+            for client in self._clients():
+                for cache_key in client.sscan_iter(index_key, count=SCAN_BATCH_SIZE):
+                    cache_key = force_text(cache_key)
+                    for template in (self.counter_cache_key, self.hll_cache_key):
+                        prefix, suffix = template.split('%s')
+                        if cache_key.startswith(prefix) and cache_key.endswith(suffix):
+                            keys.add(cache_key[len(prefix):len(cache_key) - len(suffix)])
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            pass
+        return keys
+
+    def reset_index(self, index, keys=()):
+        """
+        Delete every key incremented with this index, plus `keys` (e.g. keys written before the
+        index existed), without scanning the keyspace.
+        """
+        try:
+            index_key = COUNTER_INDEX_CACHE_KEY % index
+            for client in self._clients():
+                self._unlink_batches(client, client.sscan_iter(index_key, count=SCAN_BATCH_SIZE))
+            for client, group in self._group_by_client(keys).items():
+                self._unlink_batches(client, [cache_key % key for key in group for cache_key in (self.counter_cache_key, self.freq_cache_key, self.hll_cache_key, self.minimum_cache_key)])
+            for client in self._clients():
+                self._unlink(client, [index_key])
+            return True
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            return False
+
+    def _unlink_batches(self, client, keys):
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                self._unlink(client, batch)
+                batch = []
+        if batch:
+            self._unlink(client, batch)
+
+    def _unlink(self, client, keys):
+        # UNLINK (redis >= 4) frees the memory in a background thread, unlike DEL
+        if self._supports_unlink:
+            try:
+                return client.execute_command('UNLINK', *keys)
+            except ResponseError:
+                self._supports_unlink = False
+        return client.delete(*keys)
+
+
+class ShardedCounters(Counters):
+    """
+    Counters spread over the redis servers in EXPERIMENTS_REDIS_SHARDS by consistent hashing.
+
+    Each counter key is placed on a server by the hash tag ({...}) in its redis key names, so
+    a participant hash and its frequency histogram always live on the same server and are
+    still updated atomically. Adding a server only moves about 1/N of the counters.
+    Each server keeps its own index set for reset_index.
+    """
+    counter_cache_key = SHARDED_COUNTER_CACHE_KEY
+    freq_cache_key = SHARDED_COUNTER_FREQ_CACHE_KEY
+    hll_cache_key = SHARDED_COUNTER_HLL_CACHE_KEY
+    minimum_cache_key = SHARDED_COUNTER_MINIMUM_CACHE_KEY
+
+    @cached_property
+    def _shards(self):
+        return [redis.Redis(connection_pool=pool) for pool in shard_connection_pools()]
+
+    @cached_property
+    def _ring(self):
+        return HashRing(range(len(self._shards)), [shard_name(shard) for shard in settings.EXPERIMENTS_REDIS_SHARDS])
+
+    @cached_property
+    def _redis(self):
+        return self._shards[0]
+
+    def _clients(self):
+        return self._shards
+
+    def _client_for(self, key):
+        return self._shards[self._ring.get_node(key)]
+
+    def _marker_client(self):
+        # Not one of the shards: markers get a transaction of their own, after the increments
+        return redis_client()
+
+
+def default_counters():
+    """
+    Counters backend named by the EXPERIMENTS_COUNTER_BACKEND setting (a dotted path). Without it,
+    ShardedCounters when EXPERIMENTS_REDIS_SHARDS is set, otherwise Counters.
+    """
+    backend = getattr(settings, 'EXPERIMENTS_COUNTER_BACKEND', None)
+    if backend:
+        return import_string(backend)()
+    if getattr(settings, 'EXPERIMENTS_REDIS_SHARDS', None):
+        return ShardedCounters()
+    return Counters()
@@ -1,5 +1,5 @@
 import calendar
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.conf import settings
 
@@ -31,3 +31,10 @@ def datetime_from_timestamp(ts):
     if ts is None:
         return None
     return datetime.utcfromtimestamp(ts)
+
+
+def truncate_datetime(dt, seconds):
+    """Round dt down to a multiple of `seconds` since the epoch"""
+    if not seconds:
+        return dt
+    return dt - timedelta(seconds=calendar.timegm(dt.utctimetuple()) % seconds, microseconds=dt.microsecond)
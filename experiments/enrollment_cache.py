@@ -0,0 +1,48 @@
+"""
+Optional cache of authenticated users' enrollments that is shared between requests.
+
+Entries are written through by AuthenticatedUser whenever it changes an enrollment, and
+dropped when an Enrollment row is saved or deleted elsewhere. Every entry records the
+version stamp it was written under. Bumping the stamp with invalidate_all() makes every
+entry stale at once, which is what bulk updates that bypass model signals need.
+"""
+from django.core.cache import caches
+
+from experiments import conf
+
+from uuid import uuid4
+
+VERSION_CACHE_KEY = 'experiments:enrollments:version'
+USER_CACHE_KEY = 'experiments:enrollments:%s'
+
+
+def _cache():
+    return caches[conf.ENROLLMENT_CACHE]
+
+
+def get_enrollments(user_pk):
+    """Returns (enrollments, version). enrollments is None if the user's cached entry is missing or stale"""
+    if not conf.ENROLLMENT_CACHE:
+        return None, None
+    user_cache_key = USER_CACHE_KEY % user_pk
+    cached = _cache().get_many([VERSION_CACHE_KEY, user_cache_key])
+    version = cached.get(VERSION_CACHE_KEY)
+    entry = cached.get(user_cache_key)
+    if entry is None or entry[0] != version:
+        return None, version
+    return entry[1], version
+
+
+def set_enrollments(user_pk, enrollments, version):
+    if conf.ENROLLMENT_CACHE:
+        _cache().set(USER_CACHE_KEY % user_pk, (version, enrollments), conf.ENROLLMENT_CACHE_TIMEOUT)
+
+
+def invalidate_user(user_pk):
+    if conf.ENROLLMENT_CACHE:
+        _cache().delete(USER_CACHE_KEY % user_pk)
+
+
+def invalidate_all():
+    if conf.ENROLLMENT_CACHE:
+        _cache().set(VERSION_CACHE_KEY, uuid4().hex, None)
@@ -0,0 +1,180 @@
+"""
+Event log of participants and goals (participant_add, goal_hit, ...).
+
+emit() only appends the event to an in-memory ring buffer. A background thread ships the
+buffered events in batches to the sinks in EXPERIMENTS_EVENT_SINKS, which serialize them.
+When no sink is interested (e.g. the 'experiments' logger doesn't log INFO), emit() returns
+before doing any work. If the buffer fills up faster than the sinks keep up, the oldest events
+are dropped.
+"""
+from collections import deque
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from experiments import conf
+
+from redis.exceptions import ConnectionError, ResponseError
+
+logger = logging.getLogger('experiments')
+
+
+class LoggingSink(object):
+    """Logs every event as JSON to the 'experiments' logger, at INFO"""
+
+    def __init__(self, logger_name='experiments'):
+        self.logger = logging.getLogger(logger_name)
+
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.INFO)
+
+    def write(self, events):
+        for timestamp, data in events:
+            self.logger.info(json.dumps(data))
+
+
+class FileSink(object):
+    """Appends events to a file, one JSON object per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def enabled(self):
+        return True
+
+    def write(self, events):
+        with open(self.path, 'a') as output:
+            output.write(''.join(json.dumps(dict(data, timestamp=timestamp)) + '\n' for timestamp, data in events))
+
+
+class RedisStreamSink(object):
+    """Adds events to a redis stream (redis >= 5), trimmed to about `maxlen` entries"""
+
+    def __init__(self, key='experiments:events', maxlen=1000000):
+        self.key = key
+        self.maxlen = maxlen
+
+    def enabled(self):
+        return True
+
+    def write(self, events):
+        from experiments.counters import redis_client
+        try:
+            pipe = redis_client().pipeline(transaction=False)
+            for timestamp, data in events:
+                fields = []
+                for name, value in sorted(data.items()):
+                    fields.extend([name, value])
+                pipe.execute_command('XADD', self.key, 'MAXLEN', '~', self.maxlen, '*', 'timestamp', timestamp, *fields)
+            pipe.execute()
+        except (ConnectionError, ResponseError):
+            # Handle Redis failures gracefully
+            pass
+
+
+class EventPipeline(object):
+    def __init__(self, sinks, buffer_size, batch_size, flush_interval, background=True):
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.events = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def enabled(self):
+        return any(sink.enabled() for sink in self.sinks)
+
+    def emit(self, event_type, fields):
+        if not self.enabled():
+            return
+        fields['type'] = event_type
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((time.time(), fields))
+
+        if not self.background:
+            self.flush()
+            return
+        if self._pid != os.getpid():
+            # First event in this process, or we were forked and the thread stayed in the parent
+            self._start()
+        if len(self.events) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # The parent process ships the events it buffered before the fork
+                self.events.clear()
+                self._write_lock = threading.Lock()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='experiments-events')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all buffered events to the sinks"""
+        with self._write_lock:
+            while self.events:
+                batch = []
+                while self.events and len(batch) < self.batch_size:
+                    batch.append(self.events.popleft())
+                for sink in self.sinks:
+                    if sink.enabled():
+                        try:
+                            sink.write(batch)
+                        except Exception:
+                            logger.exception('Writing experiment events to %r failed', sink)
+
+
+def _create_sink(config):
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def pipeline():
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = EventPipeline(
+                    [_create_sink(config) for config in conf.EVENT_SINKS],
+                    buffer_size=conf.EVENT_BUFFER_SIZE,
+                    batch_size=conf.EVENT_BATCH_SIZE,
+                    flush_interval=conf.EVENT_FLUSH_INTERVAL,
+                    background=conf.EVENT_BACKGROUND,
+                )
+    return _pipeline
+
+
+def emit(event_type, **fields):
+    pipeline().emit(event_type, fields)
+
+
+def flush():
+    if _pipeline is not None:
+        _pipeline.flush()
+
+
+atexit.register(flush)
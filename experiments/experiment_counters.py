@@ -1,48 +1,382 @@
-from experiments import counters, conf
-import logging
-import json
+from django.utils.encoding import force_bytes
+
+from experiments import counters, conf, events
+from experiments.models import ExperimentArchive
+from collections import OrderedDict
+from contextlib import contextmanager
+import binascii
+import hashlib
+import threading
 
 PARTICIPANT_KEY = '%s:%s:participant'
 GOAL_KEY = '%s:%s:%s:goal'
 
-logger = logging.getLogger('experiments')
+# Participant identifiers as written before EXPERIMENTS_COMPACT_PARTICIPANT_IDS, see WebUser._participant_identifier
+LEGACY_PARTICIPANT_PATTERNS = ('user:*', 'session:*')
+
+_buffer_state = threading.local()
+
+
+class CounterBuffer(object):
+    """Increments waiting to be written. Increments of the same key and participant are summed."""
+    def __init__(self):
+        self.depth = 0
+        self.increments = OrderedDict()
+        self.unique = OrderedDict()
+        # Set along with the last write, see BaseCounters.increment_many
+        self.markers = []
+        self.raise_errors = False
+
+    def add(self, counter_key, participant_identifier, count, index):
+        item = (counter_key, participant_identifier, index)
+        self.increments[item] = self.increments.get(item, 0) + count
+
+    def add_unique(self, counter_key, participant_identifier, index):
+        self.unique[(counter_key, participant_identifier, index)] = True
+
+    def pop_all(self):
+        """Returns the pending increments and unique additions"""
+        increments = [(key, participant_identifier, count, index) for (key, participant_identifier, index), count in self.increments.items()]
+        unique = list(self.unique)
+        self.increments = OrderedDict()
+        self.unique = OrderedDict()
+        return increments, unique
+
+
+class ExperimentSnapshot(object):
+    """Read-only copy of the counters of one experiment, fetched in a single round trip"""
+    __slots__ = ('_participants', '_goals', '_distributions')
+
+    def __init__(self, participants, goals, distributions):
+        object.__setattr__(self, '_participants', participants)
+        object.__setattr__(self, '_goals', goals)
+        object.__setattr__(self, '_distributions', distributions)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ExperimentSnapshot is immutable")
+
+    def participant_count(self, alternative):
+        return self._participants.get(alternative, 0)
+
+    def goal_count(self, alternative, goal):
+        return self._goals.get((alternative, goal), 0)
+
+    def goal_distribution(self, alternative, goal):
+        # Callers (e.g. fixup_distribution) modify the histogram, so hand out a copy
+        return dict(self._distributions.get((alternative, goal), {}))
+
+    def combined(self, other):
+        """A snapshot with the counts of both snapshots added up"""
+        def add(a, b, add_values=lambda x, y: x + y):
+            result = dict(a)
+            for key, value in b.items():
+                result[key] = add_values(result[key], value) if key in result else value
+            return result
+
+        return ExperimentSnapshot(
+            participants=add(self._participants, other._participants),
+            goals=add(self._goals, other._goals),
+            distributions=add(self._distributions, other._distributions, add),
+        )
+
+    def to_dict(self):
+        """JSON serializable form of the snapshot, see from_dict"""
+        return {
+            'participants': self._participants,
+            'goals': [[alternative, goal, count] for (alternative, goal), count in self._goals.items()],
+            'distributions': [[alternative, goal, histogram] for (alternative, goal), histogram in self._distributions.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            participants=dict(data.get('participants', {})),
+            goals=dict(((alternative, goal), count) for alternative, goal, count in data.get('goals', [])),
+            # JSON turned the histograms' keys into strings
+            distributions=dict(((alternative, goal), dict((int(value), frequency) for value, frequency in histogram.items()))
+                               for alternative, goal, histogram in data.get('distributions', [])),
+        )
+
+
+def compact_participant_identifier(participant_identifier):
+    """Stable 8 byte hash of a participant identifier, see EXPERIMENTS_COMPACT_PARTICIPANT_IDS"""
+    return hashlib.sha1(force_bytes(participant_identifier)).digest()[:8]
+
+
+def _current_buffer():
+    return getattr(_buffer_state, 'buffer', None)
+
 
 class ExperimentCounter(object):
     def __init__(self):
-        self.counters = counters.Counters()
+        self.counters = counters.default_counters()
+
+    def begin_buffer(self, raise_errors=False):
+        """
+        Start holding back increments made on this thread until the matching end_buffer. With
+        `raise_errors` the buffer's writes raise when the counters can't be updated.
+        """
+        buffer = _current_buffer()
+        if buffer is None:
+            buffer = _buffer_state.buffer = CounterBuffer()
+        buffer.depth += 1
+        buffer.raise_errors = buffer.raise_errors or raise_errors
+
+    def end_buffer(self):
+        """Close a begin_buffer. Leaving the outermost one writes all pending increments in one batch"""
+        buffer = _current_buffer()
+        if buffer is None:
+            return
+        buffer.depth -= 1
+        if buffer.depth <= 0:
+            _buffer_state.buffer = None
+            self._write(buffer, buffer.markers)
+
+    def close_buffer(self):
+        """Write and drop this thread's buffer however deeply it is nested, e.g. one left open by an earlier request"""
+        buffer = _current_buffer()
+        if buffer is not None:
+            _buffer_state.buffer = None
+            self._write(buffer, buffer.markers)
+
+    @contextmanager
+    def buffer(self, markers=(), raise_errors=False):
+        """
+        Coalesce increments made inside the block and write them when it exits, e.g. in tasks or commands.
+        Unless the block raises, the (redis key, timeout) `markers` are set along with the increments.
+        """
+        self.begin_buffer(raise_errors)
+        try:
+            yield self
+            buffer = _current_buffer()
+            if buffer is not None:
+                buffer.markers.extend(markers)
+        finally:
+            self.end_buffer()
+
+    def flush(self):
+        """Write the increments buffered so far without closing the buffer"""
+        buffer = _current_buffer()
+        if buffer is not None:
+            self._write(buffer)
+
+    def _write(self, buffer, markers=()):
+        increments, unique = buffer.pop_all()
+        if increments or unique or markers:
+            self.counters.increment_many(increments, unique, markers=markers, raise_errors=buffer.raise_errors)
+
+    def counter_participant(self, participant_identifier):
+        """The participant's field name in the counters"""
+        if not conf.COMPACT_PARTICIPANT_IDS:
+            return participant_identifier
+        compact = compact_participant_identifier(participant_identifier)
+        if not self.counters.binary_participants:
+            return binascii.hexlify(compact).decode('ascii')
+        return compact
+
+    def _increment(self, experiment, counter_key, participant_identifier, count=1):
+        participant_identifier = self.counter_participant(participant_identifier)
+        # Every key is indexed under its experiment so delete() doesn't have to scan for them
+        buffer = _current_buffer()
+        if buffer is not None:
+            buffer.add(counter_key, participant_identifier, count, experiment.name)
+        else:
+            self.counters.increment(counter_key, participant_identifier, count, index=experiment.name)
+
+    def _add_unique(self, experiment, counter_key, participant_identifier):
+        participant_identifier = self.counter_participant(participant_identifier)
+        buffer = _current_buffer()
+        if buffer is not None:
+            buffer.add_unique(counter_key, participant_identifier, experiment.name)
+        else:
+            self.counters.add_unique(counter_key, participant_identifier, index=experiment.name)
 
     def increment_participant_count(self, experiment, alternative_name, participant_identifier):
         counter_key = PARTICIPANT_KEY % (experiment.name, alternative_name)
-        self.counters.increment(counter_key, participant_identifier)
-        logger.info(json.dumps({'type':'participant_add', 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
+        self._increment(experiment, counter_key, participant_identifier)
+        events.emit('participant_add', experiment=experiment.name, alternative=alternative_name, participant=participant_identifier)
 
     def increment_goal_count(self, experiment, alternative_name, goal_name, participant_identifier, count=1):
         counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
-        self.counters.increment(counter_key, participant_identifier, count)
-        logger.info(json.dumps({'type':'goal_hit', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
+        if goal_name in conf.HLL_GOALS:
+            if count > 0:
+                self._add_unique(experiment, counter_key, participant_identifier)
+        else:
+            self._increment(experiment, counter_key, participant_identifier, count)
+        events.emit('goal_hit', goal=goal_name, goal_count=count, experiment=experiment.name, alternative=alternative_name, participant=participant_identifier)
 
     def remove_participant(self, experiment, alternative_name, participant_identifier):
+        # Pending increments have to land before they can be removed
+        self.flush()
+
+        counter_participant = self.counter_participant(participant_identifier)
         counter_key = PARTICIPANT_KEY % (experiment.name, alternative_name)
-        self.counters.clear(counter_key, participant_identifier)
-        logger.info(json.dumps({'type':'participant_remove', 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
+        self.counters.clear(counter_key, counter_participant)
+        events.emit('participant_remove', experiment=experiment.name, alternative=alternative_name, participant=participant_identifier)
 
-        # Remove goal records
+        # Remove goal records. Participants can't be taken out of HLL_GOALS' unique counters.
         for goal_name in conf.ALL_GOALS:
             counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
-            self.counters.clear(counter_key, participant_identifier)
+            self.counters.clear(counter_key, counter_participant)
 
     def participant_count(self, experiment, alternative):
+        self.flush()
         return self.counters.get(PARTICIPANT_KEY % (experiment.name, alternative))
 
     def goal_count(self, experiment, alternative, goal):
+        self.flush()
+        if goal in conf.HLL_GOALS:
+            return self.counters.get_unique(GOAL_KEY % (experiment.name, alternative, goal))
         return self.counters.get(GOAL_KEY % (experiment.name, alternative, goal))
 
+    def goal_count_error(self, goal):
+        """Relative standard error of the goal's counts, 0 for exact counts"""
+        return self.counters.unique_error if goal in conf.HLL_GOALS else 0
+
     def participant_goal_frequencies(self, experiment, alternative, participant_identifier):
+        self.flush()
+        counter_participant = self.counter_participant(participant_identifier)
         for goal in conf.ALL_GOALS:
-            yield goal, self.counters.get_frequency(GOAL_KEY % (experiment.name, alternative, goal), participant_identifier)
+            # Per participant counts aren't kept for HLL_GOALS
+            if goal not in conf.HLL_GOALS:
+                yield goal, self.counters.get_frequency(GOAL_KEY % (experiment.name, alternative, goal), counter_participant)
 
     def goal_distribution(self, experiment, alternative, goal):
+        self.flush()
+        if goal in conf.HLL_GOALS:
+            return {}
         return self.counters.get_frequencies(GOAL_KEY % (experiment.name, alternative, goal))
 
+    def experiment_snapshot(self, experiment, goals=conf.ALL_GOALS, distribution_goals=()):
+        """
+        Fetch the participant and goal counts for every alternative of the experiment, plus the
+        goal distributions of `distribution_goals`, in one pipelined call.
+        Counts of an archived experiment are read from its archive (plus anything counted since).
+        """
+        snapshot = self._live_snapshot(experiment, goals, distribution_goals)
+        archive = ExperimentArchive.objects.filter(experiment_id=experiment.name).first()
+        if archive is not None:
+            snapshot = ExperimentSnapshot.from_dict(archive.snapshot).combined(snapshot)
+        return snapshot
+
+    def _live_snapshot(self, experiment, goals, distribution_goals):
+        self.flush()
+        alternatives = set(experiment.alternatives.keys()) | set([conf.CONTROL_GROUP])
+
+        participant_keys = dict((PARTICIPANT_KEY % (experiment.name, alternative), alternative) for alternative in alternatives)
+        goal_keys = dict((GOAL_KEY % (experiment.name, alternative, goal), (alternative, goal)) for alternative in alternatives for goal in goals)
+        distribution_keys = dict((GOAL_KEY % (experiment.name, alternative, goal), (alternative, goal)) for alternative in alternatives for goal in distribution_goals if goal not in conf.HLL_GOALS)
+        unique_keys = [key for key, (alternative, goal) in goal_keys.items() if goal in conf.HLL_GOALS]
+        exact_keys = [key for key, (alternative, goal) in goal_keys.items() if goal not in conf.HLL_GOALS]
+
+        counts, frequencies = self.counters.get_multi(list(participant_keys) + exact_keys, distribution_keys, unique_keys)
+
+        return ExperimentSnapshot(
+            participants=dict((alternative, counts.get(key, 0)) for key, alternative in participant_keys.items()),
+            goals=dict((item, counts.get(key, 0)) for key, item in goal_keys.items()),
+            distributions=dict((item, frequencies.get(key, {})) for key, item in distribution_keys.items()),
+        )
+
+    def export_participants(self, experiment, goals=conf.ALL_GOALS, batch_size=counters.SCAN_BATCH_SIZE):
+        """
+        Stream the experiment's participants with their goal counts, as (alternative, participant,
+        [count of each goal]) tuples. Participants are read batch_size at a time (HSCAN with redis)
+        and their goal counts fetched per batch, so memory use doesn't grow with the experiment.
+        HLL_GOALS have no per participant counts and are skipped.
+
+        With redis a participant may appear more than once, when a counter is resized during the
+        scan (see Counters.scan_participants); keeping the last row per participant is enough.
+        """
+        self.flush()
+        goals = [goal for goal in goals if goal not in conf.HLL_GOALS]
+        for alternative in sorted(set(experiment.alternatives.keys()) | set([conf.CONTROL_GROUP])):
+            goal_keys = [GOAL_KEY % (experiment.name, alternative, goal) for goal in goals]
+            batch = []
+            for participant_identifier, _ in self.counters.scan_participants(PARTICIPANT_KEY % (experiment.name, alternative)):
+                batch.append(participant_identifier)
+                if len(batch) >= batch_size:
+                    for row in self._export_batch(alternative, goal_keys, batch):
+                        yield row
+                    batch = []
+            for row in self._export_batch(alternative, goal_keys, batch):
+                yield row
+
+    def _export_batch(self, alternative, goal_keys, participant_identifiers):
+        if not participant_identifiers:
+            return
+        counts = self.counters.get_participant_counts(goal_keys, participant_identifiers)
+        for i, participant_identifier in enumerate(participant_identifiers):
+            yield alternative, self._exported_participant(participant_identifier), [counts[key][i] for key in goal_keys]
+
+    def _exported_participant(self, participant_identifier):
+        participant_identifier = force_bytes(participant_identifier)
+        # Compact identifiers are binary, anything else was written as text
+        if conf.COMPACT_PARTICIPANT_IDS and self.counters.binary_participants and not participant_identifier.startswith((b'user:', b'session:')):
+            return binascii.hexlify(participant_identifier).decode('ascii')
+        return participant_identifier.decode('utf-8')
+
+    def compact_participants(self, experiment, batch_size=counters.SCAN_BATCH_SIZE):
+        """
+        Rename the experiment's participants in the counters to their compact identifiers, merging
+        them with the counts written since EXPERIMENTS_COMPACT_PARTICIPANT_IDS was enabled.
+        Only the redis backends support this. Returns the number of participant fields renamed.
+        """
+        self.flush()
+        alternatives = set(experiment.alternatives.keys()) | set([conf.CONTROL_GROUP])
+        keys = [PARTICIPANT_KEY % (experiment.name, alternative) for alternative in alternatives]
+        keys += [GOAL_KEY % (experiment.name, alternative, goal) for alternative in alternatives for goal in conf.ALL_GOALS if goal not in conf.HLL_GOALS]
+
+        renamed = 0
+        for key in keys:
+            for pattern in LEGACY_PARTICIPANT_PATTERNS:
+                batch = []
+                for participant_identifier, count in self.counters.scan_participants(key, match=pattern):
+                    batch.append((participant_identifier, compact_participant_identifier(participant_identifier)))
+                    if len(batch) >= batch_size:
+                        renamed += self.counters.rename_participants(key, batch)
+                        batch = []
+                renamed += self.counters.rename_participants(key, batch)
+        return renamed
+
+    def counter_version(self, experiment):
+        """Changes whenever the experiment's counters are reset, invalidating anything derived from them"""
+        return self.counters.get_version(experiment.name)
+
+    def archive(self, experiment):
+        """
+        Store the experiment's counts, including every goal distribution, in an ExperimentArchive
+        and remove its counters from the counter store. Per participant counts are lost.
+        Goals no longer in EXPERIMENTS_GOALS are archived too, as long as their counters are indexed.
+        """
+        goals = list(conf.ALL_GOALS) + sorted(self._indexed_goals(experiment) - set(conf.ALL_GOALS))
+        snapshot = self.experiment_snapshot(experiment, goals, distribution_goals=goals)
+        ExperimentArchive.objects.update_or_create(experiment_id=experiment.name, defaults={'snapshot': snapshot.to_dict()})
+        self._delete_counters(experiment)
+        return snapshot
+
+    def _indexed_goals(self, experiment):
+        self.flush()
+        alternatives = set(experiment.alternatives.keys()) | set([conf.CONTROL_GROUP])
+        # Longest first, in case one alternative's name starts with another's (see GOAL_KEY)
+        prefixes = sorted(('%s:%s:' % (experiment.name, alternative) for alternative in alternatives), key=len, reverse=True)
+        goals = set()
+        for key in self.counters.index_keys(experiment.name):
+            if key.endswith(':goal'):
+                for prefix in prefixes:
+                    if key.startswith(prefix):
+                        goals.add(key[len(prefix):-len(':goal')])
+                        break
+        return goals
+
     def delete(self, experiment):
-        self.counters.reset_pattern(experiment.name + "*")
+        ExperimentArchive.objects.filter(experiment_id=experiment.name).delete()
+        self._delete_counters(experiment)
+
+    def _delete_counters(self, experiment):
+        self.flush()
+        # Keys from before the index existed are covered by listing the ones we know of
+        alternatives = set(experiment.alternatives.keys()) | set([conf.CONTROL_GROUP])
+        known_keys = [PARTICIPANT_KEY % (experiment.name, alternative) for alternative in alternatives]
+        known_keys += [GOAL_KEY % (experiment.name, alternative, goal) for alternative in alternatives for goal in conf.ALL_GOALS]
+        self.counters.reset_index(experiment.name, known_keys)
+        self.counters.bump_version(experiment.name)
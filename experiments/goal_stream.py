@@ -0,0 +1,159 @@
+"""
+Asynchronous goal ingestion through a redis stream (redis >= 5).
+
+With EXPERIMENTS_ASYNC_GOALS enabled, WebUser.goal() doesn't update the counters itself: it
+adds a single entry to the EXPERIMENTS_GOAL_STREAM stream holding the participant, the goal,
+its count and the (experiment, alternative) pairs the participant is enrolled in. The
+process_goal_stream management command reads the stream through a consumer group and applies
+the entries to the counters in batches.
+
+Entries are delivered at least once. An applied entry is recorded under an idempotency key, in
+the same transaction as its counter updates, before it is acknowledged. So one that is delivered
+again (e.g. because the worker died before XACK) isn't counted twice. With ShardedCounters the
+keys can only be written after the updates, and a worker dying in between counts them twice.
+Entries whose counters couldn't be updated are left pending, and claimed again later.
+"""
+import json
+import os
+import socket
+
+from experiments.counters import redis_client
+from experiments.experiment_counters import ExperimentCounter
+from experiments.manager import experiment_manager
+from experiments import conf
+
+from redis.exceptions import ConnectionError, ResponseError
+
+CONSUMER_GROUP = 'experiments'
+APPLIED_KEY = 'experiments:goals:applied:%s'
+
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis_client()
+    return _redis
+
+
+def enqueue_goal(participant_identifier, goal_name, count, enrollments):
+    """Add a goal for the (experiment name, alternative) enrollments to the stream. Returns False if redis is unavailable"""
+    try:
+        _client().execute_command('XADD', conf.GOAL_STREAM, '*',
+                                  'p', participant_identifier,
+                                  'g', goal_name,
+                                  'c', count,
+                                  'e', json.dumps(enrollments, separators=(',', ':')))
+        return True
+    except (ConnectionError, ResponseError):
+        return False
+
+
+def default_consumer_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def create_group():
+    try:
+        _client().execute_command('XGROUP', 'CREATE', conf.GOAL_STREAM, CONSUMER_GROUP, '0', 'MKSTREAM')
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def consume(consumer, batch_size=500, block=None, claim_idle=60000):
+    """Apply one batch of entries and return the number of entries read
+
+    The consumer's own pending entries (left over from a previous run under the same name) come
+    first, then entries other consumers have left pending for over `claim_idle` milliseconds,
+    then new entries, waiting up to `block` milliseconds for them when it's given."""
+    client = _client()
+    entries = _read_group(client, consumer, '0', batch_size)
+    if not entries and claim_idle is not None:
+        entries = _claim_stale(client, consumer, claim_idle, batch_size)
+    if not entries:
+        entries = _read_group(client, consumer, '>', batch_size, block)
+    if entries:
+        # Raises when the counters can't be updated, leaving the entries pending
+        apply_entries(entries)
+        _acknowledge(client, [entry_id for entry_id, fields in entries])
+    return len(entries)
+
+
+def apply_entries(entries):
+    """
+    Add the goals of the (entry id, fields) entries that weren't applied before to the counters. Returns
+    the number applied. Raises when the counters can't be updated, in which case no entry is marked as applied.
+    """
+    client = _client()
+    applied = client.pipeline(transaction=False)
+    for entry_id, fields in entries:
+        applied.exists(APPLIED_KEY % entry_id)
+    entries = [(entry_id, fields) for (entry_id, fields), seen in zip(entries, applied.execute())
+               if fields is not None and not seen]
+    if not entries:
+        return 0
+
+    experiment_counter = ExperimentCounter()
+    markers = [(APPLIED_KEY % entry_id, conf.GOAL_STREAM_APPLIED_TIMEOUT) for entry_id, fields in entries]
+    with experiment_counter.buffer(markers=markers, raise_errors=True):
+        for entry_id, fields in entries:
+            participant_identifier = fields['p']
+            goal_name = fields['g']
+            count = int(fields['c'])
+            for experiment_name, alternative in json.loads(fields['e']):
+                # Experiments deleted since the goal was queued are skipped rather than auto created again
+                if experiment_name in experiment_manager:
+                    experiment = experiment_manager[experiment_name]
+                    experiment_counter.increment_goal_count(experiment, alternative, goal_name, participant_identifier, count)
+    return len(entries)
+
+
+def _acknowledge(client, ids):
+    # Acknowledged entries are removed, so the stream only holds the backlog
+    pipe = client.pipeline(transaction=False)
+    pipe.execute_command('XACK', conf.GOAL_STREAM, CONSUMER_GROUP, *ids)
+    pipe.execute_command('XDEL', conf.GOAL_STREAM, *ids)
+    pipe.execute()
+
+
+def _read_group(client, consumer, last_id, count, block=None):
+    args = ['XREADGROUP', 'GROUP', CONSUMER_GROUP, consumer, 'COUNT', count]
+    if block is not None:
+        args.extend(['BLOCK', block])
+    args.extend(['STREAMS', conf.GOAL_STREAM, last_id])
+    response = client.execute_command(*args)
+    if not response:
+        return []
+    stream, entries = response[0]
+    return _entries(entries)
+
+
+def _claim_stale(client, consumer, min_idle, count):
+    # XAUTOCLAIM would do this in one call but needs redis 6.2
+    pending = client.execute_command('XPENDING', conf.GOAL_STREAM, CONSUMER_GROUP, '-', '+', count)
+    ids = [entry[0] for entry in pending or [] if entry[2] >= min_idle]
+    if not ids:
+        return []
+    return _entries(client.execute_command('XCLAIM', conf.GOAL_STREAM, CONSUMER_GROUP, consumer, min_idle, *ids))
+
+
+def _entries(raw_entries):
+    entries = []
+    for raw_entry in raw_entries:
+        if raw_entry is None:
+            continue
+        entry_id, raw_fields = raw_entry
+        if not raw_fields:
+            # Pending entries that were deleted in the meantime come back without fields, they only need an XACK
+            entries.append((_text(entry_id), None))
+            continue
+        if not isinstance(raw_fields, dict):
+            raw_fields = dict(zip(raw_fields[::2], raw_fields[1::2]))
+        entries.append((_text(entry_id), dict((_text(name), _text(value)) for name, value in raw_fields.items())))
+    return entries
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
@@ -0,0 +1,116 @@
+"""
+Buffer for authenticated users' last_seen times.
+
+With EXPERIMENTS_LAST_SEEN_BUFFER enabled, retention tracking writes last_seen to a redis
+hash per user instead of the enrollment table. AuthenticatedUser reads the buffered values
+back on top of the database rows, and flush() (run periodically through the
+flush_last_seen management command) copies them to the database in bulk.
+"""
+from collections import defaultdict
+
+from django.db import DatabaseError
+
+from experiments.counters import redis_client
+from experiments.dateutils import timestamp_from_datetime, datetime_from_timestamp, fix_awareness
+from experiments.models import Enrollment
+from experiments import enrollment_cache
+
+from redis.exceptions import ConnectionError, ResponseError
+
+USER_LAST_SEEN_KEY = 'experiments:last_seen:%s'
+DIRTY_USERS_KEY = 'experiments:last_seen:users'
+
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis_client()
+    return _redis
+
+
+def buffer_last_seen(user_pk, experiment_names, last_seen):
+    """Record last_seen for the user's enrollments in the given experiments. Returns False if redis is unavailable"""
+    timestamp = timestamp_from_datetime(last_seen)
+    try:
+        pipe = _client().pipeline()
+        pipe.hmset(USER_LAST_SEEN_KEY % user_pk, dict((name, timestamp) for name in experiment_names))
+        pipe.sadd(DIRTY_USERS_KEY, user_pk)
+        pipe.execute()
+        return True
+    except (ConnectionError, ResponseError):
+        return False
+
+
+def buffered_last_seen(user_pk):
+    """The last_seen times buffered for the user but not yet flushed, by experiment name"""
+    try:
+        values = _client().hgetall(USER_LAST_SEEN_KEY % user_pk)
+    except (ConnectionError, ResponseError):
+        return {}
+    return dict((_text(name), fix_awareness(datetime_from_timestamp(int(timestamp)))) for name, timestamp in values.items())
+
+
+def flush(batch_size=1000):
+    """Copy buffered last_seen times to the enrollment table. Returns the number of users flushed"""
+    flushed = 0
+    try:
+        while True:
+            try:
+                client = _client()
+                # SPOP with a count needs redis 3.2
+                user_pks = client.execute_command('SPOP', DIRTY_USERS_KEY, batch_size) or []
+                if not user_pks:
+                    break
+                # Read and clear each hash atomically so concurrent visits are kept for the next flush
+                pipe = client.pipeline()
+                for user_pk in user_pks:
+                    pipe.hgetall(USER_LAST_SEEN_KEY % _text(user_pk))
+                    pipe.delete(USER_LAST_SEEN_KEY % _text(user_pk))
+                results = pipe.execute()[::2]
+            except (ConnectionError, ResponseError):
+                break
+
+            try:
+                _update_enrollments(user_pks, results)
+            except DatabaseError:
+                _restore(user_pks, results)
+                raise
+            flushed += len(user_pks)
+
+            if len(user_pks) < batch_size:
+                break
+    finally:
+        if flushed:
+            # The enrollment table was updated without model signals
+            enrollment_cache.invalidate_all()
+    return flushed
+
+
+def _update_enrollments(user_pks, results):
+    # One UPDATE per experiment and timestamp; timestamps share values thanks to LAST_SEEN_GRANULARITY
+    updates = defaultdict(list)
+    for user_pk, values in zip(user_pks, results):
+        for name, timestamp in values.items():
+            updates[(_text(name), int(timestamp))].append(_text(user_pk))
+    for (experiment_name, timestamp), users in updates.items():
+        last_seen = fix_awareness(datetime_from_timestamp(timestamp))
+        Enrollment.objects.filter(experiment_id=experiment_name, user_id__in=users).update(last_seen=last_seen)
+
+
+def _restore(user_pks, results):
+    """Buffer values that couldn't be written again, without overwriting those of visits since"""
+    try:
+        pipe = _client().pipeline()
+        for user_pk, values in zip(user_pks, results):
+            for name, timestamp in values.items():
+                pipe.hsetnx(USER_LAST_SEEN_KEY % _text(user_pk), name, timestamp)
+            pipe.sadd(DIRTY_USERS_KEY, user_pk)
+        pipe.execute()
+    except (ConnectionError, ResponseError):
+        pass
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
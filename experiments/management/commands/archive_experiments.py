@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from experiments.dateutils import now
+from experiments.experiment_counters import ExperimentCounter
+from experiments.models import Experiment, CONTROL_STATE
+from experiments import conf
+
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = 'Move the counters of experiments that ended more than EXPERIMENTS_ARCHIVE_AFTER_DAYS ago to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiments', nargs='*', help='Names of ended experiments to archive right away')
+        parser.add_argument('--after-days', type=int, default=conf.ARCHIVE_AFTER_DAYS,
+                            help='Archive experiments that ended this many days ago (default: %d)' % conf.ARCHIVE_AFTER_DAYS)
+
+    def handle(self, *args, **options):
+        experiments = Experiment.objects.filter(state=CONTROL_STATE, archive__isnull=True)
+        if options['experiments']:
+            experiments = experiments.filter(name__in=options['experiments'])
+        else:
+            experiments = experiments.filter(end_date__lte=now() - timedelta(days=options['after_days']))
+
+        experiment_counter = ExperimentCounter()
+        for experiment in experiments:
+            experiment_counter.archive(experiment)
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Archived %s' % experiment.name)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.experiment_counters import ExperimentCounter
+from experiments.models import Experiment
+
+
+class Command(BaseCommand):
+    help = 'Convert the participants in the redis counters to the identifiers used with EXPERIMENTS_COMPACT_PARTICIPANT_IDS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiments', nargs='*', help='Names of the experiments to convert (default: all)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of participants to rename per redis call')
+
+    def handle(self, *args, **options):
+        experiment_counter = ExperimentCounter()
+        if not hasattr(experiment_counter.counters, 'rename_participants'):
+            raise CommandError('The counter backend in use does not support renaming participants')
+
+        experiments = Experiment.objects.all()
+        if options['experiments']:
+            experiments = experiments.filter(name__in=options['experiments'])
+
+        for experiment in experiments:
+            renamed = experiment_counter.compact_participants(experiment, batch_size=options['batch_size'])
+            if int(options['verbosity']) > 0:
+                self.stdout.write('%s: renamed %d participant fields' % (experiment.name, renamed))
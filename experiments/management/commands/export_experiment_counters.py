@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.experiment_counters import ExperimentCounter
+from experiments.models import Experiment
+from experiments import conf
+
+from collections import OrderedDict
+import csv
+import json
+
+
+class Command(BaseCommand):
+    help = ("Write an experiment's participants and their goal counts as CSV or JSON lines, one participant per row. "
+            "With redis a participant can occasionally be written twice; keep its last row.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiment', help='Name of the experiment to export')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+        parser.add_argument('--output', help='File to write to (default: standard output)')
+        parser.add_argument('--goals', help='Comma separated goals to include (default: all goals)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of participants to read per batch')
+
+    def handle(self, *args, **options):
+        try:
+            experiment = Experiment.objects.get(name=options['experiment'])
+        except Experiment.DoesNotExist:
+            raise CommandError('Experiment %s does not exist' % options['experiment'])
+
+        goals = options['goals'].split(',') if options['goals'] else conf.ALL_GOALS
+        goals = [goal for goal in goals if goal not in conf.HLL_GOALS]
+        rows = ExperimentCounter().export_participants(experiment, goals, batch_size=options['batch_size'])
+
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(output, lineterminator='\n')
+                writer.writerow(['alternative', 'participant'] + list(goals))
+                for alternative, participant_identifier, counts in rows:
+                    writer.writerow([alternative, participant_identifier] + counts)
+            else:
+                for alternative, participant_identifier, counts in rows:
+                    row = OrderedDict([('alternative', alternative), ('participant', participant_identifier)])
+                    row.update(zip(goals, counts))
+                    output.write(json.dumps(row) + '\n')
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from experiments import last_seen
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Store the last_seen times buffered in redis (EXPERIMENTS_LAST_SEEN_BUFFER) in the enrollment table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of users to flush per batch')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep flushing, waiting this many seconds between rounds')
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = last_seen.flush(batch_size=options['batch_size'])
+            if int(options['verbosity']) > 1:
+                self.stdout.write('Flushed last_seen for %d users' % flushed)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
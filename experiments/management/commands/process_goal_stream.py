@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from experiments import goal_stream
+
+
+class Command(BaseCommand):
+    help = 'Count the goals added to the goal stream (EXPERIMENTS_ASYNC_GOALS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default=None,
+                            help='Name of this worker in the consumer group, defaults to <hostname>-<pid>. '
+                                 'A restarted worker under the same name picks up its unacknowledged entries first.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of stream entries to apply per batch')
+        parser.add_argument('--claim-idle', type=int, default=60, metavar='SECONDS',
+                            help="Take over other workers' entries left unacknowledged for this long")
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep consuming, waiting up to this many seconds for new entries at a time')
+
+    def handle(self, *args, **options):
+        consumer = options['consumer'] or goal_stream.default_consumer_name()
+        block = options['loop'] * 1000 if options['loop'] else None
+        goal_stream.create_group()
+        while True:
+            processed = goal_stream.consume(consumer, batch_size=options['batch_size'], block=block,
+                                            claim_idle=options['claim_idle'] * 1000)
+            if processed and int(options['verbosity']) > 1:
+                self.stdout.write('Processed %d goal stream entries' % processed)
+            if not processed and not options['loop']:
+                break
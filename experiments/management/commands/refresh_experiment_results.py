@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from experiments.admin_utils import refresh_result_context
+from experiments.models import Experiment, CONTROL_STATE
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cached admin results of all running experiments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiments', nargs='*', help='Names of the experiments to refresh (defaults to all running experiments)')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep refreshing, waiting this many seconds between rounds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.refresh(options['experiments'], int(options['verbosity']))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def refresh(self, names, verbosity):
+        if names:
+            experiments = Experiment.objects.filter(name__in=names)
+        else:
+            experiments = Experiment.objects.exclude(state=CONTROL_STATE)
+
+        for experiment in experiments:
+            refresh_result_context(experiment)
+            if verbosity > 1:
+                self.stdout.write('Refreshed results for %s' % experiment.name)
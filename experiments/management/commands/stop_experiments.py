@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from experiments.models import Experiment, ENABLED_STATE
+from experiments import sequential
+
+import time
+
+
+class Command(BaseCommand):
+    help = ('Stop running experiments whose relevant chi2 goals are significant according to '
+            'their always-valid sequential p-values (EXPERIMENTS_SEQUENTIAL_ALPHA)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiments', nargs='*', help='Names of the experiments to check (defaults to all enabled experiments)')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep checking, waiting this many seconds between rounds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.check(options['experiments'], int(options['verbosity']))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def check(self, names, verbosity):
+        experiments = Experiment.objects.filter(state=ENABLED_STATE)
+        if names:
+            experiments = experiments.filter(name__in=names)
+
+        for experiment in experiments:
+            stopped = sequential.check_experiment(experiment)
+            if stopped:
+                goal, alternative, p_value = stopped
+                if verbosity > 0:
+                    self.stdout.write('Stopped %s: %s differs from control on %s (p = %.2g)' % (experiment.name, alternative, goal, p_value))
+            elif verbosity > 1:
+                self.stdout.write('%s keeps running' % experiment.name)
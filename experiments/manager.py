@@ -1,6 +1,38 @@
 from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_save, post_delete
 from experiments.models import Experiment
-from modeldict import ModelDict
+from experiments import conf
+
+from uuid import uuid4
+import threading
+import logging
+import time
+
+logger = logging.getLogger('experiments')
+
+# Cache backends whose contents other processes can't see
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def check_registry_cache(app_configs=None, **kwargs):
+    """System check: the registry's version key has to live in a cache shared by all processes"""
+    backend = settings.CACHES.get(conf.REGISTRY_CACHE, {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [checks.Warning(
+        "EXPERIMENTS_REGISTRY_CACHE ('%s') uses %s, which isn't shared between processes. Other processes won't "
+        "notice changes to experiments%s." % (conf.REGISTRY_CACHE, backend.rsplit('.', 1)[1],
+                                               ' until their next poll, reloading them every time' if backend.endswith('DummyCache') else ''),
+        hint='Point EXPERIMENTS_REGISTRY_CACHE at a shared cache (e.g. memcached or redis), unless a single process serves the site.',
+        id='experiments.W001',
+    )]
 
 
 class LazyAutoCreate(object):
@@ -11,7 +43,90 @@ class LazyAutoCreate(object):
         return getattr(settings, 'EXPERIMENTS_AUTO_CREATE', True)
 
 
-class ExperimentManager(ModelDict):
+class PendingAlternatives(object):
+    """
+    Alternatives found while rendering that still have to be stored.
+
+    Each alternative is queued once per process until the registry is reloaded. flush() stores
+    everything queued for an experiment with a single update, and runs once the response has
+    been sent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._pending = {}
+
+    def add(self, experiment_name, alternative, weight=None):
+        seen_key = (experiment_name, alternative, weight is not None)
+        if seen_key in self._seen:
+            return
+        with self._lock:
+            self._seen.add(seen_key)
+            alternatives = self._pending.setdefault(experiment_name, {})
+            if alternatives.get(alternative) is None:
+                alternatives[alternative] = weight
+
+    def pop_all(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def forget(self, experiment_name, alternatives):
+        """Let alternatives that couldn't be stored be queued again"""
+        with self._lock:
+            for alternative, weight in alternatives.items():
+                self._seen.discard((experiment_name, alternative, weight is not None))
+
+    def forget_all(self):
+        with self._lock:
+            self._seen = set()
+
+
+class ExperimentManager(object):
+    """
+    In-process registry of all experiments, keyed by name.
+
+    Lookups are plain dict reads: the registry is an immutable dict that is rebuilt from the
+    database and swapped in whenever it changes. Once saving or deleting an experiment is committed,
+    the registry is rebuilt in the current process and a version key is bumped in the cache, which other
+    processes check at most once every REGISTRY_POLL_INTERVAL seconds.
+    """
+    version_cache_key = 'experiments:registry:version'
+
+    def __init__(self, model, auto_create=False):
+        self.model = model
+        self.auto_create = auto_create
+
+        self._experiments = None
+        self._version = None
+        self._last_checked = 0
+        self._reload_lock = threading.Lock()
+        self._pending_alternatives = PendingAlternatives()
+        self._after_request = threading.local()
+
+        # Metrics
+        self.refresh_count = 0
+        self.last_refreshed = None
+
+        post_save.connect(self._post_change, sender=model)
+        post_delete.connect(self._post_change, sender=model)
+        request_finished.connect(self._request_finished)
+
+    def __getitem__(self, experiment_name):
+        try:
+            return self._get_experiments()[experiment_name]
+        except KeyError:
+            if not self.auto_create:
+                raise
+        experiment, created = self.model.objects.get_or_create(name=experiment_name)
+        if not created:
+            # Created by another process since our last refresh
+            self._add(experiment)
+        return experiment
+
+    def __contains__(self, experiment_name):
+        return experiment_name in self._get_experiments()
+
     def get_experiment(self, experiment_name):
         # Helper that uses self[...] so that the experiment is auto created where desired
         try:
@@ -19,5 +134,132 @@ class ExperimentManager(ModelDict):
         except KeyError:
             return None
 
+    def all(self):
+        return list(self._get_experiments().values())
+
+    def ensure_alternative_exists(self, experiment, alternative, weight=None):
+        """
+        Make the alternative available on the experiment straight away and queue it to be stored.
+        Rendering never writes to the experiment table; see store_pending_alternatives.
+        """
+        if experiment.ensure_alternative_exists(alternative, weight):
+            self._pending_alternatives.add(experiment.name, alternative, weight)
+
+    def store_pending_alternatives(self):
+        """
+        Store the alternatives queued by ensure_alternative_exists, with one update per experiment.
+        Runs after every request; call it yourself when rendering outside of requests.
+        """
+        changed = False
+        for experiment_name, alternatives in self._pending_alternatives.pop_all().items():
+            try:
+                changed = self._store_alternatives(experiment_name, alternatives) or changed
+            except DatabaseError:
+                logger.exception('Could not store the alternatives of experiment %s', experiment_name)
+                self._pending_alternatives.forget(experiment_name, alternatives)
+        if changed:
+            self.invalidate()
+
+    def _store_alternatives(self, experiment_name, alternatives):
+        with transaction.atomic():
+            try:
+                experiment = self.model.objects.select_for_update().get(name=experiment_name)
+            except self.model.DoesNotExist:
+                return False
+            changed = False
+            for alternative, weight in alternatives.items():
+                changed = experiment.ensure_alternative_exists(alternative, weight) or changed
+            if changed:
+                # update() rather than save(): no waffle flags or dates are touched
+                self.model.objects.filter(name=experiment_name).update(alternatives=experiment.alternatives)
+        return changed
+
+    def stats(self):
+        """Registry metrics: how often it was rebuilt and how long since it was last known to be current"""
+        return {
+            'experiments': len(self._experiments or {}),
+            'refresh_count': self.refresh_count,
+            'last_refreshed': self.last_refreshed,
+            'staleness': self.staleness(),
+            'version': self._version,
+        }
+
+    def staleness(self):
+        """Seconds since the registry was last confirmed to be up to date"""
+        if not self._last_checked:
+            return None
+        return time.time() - self._last_checked
+
+    def refresh(self):
+        """Rebuild the registry from the database, whatever the shared version says"""
+        self._reload(self._remote_version())
+
+    def _get_experiments(self):
+        experiments = self._experiments
+        if experiments is None and self._last_checked == 0:
+            # System checks don't run under most WSGI servers
+            for warning in check_registry_cache():
+                logger.warning(warning.msg)
+        if experiments is None or time.time() - self._last_checked >= conf.REGISTRY_POLL_INTERVAL:
+            remote_version = self._remote_version()
+            # Backends without shared storage (e.g. DummyCache) never report a version, so reload on every poll
+            if experiments is None or remote_version is None or remote_version != self._version:
+                self._reload(remote_version)
+            else:
+                self._last_checked = time.time()
+            experiments = self._experiments
+        return experiments
+
+    def _reload(self, version):
+        if not self._reload_lock.acquire(False):
+            # Another thread is already rebuilding it, carry on with the current registry if there is one
+            if self._experiments is not None:
+                return
+            self._reload_lock.acquire()
+        try:
+            checked = time.time()
+            self._experiments = dict((experiment.name, experiment) for experiment in self.model.objects.all())
+            # The new experiments may lack alternatives queued before, e.g. ones removed in the admin
+            self._pending_alternatives.forget_all()
+            self._version = version
+            self._last_checked = checked
+            self.refresh_count += 1
+            self.last_refreshed = checked
+            logger.debug('Experiment registry refreshed (%d experiments, version %s)', len(self._experiments), version)
+        finally:
+            self._reload_lock.release()
+
+    def _add(self, experiment):
+        experiments = dict(self._get_experiments())
+        experiments[experiment.name] = experiment
+        self._experiments = experiments
+
+    def _remote_version(self):
+        return caches[conf.REGISTRY_CACHE].get(self.version_cache_key)
+
+    def invalidate(self):
+        """Rebuild the registry here and tell other processes to rebuild theirs"""
+        version = uuid4().hex
+        caches[conf.REGISTRY_CACHE].set(self.version_cache_key, version, None)
+        self._reload(version)
+
+    def _post_change(self, sender, instance, using=None, **kwargs):
+        # Other processes may only see the new version once the change is committed. Otherwise they
+        # could reload the old rows and keep them as the new version until the next change.
+        if hasattr(transaction, 'on_commit'):
+            transaction.on_commit(self.invalidate, using=using)
+        else:
+            # Django < 1.9 has no commit hooks: invalidate now, and again once the request (and
+            # with it the admin's transaction) is over
+            self.invalidate()
+            if transaction.get_connection(using).in_atomic_block:
+                self._after_request.invalidate = True
+
+    def _request_finished(self, **kwargs):
+        if getattr(self._after_request, 'invalidate', False):
+            self._after_request.invalidate = False
+            self.invalidate()
+        self.store_pending_alternatives()
+
 
-experiment_manager = ExperimentManager(Experiment, key='name', value='value', instances=True, auto_create=LazyAutoCreate())
+experiment_manager = ExperimentManager(Experiment, auto_create=LazyAutoCreate())
@@ -1,3 +1,4 @@
+from experiments.experiment_counters import ExperimentCounter
 from experiments.utils import participant
 
 
@@ -12,3 +13,24 @@ class ExperimentsRetentionMiddleware(object):
         experiment_user.visit()
 
         return response
+
+
+class ExperimentsCounterBufferMiddleware(object):
+    """
+    Holds back counter increments made while handling a request and writes them to the
+    counter store in one batch once the response is ready. Place it above
+    ExperimentsRetentionMiddleware so retention goals are part of the same batch.
+    """
+    def process_request(self, request):
+        experiment_counter = ExperimentCounter()
+        # A request whose process_response was skipped (e.g. a middleware below raised) leaves
+        # its buffer open on this thread. Write it out rather than nesting every later request in it.
+        experiment_counter.close_buffer()
+        request._experiments_counter_buffer = True
+        experiment_counter.begin_buffer()
+
+    def process_response(self, request, response):
+        if getattr(request, '_experiments_counter_buffer', False):
+            del request._experiments_counter_buffer
+            ExperimentCounter().end_buffer()
+        return response
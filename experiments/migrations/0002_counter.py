@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=255)),
+                ('participant', models.CharField(max_length=255)),
+                ('count', models.IntegerField(default=0)),
+                ('index_name', models.CharField(max_length=255, null=True, db_index=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='counter',
+            unique_together=set([('key', 'participant')]),
+        ),
+    ]
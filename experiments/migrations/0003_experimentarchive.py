@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0002_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExperimentArchive',
+            fields=[
+                ('experiment', models.OneToOneField(related_name='archive', primary_key=True, serialize=False, to='experiments.Experiment')),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('snapshot', jsonfield.fields.JSONField(default={})),
+            ],
+        ),
+    ]
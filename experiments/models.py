@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connections, router, transaction
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 from django.utils.safestring import mark_safe
@@ -8,6 +8,8 @@ from jsonfield import JSONField
 import waffle
 from waffle.models import Flag
 
+import sqlite3
+from collections import OrderedDict
 import random
 import json
 
@@ -91,13 +93,22 @@ class Experiment(models.Model):
         return None
 
     def ensure_alternative_exists(self, alternative, weight=None):
-        if alternative not in self.alternatives:
-            self.alternatives[alternative] = {}
-            self.alternatives[alternative]['enabled'] = True
-            self.save()
-        if weight is not None and 'weight' not in self.alternatives[alternative]:
-            self.alternatives[alternative]['weight'] = float(weight)
-            self.save()
+        """
+        Add the alternative (and its weight) to this instance if it is missing. Returns True if
+        anything changed. Nothing is saved: see ExperimentManager.ensure_alternative_exists.
+        """
+        alternative_conf = self.alternatives.get(alternative)
+        if alternative_conf is not None and (weight is None or 'weight' in alternative_conf):
+            return False
+
+        # Experiments are shared between threads, so build new dicts instead of modifying them
+        alternative_conf = dict(alternative_conf or {'enabled': True})
+        if weight is not None and 'weight' not in alternative_conf:
+            alternative_conf['weight'] = float(weight)
+        alternatives = dict(self.alternatives)
+        alternatives[alternative] = alternative_conf
+        self.alternatives = alternatives
+        return True
 
     @property
     def default_alternative(self):
@@ -215,8 +226,106 @@ class Experiment(models.Model):
         super(Experiment, self).delete(*args, **kwargs)
 
 
+# Databases with a native single statement upsert
+UPSERT_VENDORS = ('postgresql', 'sqlite', 'mysql')
+
+
+def supports_upsert(connection):
+    if connection.vendor not in UPSERT_VENDORS:
+        return False
+    # ON CONFLICT ... DO UPDATE arrived in SQLite 3.24
+    return connection.vendor != 'sqlite' or sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+class EnrollmentManager(models.Manager):
+    def upsert(self, user, experiment, alternative, enrollment_date=None, last_seen=None):
+        """
+        Enroll the user in the alternative with a single statement, replacing any existing
+        alternative. enrollment_date and last_seen are only overwritten when given.
+        """
+        self.bulk_upsert([(user.pk, experiment.name, alternative, enrollment_date, last_seen)])
+
+    def bulk_upsert(self, rows, update=True, batch_size=1000):
+        """
+        Write (user_id, experiment_name, alternative, enrollment_date, last_seen) rows in batches.
+
+        Existing enrollments are updated as in upsert(), or left untouched when update is False.
+        Model signals are not sent.
+        """
+        connection = connections[router.db_for_write(self.model)]
+        if not supports_upsert(connection):
+            return self._bulk_upsert_fallback(rows, update)
+
+        # Rows with and without an explicit enrollment_date need different conflict clauses
+        with_date = [row for row in rows if row[3] is not None]
+        without_date = [row for row in rows if row[3] is None]
+
+        fields = [self.model._meta.get_field(name) for name in ('user', 'experiment', 'alternative', 'enrollment_date', 'last_seen')]
+        batch_size = min(batch_size, connection.ops.bulk_batch_size(fields, rows) or batch_size)
+        with transaction.atomic(using=connection.alias, savepoint=False):
+            for group, update_date in ((with_date, True), (without_date, False)):
+                for start in range(0, len(group), batch_size):
+                    self._execute_upsert(connection, fields, group[start:start + batch_size], update, update_date)
+
+    def _execute_upsert(self, connection, fields, rows, update, update_date):
+        if not rows:
+            return
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        user_column, experiment_column, alternative_column, date_column, last_seen_column = [qn(field.column) for field in fields]
+        insert_date = now()
+
+        params = []
+        for user_id, experiment_name, alternative, enrollment_date, last_seen in rows:
+            params.extend([
+                user_id,
+                experiment_name,
+                alternative,
+                fields[3].get_db_prep_value(enrollment_date or insert_date, connection),
+                fields[4].get_db_prep_value(last_seen, connection),
+            ])
+
+        sql = 'INSERT INTO %s (%s, %s, %s, %s, %s) VALUES %s' % (
+            table, user_column, experiment_column, alternative_column, date_column, last_seen_column,
+            ', '.join(['(%s, %s, %s, %s, %s)'] * len(rows)))
+
+        if connection.vendor == 'mysql':
+            if update:
+                assignments = ['%s = VALUES(%s)' % (alternative_column, alternative_column),
+                               '%s = COALESCE(VALUES(%s), %s)' % (last_seen_column, last_seen_column, last_seen_column)]
+                if update_date:
+                    assignments.append('%s = VALUES(%s)' % (date_column, date_column))
+                sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(assignments)
+            else:
+                sql = 'INSERT IGNORE' + sql[len('INSERT'):]
+        else:
+            if update:
+                assignments = ['%s = excluded.%s' % (alternative_column, alternative_column),
+                               '%s = COALESCE(excluded.%s, %s.%s)' % (last_seen_column, last_seen_column, table, last_seen_column)]
+                if update_date:
+                    assignments.append('%s = excluded.%s' % (date_column, date_column))
+                sql += ' ON CONFLICT (%s, %s) DO UPDATE SET %s' % (user_column, experiment_column, ', '.join(assignments))
+            else:
+                sql += ' ON CONFLICT (%s, %s) DO NOTHING' % (user_column, experiment_column)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _bulk_upsert_fallback(self, rows, update):
+        for user_id, experiment_name, alternative, enrollment_date, last_seen in rows:
+            defaults = {'alternative': alternative, 'last_seen': last_seen, 'enrollment_date': enrollment_date}
+            with transaction.atomic():
+                enrollment, created = self.get_or_create(user_id=user_id, experiment_id=experiment_name, defaults=defaults)
+                # enrollment_date is auto_now_add, so a given date has to be set after creation
+                if update or (created and enrollment_date):
+                    changes = dict((name, value) for name, value in defaults.items() if value is not None)
+                    self.filter(pk=enrollment.pk).update(**changes)
+
+
 class Enrollment(models.Model):
     """ A participant in a split testing experiment """
+    objects = EnrollmentManager()
+
     user = models.ForeignKey(getattr(settings, 'AUTH_USER_MODEL', 'auth.User'))
     experiment = models.ForeignKey(Experiment)
     enrollment_date = models.DateTimeField(auto_now_add=True)
@@ -230,6 +339,90 @@ class Enrollment(models.Model):
         return u'%s - %s' % (self.user, self.experiment)
 
 
+class ExperimentArchive(models.Model):
+    """ Frozen counts of an ended experiment whose counters were removed from the counter store """
+    experiment = models.OneToOneField(Experiment, primary_key=True, related_name='archive')
+    archived_at = models.DateTimeField(auto_now_add=True)
+    snapshot = JSONField(default={})
+
+    def __unicode__(self):
+        return u'%s (archived %s)' % (self.experiment_id, self.archived_at)
+
+
+class CounterManager(models.Manager):
+
+    def bulk_increment(self, increments, batch_size=1000):
+        """
+        Add (key, participant, count, index_name) increments to the counters, creating missing
+        rows. Increments of the same participant's counter are summed first.
+        """
+        totals = OrderedDict()
+        for key, participant, count, index_name in increments:
+            total, previous_index = totals.get((key, participant), (0, None))
+            totals[(key, participant)] = (total + count, index_name or previous_index)
+        rows = [(key, participant, count, index_name) for (key, participant), (count, index_name) in totals.items() if count != 0]
+
+        connection = connections[router.db_for_write(self.model)]
+        if not supports_upsert(connection):
+            return self._bulk_increment_fallback(rows)
+
+        fields = [self.model._meta.get_field(name) for name in ('key', 'participant', 'count', 'index_name')]
+        batch_size = min(batch_size, connection.ops.bulk_batch_size(fields, rows) or batch_size)
+        with transaction.atomic(using=connection.alias, savepoint=False):
+            for start in range(0, len(rows), batch_size):
+                self._execute_increment(connection, fields, rows[start:start + batch_size])
+
+    def _execute_increment(self, connection, fields, rows):
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        key_column, participant_column, count_column, index_column = [qn(field.column) for field in fields]
+
+        params = []
+        for row in rows:
+            params.extend(row)
+
+        sql = 'INSERT INTO %s (%s, %s, %s, %s) VALUES %s' % (
+            table, key_column, participant_column, count_column, index_column,
+            ', '.join(['(%s, %s, %s, %s)'] * len(rows)))
+
+        if connection.vendor == 'mysql':
+            sql += ' ON DUPLICATE KEY UPDATE %s = %s + VALUES(%s), %s = COALESCE(VALUES(%s), %s)' % (
+                count_column, count_column, count_column, index_column, index_column, index_column)
+        else:
+            sql += ' ON CONFLICT (%s, %s) DO UPDATE SET %s = %s.%s + excluded.%s, %s = COALESCE(excluded.%s, %s.%s)' % (
+                key_column, participant_column, count_column, table, count_column, count_column,
+                index_column, index_column, table, index_column)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _bulk_increment_fallback(self, rows):
+        for key, participant, count, index_name in rows:
+            with transaction.atomic():
+                counter, created = self.get_or_create(key=key, participant=participant, defaults={'count': count, 'index_name': index_name})
+                if not created:
+                    changes = {'count': models.F('count') + count}
+                    if index_name is not None:
+                        changes['index_name'] = index_name
+                    self.filter(pk=counter.pk).update(**changes)
+
+
+class Counter(models.Model):
+    """ A participant's count in a counter of counters.DatabaseCounters """
+    objects = CounterManager()
+
+    key = models.CharField(max_length=255)
+    participant = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+    index_name = models.CharField(max_length=255, null=True, db_index=True)
+
+    class Meta:
+        unique_together = ('key', 'participant')
+
+    def __unicode__(self):
+        return u'%s - %s: %s' % (self.key, self.participant, self.count)
+
+
 def weighted_choice(choices):
     total = sum(w for c, w in choices)
     r = random.uniform(0, total)
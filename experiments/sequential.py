@@ -0,0 +1,92 @@
+"""
+Sequential testing with always-valid p-values.
+
+The results page's chi-square confidence is only valid for a sample size fixed in advance, not
+when it's checked over and over while the experiment runs. Here every comparison of an
+alternative with control gets an mSPRT p-value (see significance.msprt_p_value) and the running
+minimum of those p-values is kept in the counter backend (BaseCounters.update_minimums), one
+entry per experiment, updated for all of its comparisons in one call.
+
+The p-values are computed from the participant and conversion counts of a snapshot, not kept up
+to date from each increment: the mSPRT statistic of a comparison only depends on those four
+counts, so a snapshot gives the same value in O(1) per comparison, without adding work to every
+increment. The running minimum is what makes checking at arbitrary times valid, and it only
+advances when the p-values are looked at (by the results page or the stop_experiments command).
+
+The stop_experiments command uses them to end experiments as soon as a relevant goal shows a
+significant difference.
+"""
+from experiments.counters import default_counters
+from experiments.experiment_counters import ExperimentCounter
+from experiments.models import CONTROL_STATE
+from experiments.significance import msprt_p_value
+from experiments.signals import experiment_stopped
+from experiments import conf, events
+
+SEQUENTIAL_STATE_KEY = 'sequential:%s'
+
+
+def always_valid_p_values(experiment, counter_version, comparisons, counters=None):
+    """
+    The always-valid p-value of each (goal, alternative name, alternative participants,
+    alternative conversions, control participants, control conversions) comparison of the
+    experiment, after updating its running minimum in `counters` (by default the
+    EXPERIMENTS_COUNTER_BACKEND). Returns {(goal, alternative name): p_value},
+    where p_value is None while a side has fewer than SEQUENTIAL_MIN_PARTICIPANTS.
+    """
+    p_values = {}
+    for goal, alternative_name, a_count, a_conversion, b_count, b_conversion in comparisons:
+        if min(a_count, b_count) >= conf.SEQUENTIAL_MIN_PARTICIPANTS:
+            p_value = msprt_p_value(a_count, a_conversion, b_count, b_conversion, conf.SEQUENTIAL_MIXTURE_SD)
+        else:
+            p_value = None
+        p_values[(goal, alternative_name)] = p_value
+
+    updates = dict(('%s:%s' % key, p_value) for key, p_value in p_values.items() if p_value is not None)
+    if updates:
+        counters = counters or default_counters()
+        minimums = counters.update_minimums(SEQUENTIAL_STATE_KEY % experiment.name, counter_version, updates, conf.SEQUENTIAL_STATE_TIMEOUT)
+        for key in p_values:
+            if p_values[key] is not None:
+                p_values[key] = minimums['%s:%s' % key]
+    return p_values
+
+
+def stop_goals(experiment):
+    """The goals that can end the experiment early, its relevant_chi2_goals"""
+    goals = (experiment.relevant_chi2_goals or '').replace(' ', '').split(',')
+    return [goal for goal in goals if goal in conf.ALL_GOALS]
+
+
+def check_experiment(experiment, experiment_counter=None):
+    """
+    Update the experiment's always-valid p-values of its stop_goals() from the current counts
+    (without computing the rest of the results) and stop it, leaving everyone on control, once
+    one of them is below SEQUENTIAL_ALPHA. Alpha is split among all the comparisons (Bonferroni)
+    as any of them can stop the experiment. Returns the (goal, alternative, p_value) that stopped it, or None.
+    """
+    experiment_counter = experiment_counter or ExperimentCounter()
+    goals = stop_goals(experiment)
+    alternatives = [alternative for alternative in experiment.alternatives.keys() if alternative != conf.CONTROL_GROUP]
+    if not goals or not alternatives:
+        return None
+
+    snapshot = experiment_counter.experiment_snapshot(experiment, goals)
+    comparisons = [(goal, alternative,
+                    snapshot.participant_count(alternative), snapshot.goal_count(alternative, goal),
+                    snapshot.participant_count(conf.CONTROL_GROUP), snapshot.goal_count(conf.CONTROL_GROUP, goal))
+                   for goal in goals for alternative in alternatives]
+    p_values = always_valid_p_values(experiment, experiment_counter.counter_version(experiment), comparisons, experiment_counter.counters)
+
+    alpha = conf.SEQUENTIAL_ALPHA / len(comparisons)
+    significant = sorted((p_value, goal, alternative) for (goal, alternative), p_value in p_values.items()
+                         if p_value is not None and p_value < alpha)
+    if not significant:
+        return None
+
+    p_value, goal, alternative = significant[0]
+    experiment.state = CONTROL_STATE
+    experiment.save()
+    experiment_stopped.send(sender=experiment.__class__, experiment=experiment, goal=goal, alternative=alternative, p_value=p_value)
+    events.emit('experiment_stopped', experiment=experiment.name, goal=goal, alternative=alternative, p_value=p_value)
+    return goal, alternative, p_value
@@ -1,4 +1,5 @@
 from experiments.utils import participant, clear_participant_cache
+from experiments import enrollment_cache
 
 
 def transfer_enrollments_to_user(sender, request, user, **kwargs):
@@ -10,4 +11,12 @@ def transfer_enrollments_to_user(sender, request, user, **kwargs):
 
 
 def handle_user_logged_out(sender, request, user, **kwargs):
-    clear_participant_cache(request)
\ No newline at end of file
+    clear_participant_cache(request)
+
+
+def handle_enrollment_changed(sender, instance, **kwargs):
+    enrollment_cache.invalidate_user(instance.user_id)
+
+
+def handle_experiment_deleted(sender, instance, **kwargs):
+    enrollment_cache.invalidate_all()
@@ -1,3 +1,4 @@
 from django.dispatch import Signal
 
 user_enrolled = Signal(providing_args=['experiment', 'alternative', 'user', 'session'])
+experiment_stopped = Signal(providing_args=['experiment', 'goal', 'alternative', 'p_value'])
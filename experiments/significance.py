@@ -1,10 +1,17 @@
-from experiments.stats import zprob, chisqprob
+from experiments.stats import zprob, chisqprob, zprob_array, chisqprob_array
+
+from math import exp, log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MINIMUM_VALUES = 20
 
 
 def mann_whitney(a_distribution, b_distribution, use_continuity=True):
     """Returns (u, p_value)"""
-    MINIMUM_VALUES = 20
-
     all_values = sorted(set(a_distribution.keys() + b_distribution.keys()))
 
     count_so_far = 0
@@ -58,6 +65,44 @@ def mann_whitney(a_distribution, b_distribution, use_continuity=True):
     return small_u, 1 - zprob(z_score)
 
 
+def kruskal_wallis(distributions):
+    """
+    Kruskal-Wallis H test of k samples given as frequency histograms (value -> frequency), the
+    k sample version of mann_whitney(). All rank sums are computed in a single pass over the values.
+
+    Returns (h, p_value). The p_value is None unless every sample has MINIMUM_VALUES values, or
+    when all values are tied.
+    """
+    distributions = list(distributions)
+    all_values = sorted(set(v for distribution in distributions for v in distribution))
+
+    count_so_far = 0
+    counts = [0] * len(distributions)
+    rank_sums = [0.0] * len(distributions)
+    tie_adjustment = 0
+
+    for v in all_values:
+        for_value = [distribution.get(v, 0) for distribution in distributions]
+        total_for_value = sum(for_value)
+        average_rank = count_so_far + (1 + total_for_value) / 2.0
+        for i, frequency in enumerate(for_value):
+            rank_sums[i] += average_rank * frequency
+            counts[i] += frequency
+        count_so_far += total_for_value
+        tie_adjustment += total_for_value ** 3 - total_for_value
+
+    if len(distributions) < 2 or min(counts) < MINIMUM_VALUES:
+        return 0, None
+
+    total_count = float(count_so_far)
+    tie_correction = 1 - tie_adjustment / (total_count ** 3 - total_count)
+    if tie_correction <= 0:
+        return 0, None
+    h = (12 / (total_count * (total_count + 1)) * sum(rank_sum ** 2 / count for rank_sum, count in zip(rank_sums, counts)) -
+         3 * (total_count + 1)) / tie_correction
+    return h, chisqprob(h, len(distributions) - 1)
+
+
 def chi_square_p_value(matrix):
     """
     Accepts a matrix (an array of arrays, where each child array represents a row)
@@ -97,6 +142,24 @@ def chi_square_p_value(matrix):
         if len(row) != num_columns:
             return None
 
+    return _chi_square(matrix, num_rows, num_columns)
+
+
+def chi_square_contingency(matrix):
+    """
+    Chi-square test of independence of any r x c matrix (an array of rows), e.g. one row of
+    [non conversions, conversions] per alternative to test all of them at once.
+
+    Returns (statistic, p_value), or (None, None) when a row or column is empty.
+    """
+    num_rows = len(matrix)
+    num_columns = len(matrix[0]) if num_rows else 0
+    if num_rows < 2 or num_columns < 2 or any(len(row) != num_columns for row in matrix):
+        return None, None
+    return _chi_square(matrix, num_rows, num_columns)
+
+
+def _chi_square(matrix, num_rows, num_columns):
     row_sums = []
     # for each row
     for row in matrix:
@@ -135,3 +198,117 @@ def chi_square_p_value(matrix):
     p_value = chisqprob(observed_test_statistic, degrees_freedom)
 
     return observed_test_statistic, p_value
+
+
+def mann_whitney_many(distribution_pairs, use_continuity=True):
+    """
+    mann_whitney() of each (a_distribution, b_distribution) pair, e.g. of every alternative
+    against control for all goals of an experiment. Returns a list of (u, p_value).
+
+    With numpy the histograms are stacked on a shared axis of values and all pairs are ranked
+    at once; without it this falls back to calling mann_whitney() for each pair.
+    """
+    distribution_pairs = list(distribution_pairs)
+    if numpy is None or not distribution_pairs:
+        return [mann_whitney(a, b, use_continuity) for a, b in distribution_pairs]
+
+    all_values = sorted(set(v for pair in distribution_pairs for distribution in pair for v in distribution))
+    column = dict((v, i) for i, v in enumerate(all_values))
+    a_frequencies = numpy.zeros((len(distribution_pairs), len(all_values)))
+    b_frequencies = numpy.zeros_like(a_frequencies)
+    for row, (a_distribution, b_distribution) in enumerate(distribution_pairs):
+        for frequencies, distribution in ((a_frequencies, a_distribution), (b_frequencies, b_distribution)):
+            if distribution:
+                frequencies[row, [column[v] for v in distribution]] = list(distribution.values())
+
+    totals = a_frequencies + b_frequencies
+    average_ranks = numpy.cumsum(totals, axis=1) - totals + (1 + totals) / 2.0
+    a_rank_sum = (average_ranks * a_frequencies).sum(axis=1)
+    b_rank_sum = (average_ranks * b_frequencies).sum(axis=1)
+    a_count = a_frequencies.sum(axis=1)
+    b_count = b_frequencies.sum(axis=1)
+    variance_adjustment = (totals ** 3 - totals).sum(axis=1)
+
+    a_u = a_rank_sum - a_count * (a_count + 1) / 2.0
+    b_u = b_rank_sum - b_count * (b_count + 1) / 2.0
+    small_u = numpy.minimum(a_u, b_u)
+    big_u = numpy.maximum(a_u, b_u)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        total_count = a_count + b_count
+        u_distribution_mean = a_count * b_count / 2.0
+        u_distribution_sd = (
+            (a_count * b_count / (total_count * (total_count - 1))) ** 0.5 *
+            ((total_count ** 3 - total_count - variance_adjustment) / 12.0) ** 0.5)
+        if use_continuity:
+            z_score = numpy.abs((big_u - 0.5 - u_distribution_mean) / u_distribution_sd)
+        else:
+            z_score = numpy.abs((big_u - u_distribution_mean) / u_distribution_sd)
+        p_value = 1 - zprob_array(z_score)
+
+    results = []
+    for i in range(len(distribution_pairs)):
+        if a_count[i] < MINIMUM_VALUES or b_count[i] < MINIMUM_VALUES:
+            results.append((0, None))
+        elif u_distribution_sd[i] == 0:
+            results.append((float(small_u[i]), None))
+        else:
+            results.append((float(small_u[i]), float(p_value[i])))
+    return results
+
+
+def chi_square_p_values(matrices):
+    """
+    chi_square_p_value() of each matrix, e.g. the contingency tables of every alternative
+    against control for all goals of an experiment. Returns a list of (statistic, p_value).
+
+    With numpy, matrices of the same square shape are tested in one batch; anything else
+    falls back to calling chi_square_p_value() for each matrix.
+    """
+    matrices = list(matrices)
+    if numpy is None or not matrices:
+        return [chi_square_p_value(matrix) for matrix in matrices]
+    try:
+        observed = numpy.array(matrices, dtype=float)
+    except (TypeError, ValueError):
+        return [chi_square_p_value(matrix) for matrix in matrices]
+    if observed.ndim != 3 or observed.shape[1] != observed.shape[2] or observed.shape[1] == 0:
+        return [chi_square_p_value(matrix) for matrix in matrices]
+
+    num_rows, num_columns = observed.shape[1:]
+    row_sums = observed.sum(axis=2)
+    column_sums = observed.sum(axis=1)
+    grand_total = row_sums.sum(axis=1)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        grand_totals = grand_total[:, None, None]
+        expected = (row_sums[:, :, None] / grand_totals) * (column_sums[:, None, :] / grand_totals) * grand_totals
+        statistics = (((observed - expected) ** 2) / expected).sum(axis=(1, 2))
+    valid = (grand_total > 0) & (expected > 0).all(axis=(1, 2))
+    statistics = numpy.where(valid, statistics, 0.0)
+    p_values = chisqprob_array(statistics, (num_columns - 1) * (num_rows - 1))
+
+    return [(float(statistic), float(p_value)) if is_valid else (None, None)
+            for statistic, p_value, is_valid in zip(statistics, p_values, valid)]
+
+
+def msprt_p_value(a_count, a_conversion, b_count, b_conversion, mixture_sd):
+    """
+    p-value of the mixture sequential probability ratio test (Johari et al., "Always Valid
+    Inference") that the conversion rates of a and b are equal, using the normal approximation
+    and a normal mixing distribution with standard deviation `mixture_sd` on the difference.
+
+    The running minimum of this p-value over time stays valid however often the results are
+    looked at and whenever the experiment is stopped. Returns None while the variance is 0.
+    """
+    if not a_count or not b_count:
+        return None
+    a_rate = min(a_conversion, a_count) / float(a_count)
+    b_rate = min(b_conversion, b_count) / float(b_count)
+    variance = a_rate * (1 - a_rate) / a_count + b_rate * (1 - b_rate) / b_count
+    if variance <= 0:
+        return None
+    mixture_variance = mixture_sd ** 2
+    log_likelihood_ratio = (0.5 * log(variance / (variance + mixture_variance)) +
+                            mixture_variance * (b_rate - a_rate) ** 2 / (2 * variance * (variance + mixture_variance)))
+    return exp(-log_likelihood_ratio) if log_likelihood_ratio > 0 else 1.0
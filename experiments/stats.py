@@ -1,5 +1,10 @@
 from math import fabs, exp, sqrt, log, pi
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def zprob(z):
     """
@@ -105,3 +110,65 @@ def chisqprob(chisq, df):
             return (c * y + s)
     else:
         return s
+
+
+def zprob_array(z):
+    """zprob() of every value of a numpy array, with the same approximation"""
+    Z_MAX = 6.0
+    z = numpy.asarray(z, dtype=float)
+    y = 0.5 * numpy.fabs(z)
+    w = y * y
+    small = ((((((((0.000124818987 * w
+                    - 0.001075204047) * w + 0.005198775019) * w
+                  - 0.019198292004) * w + 0.059054035642) * w
+                - 0.151968751364) * w + 0.319152932694) * w
+              - 0.531923007300) * w + 0.797884560593) * y * 2.0
+    u = y - 2.0
+    large = (((((((((((((-0.000045255659 * u
+                         + 0.000152529290) * u - 0.000019538132) * u
+                       - 0.000676904986) * u + 0.001390604284) * u
+                     - 0.000794620820) * u - 0.002034254874) * u
+                   + 0.006549791214) * u - 0.010557625006) * u
+                 + 0.011630447319) * u - 0.009279453341) * u
+               + 0.005353579108) * u - 0.002141268741) * u
+             + 0.000535310849) * u + 0.999936657524
+    x = numpy.where(y >= Z_MAX * 0.5, 1.0, numpy.where(y < 1.0, small, large))
+    x = numpy.where(z == 0.0, 0.0, x)
+    return numpy.where(z > 0.0, (x + 1.0) * 0.5, (1.0 - x) * 0.5)
+
+
+def chisqprob_array(chisq, df):
+    """chisqprob() of every value of a numpy array, for the same df"""
+    BIG = 20.0
+    chisq = numpy.asarray(chisq, dtype=float)
+    if df < 1:
+        return numpy.ones_like(chisq)
+
+    def ex(x):
+        return numpy.where(x < -BIG, 0.0, numpy.exp(numpy.maximum(x, -BIG)))
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        a = 0.5 * chisq
+        even = df % 2 == 0
+        y = ex(-a)
+        if even:
+            s = y
+        else:
+            s = 2.0 * zprob_array(-numpy.sqrt(numpy.maximum(chisq, 0.0)))
+        if df > 2:
+            last = 0.5 * (df - 1.0)
+            # The two ways of summing the series, the first for large values of a
+            e_big = numpy.zeros_like(a) if even else numpy.full_like(a, log(sqrt(pi)))
+            e_small = numpy.ones_like(a) if even else 1.0 / sqrt(pi) / numpy.sqrt(a)
+            s_big = s
+            c_small = numpy.zeros_like(a)
+            c = numpy.log(a)
+            z = 1.0 if even else 0.5
+            while z <= last:
+                e_big = log(z) + e_big
+                s_big = s_big + ex(c * z - a - e_big)
+                e_small = e_small * (a / float(z))
+                c_small = c_small + e_small
+                z = z + 1.0
+            s = numpy.where(a > BIG, s_big, c_small * y + s)
+        return numpy.where(chisq <= 0, 1.0, s)
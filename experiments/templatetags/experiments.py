@@ -34,7 +34,7 @@ class ExperimentNode(template.Node):
     def render(self, context):
         experiment = experiment_manager.get_experiment(self.experiment_name)
         if experiment:
-            experiment.ensure_alternative_exists(self.alternative, self.weight)
+            experiment_manager.ensure_alternative_exists(experiment, self.alternative, self.weight)
 
         # Get User object
         if self.user_variable:
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+
+from django.core.cache import caches
+from django.test.utils import override_settings
+from django.utils.unittest import TestCase
+from mock import patch
+
+from experiments import bayesian, conf
+from experiments.bayesian import analyse, beta_probability_to_beat, gamma_probability_to_beat, ACTIONS, CONVERSION
+
+COMPARISONS = [
+    (CONVERSION, 5000, 600, 5000, 500),
+    (CONVERSION, 5000, 450, 5000, 500),
+    (CONVERSION, 5000, 500, 5000, 500),
+    (ACTIONS, 5000, 1800, 5000, 1500),
+]
+
+
+class ClosedFormTestCase(TestCase):
+    def test_symmetric(self):
+        self.assertAlmostEqual(beta_probability_to_beat(11, 91, 11, 91), 0.5)
+        self.assertAlmostEqual(gamma_probability_to_beat(31, 101, 31, 101), 0.5)
+
+    def test_complementary(self):
+        self.assertAlmostEqual(beta_probability_to_beat(11, 91, 21, 81) + beta_probability_to_beat(21, 81, 11, 91), 1)
+        self.assertAlmostEqual(gamma_probability_to_beat(31, 101, 41, 101) + gamma_probability_to_beat(41, 101, 31, 101), 1)
+
+    def test_known_value(self):
+        # Uniform against density 2x: integral of x * 2x over [0, 1] = 2/3
+        self.assertAlmostEqual(beta_probability_to_beat(1, 1, 2, 1), 2 / 3.0)
+
+
+class AnalyseTestCase(TestCase):
+    def setUp(self):
+        caches[conf.RESULTS_CACHE].clear()
+
+    def tearDown(self):
+        caches[conf.RESULTS_CACHE].clear()
+
+    def test_closed_form_and_sampling_agree(self):
+        with patch.object(bayesian, 'CLOSED_FORM_MAX_TERMS', 0):
+            sampled = bayesian._analyse(COMPARISONS, 20000, 1)
+        exact = bayesian._analyse(COMPARISONS, 20000, 1)
+        for (sampled_probability, sampled_loss), (probability, loss) in zip(sampled, exact):
+            self.assertAlmostEqual(sampled_probability, probability, delta=0.02)
+            self.assertEqual(sampled_loss, loss)
+
+    def test_results(self):
+        (better, better_loss), (worse, worse_loss), (same, same_loss), (more_actions, actions_loss) = analyse(COMPARISONS, seed=1)
+        self.assertGreater(better, 0.99)
+        self.assertLess(worse, 0.05)
+        self.assertAlmostEqual(same, 0.5, delta=0.01)
+        self.assertGreater(more_actions, 0.99)
+        self.assertLess(better_loss, worse_loss)
+        self.assertGreater(worse_loss, 0.005)
+        self.assertGreater(same_loss, 0)
+        self.assertLess(actions_loss, 0.001)
+
+    def test_without_numpy(self):
+        with patch.object(bayesian, 'numpy', None):
+            results = bayesian._analyse(COMPARISONS, 2000, 1)
+        for (probability, loss), (expected_probability, expected_loss) in zip(results, bayesian._analyse(COMPARISONS, 20000, 1)):
+            self.assertAlmostEqual(probability, expected_probability, delta=0.05)
+            self.assertAlmostEqual(loss, expected_loss, delta=0.005)
+
+    def test_seeded(self):
+        with patch.object(bayesian, 'CLOSED_FORM_MAX_TERMS', 0):
+            self.assertEqual(bayesian._analyse(COMPARISONS, 1000, 7), bayesian._analyse(COMPARISONS, 1000, 7))
+            self.assertNotEqual(bayesian._analyse(COMPARISONS, 1000, 7), bayesian._analyse(COMPARISONS, 1000, 8))
+
+    def test_deterministic_without_seed(self):
+        with patch.object(bayesian, 'CLOSED_FORM_MAX_TERMS', 0):
+            self.assertEqual(analyse(COMPARISONS, draws=1000), analyse(COMPARISONS, draws=1000))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_memoized_by_counts(self):
+        with patch.object(bayesian, '_analyse', wraps=bayesian._analyse) as _analyse:
+            results = analyse(COMPARISONS, draws=1000)
+            self.assertEqual(analyse(COMPARISONS, draws=1000), results)
+            self.assertEqual(_analyse.call_count, 1)
+            analyse(COMPARISONS[:1], draws=1000)
+            self.assertEqual(_analyse.call_count, 2)
+        self.assertEqual(analyse([]), [])
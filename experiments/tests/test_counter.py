@@ -1,12 +1,28 @@
 from __future__ import absolute_import
 
+from datetime import timedelta
+import json
+
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase as DjangoTestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
 from django.utils.unittest import TestCase
+from mock import patch
 
-from experiments import counters
+from experiments import counters, conf
+from experiments.experiment_counters import ExperimentCounter, GOAL_KEY
+from experiments.middleware import ExperimentsCounterBufferMiddleware
+from experiments.models import Experiment, ExperimentArchive, CONTROL_STATE, supports_upsert
+from experiments.dateutils import now
+from experiments.tests.utils import requires_redis
 
 TEST_KEY = 'CounterTestCase'
 
 
+@requires_redis
 class CounterTestCase(TestCase):
     def setUp(self):
         self.counters = counters.Counters()
@@ -58,3 +74,486 @@ class CounterTestCase(TestCase):
 
         self.assertEqual(self.counters.get(TEST_KEY), 1)
         self.assertEqual(self.counters.get_frequencies(TEST_KEY), {2: 1})
+
+    def test_increment_by_count(self):
+        self.counters.increment(TEST_KEY, 'fred', 3)
+        self.counters.increment(TEST_KEY, 'fred', 2)
+        self.counters.increment(TEST_KEY, 'barney', 5)
+        self.assertEqual(self.counters.get_frequency(TEST_KEY, 'fred'), 5)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {5: 2})
+
+    def test_histogram_drops_empty_buckets(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'fred')
+        freq_cache_key = counters.COUNTER_FREQ_CACHE_KEY % TEST_KEY
+        self.assertEqual(self.counters._redis.hgetall(freq_cache_key), {b'2': b'1'})
+
+    def test_clear_missing_value(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.clear(TEST_KEY, 'barney')
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1})
+
+    def test_reset_pattern(self):
+        self.counters.increment(TEST_KEY + ':a', 'fred')
+        self.counters.increment(TEST_KEY + ':b', 'fred')
+        self.counters.reset_pattern(TEST_KEY + ':*')
+        self.assertEqual(self.counters.get(TEST_KEY + ':a'), 0)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY + ':b'), {})
+
+    def test_increment_many_markers(self):
+        marker = 'experiments:marker:%s' % TEST_KEY
+        self.counters.increment_many([(TEST_KEY, 'fred', 2, None)], markers=[(marker, 60)], raise_errors=True)
+        self.assertEqual(self.counters.get_frequency(TEST_KEY, 'fred'), 2)
+        self.assertTrue(self.counters._redis.exists(marker))
+        self.counters._redis.delete(marker)
+
+        with patch.object(counters.Counters, '_increment_script', side_effect=counters.ConnectionError):
+            failing_counters = counters.Counters()
+            self.assertIsNone(failing_counters.increment_many([(TEST_KEY, 'fred', 1, None)], markers=[(marker, 60)]))
+            self.assertRaises(counters.ConnectionError, failing_counters.increment_many, [(TEST_KEY, 'fred', 1, None)],
+                              markers=[(marker, 60)], raise_errors=True)
+        self.assertFalse(self.counters._redis.exists(marker))
+
+    def test_reset_index(self):
+        self.counters.increment(TEST_KEY + ':a', 'fred', index=TEST_KEY)
+        self.counters.increment_many([(TEST_KEY + ':b', 'fred', 2, TEST_KEY)])
+        self.counters.increment(TEST_KEY + ':c', 'fred')
+        self.counters.reset_index(TEST_KEY, [TEST_KEY + ':c'])
+        for key in (TEST_KEY + ':a', TEST_KEY + ':b', TEST_KEY + ':c'):
+            self.assertEqual(self.counters.get(key), 0)
+            self.assertEqual(self.counters.get_frequencies(key), {})
+        self.assertFalse(self.counters._redis.exists(counters.COUNTER_INDEX_CACHE_KEY % TEST_KEY))
+
+
+class CounterBackendTests(object):
+    key = 'CounterBackendTestCase'
+
+    def setUp(self):
+        self.counters = self.backend()
+        self.counters.reset_index(self.key, [self.key, self.key + ':other'])
+
+    def tearDown(self):
+        self.counters.reset_index(self.key, [self.key, self.key + ':other'])
+
+    def test_increment(self):
+        self.counters.increment(self.key, 'fred')
+        self.counters.increment(self.key, 'fred', 2)
+        self.counters.increment(self.key, 'barney')
+        self.assertEqual(self.counters.get(self.key), 2)
+        self.assertEqual(self.counters.get_frequency(self.key, 'fred'), 3)
+        self.assertEqual(self.counters.get_frequency(self.key, 'wilma'), 0)
+        self.assertEqual(self.counters.get_frequencies(self.key), {1: 1, 3: 1})
+
+    def test_clear(self):
+        self.counters.increment(self.key, 'fred', 2)
+        self.counters.increment(self.key, 'barney', 2)
+        self.counters.clear(self.key, 'fred')
+        self.counters.clear(self.key, 'wilma')
+        self.assertEqual(self.counters.get(self.key), 1)
+        self.assertEqual(self.counters.get_frequencies(self.key), {2: 1})
+
+    def test_increment_many(self):
+        self.counters.increment_many([
+            (self.key, 'fred', 1, self.key),
+            (self.key, 'fred', 1, self.key),
+            (self.key + ':other', 'fred', 3, self.key),
+            (self.key + ':other', 'barney', 0, self.key),
+        ])
+        counts, frequencies = self.counters.get_multi([self.key, self.key + ':other'], [self.key])
+        self.assertEqual(counts, {self.key: 1, self.key + ':other': 1})
+        self.assertEqual(frequencies, {self.key: {2: 1}})
+
+    def test_reset(self):
+        self.counters.increment(self.key, 'fred', index=self.key)
+        self.counters.increment(self.key + ':other', 'fred')
+        self.counters.reset_index(self.key)
+        self.assertEqual(self.counters.get(self.key), 0)
+        self.assertEqual(self.counters.get(self.key + ':other'), 1)
+        self.counters.reset_pattern(self.key + ':*')
+        self.assertEqual(self.counters.get(self.key + ':other'), 0)
+        self.assertEqual(self.counters.get_frequencies(self.key + ':other'), {})
+
+    def test_index_keys(self):
+        self.counters.increment(self.key, 'fred', index=self.key)
+        self.counters.increment(self.key + ':other', 'fred')
+        self.assertEqual(self.counters.index_keys(self.key), set([self.key]))
+
+    def test_update_minimums(self):
+        self.counters.update_minimums(self.key, 1, {'a': 0.5, 'b': 0.25}, 60)
+        minimums = self.counters.update_minimums(self.key, 1, {'a': 0.75, 'b': 0.125}, 60)
+        self.assertAlmostEqual(minimums['a'], 0.5, places=5)
+        self.assertAlmostEqual(minimums['b'], 0.125, places=5)
+        # A new version starts over
+        self.assertAlmostEqual(self.counters.update_minimums(self.key, 2, {'a': 0.75}, 60)['a'], 0.75, places=5)
+
+    def test_version(self):
+        version = self.counters.get_version(self.key)
+        self.assertEqual(self.counters.bump_version(self.key), version + 1)
+        self.assertEqual(self.counters.get_version(self.key), version + 1)
+
+
+class LocalCounterBackendTestCase(CounterBackendTests, TestCase):
+    backend = counters.LocalCounters
+
+    def setUp(self):
+        counters.reset_local_counters()
+        super(LocalCounterBackendTestCase, self).setUp()
+
+    def test_instances_share_the_store(self):
+        self.counters.increment(self.key, 'fred')
+        self.assertEqual(counters.LocalCounters().get(self.key), 1)
+        counters.reset_local_counters()
+        self.assertEqual(self.counters.get(self.key), 0)
+
+
+class DatabaseCounterBackendTestCase(CounterBackendTests, DjangoTestCase):
+    backend = counters.DatabaseCounters
+
+    def test_increments_are_batched(self):
+        if not supports_upsert(connection):
+            self.skipTest('No upsert support in this database')
+        with self.assertNumQueries(1):
+            self.counters.increment_many([(self.key, 'user:%s' % i, 1, self.key) for i in range(50)])
+        self.assertEqual(self.counters.get(self.key), 50)
+
+
+@requires_redis
+class RedisCounterBackendTestCase(CounterBackendTests, TestCase):
+    backend = counters.Counters
+
+
+class CounterBackendSettingTestCase(TestCase):
+    @override_settings(EXPERIMENTS_COUNTER_BACKEND=None)
+    def test_default(self):
+        self.assertIsInstance(counters.default_counters(), counters.Counters)
+
+    def test_dotted_path(self):
+        with override_settings(EXPERIMENTS_COUNTER_BACKEND='experiments.counters.LocalCounters'):
+            self.assertIsInstance(counters.default_counters(), counters.LocalCounters)
+            self.assertIsInstance(ExperimentCounter().counters, counters.LocalCounters)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def tearDown(self):
+        counters.reset_connection_pool()
+
+    def test_pool_is_shared(self):
+        pool = counters.connection_pool()
+        self.assertIs(counters.connection_pool(), pool)
+        counters.reset_connection_pool()
+        self.assertIsNot(counters.connection_pool(), pool)
+
+    @override_settings(EXPERIMENTS_REDIS_HOST='redis.example.com', EXPERIMENTS_REDIS_MAX_CONNECTIONS=7,
+                       EXPERIMENTS_REDIS_SOCKET_TIMEOUT=0.5)
+    def test_pool_settings(self):
+        counters.reset_connection_pool()
+        pool = counters.connection_pool()
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs['host'], 'redis.example.com')
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 0.5)
+
+    @override_settings(EXPERIMENTS_REDIS_SENTINELS=[('localhost', 26379)], EXPERIMENTS_REDIS_SENTINELS_TIMEOUT=0.1,
+                       EXPERIMENTS_REDIS_MASTER_NAME='experiments')
+    def test_sentinel_pool(self):
+        counters.reset_connection_pool()
+        pool = counters.connection_pool()
+        self.assertIsInstance(pool, counters.SentinelConnectionPool)
+        self.assertEqual(pool.service_name, 'experiments')
+
+
+SHARDS = [{'db': 1}, {'db': 2}]
+
+
+@requires_redis
+class ShardedCounterTestCase(TestCase):
+    keys = ['%s:%s' % (TEST_KEY, i) for i in range(20)]
+
+    def setUp(self):
+        self.settings_override = override_settings(EXPERIMENTS_REDIS_SHARDS=SHARDS, EXPERIMENTS_COUNTER_BACKEND=None)
+        self.settings_override.enable()
+        counters.reset_connection_pool()
+        self.counters = counters.default_counters()
+        self.counters.reset_index(TEST_KEY, self.keys)
+
+    def tearDown(self):
+        self.counters.reset_index(TEST_KEY, self.keys)
+        self.settings_override.disable()
+        counters.reset_connection_pool()
+
+    def test_backend_selected_by_settings(self):
+        self.assertIsInstance(self.counters, counters.ShardedCounters)
+
+    def test_keys_are_spread_over_shards(self):
+        for key in self.keys:
+            self.counters.increment(key, 'fred', index=TEST_KEY)
+        for shard in self.counters._shards:
+            self.assertTrue(shard.scard(counters.COUNTER_INDEX_CACHE_KEY % TEST_KEY) > 0)
+
+    def test_counter_keys_colocate(self):
+        for key in self.keys:
+            self.counters.increment(key, 'fred', 2)
+            shard = self.counters._client_for(key)
+            self.assertEqual(shard.hget(counters.SHARDED_COUNTER_CACHE_KEY % key, 'fred'), b'2')
+            self.assertEqual(shard.hgetall(counters.SHARDED_COUNTER_FREQ_CACHE_KEY % key), {b'2': b'1'})
+
+    def test_counts(self):
+        self.counters.increment_many([(key, 'fred', 1, TEST_KEY) for key in self.keys])
+        self.counters.increment(self.keys[0], 'barney', 3, index=TEST_KEY)
+        self.counters.clear(self.keys[1], 'fred')
+        counts, frequencies = self.counters.get_multi(self.keys, self.keys[:2])
+        self.assertEqual(counts[self.keys[0]], 2)
+        self.assertEqual(counts[self.keys[1]], 0)
+        self.assertEqual(counts[self.keys[2]], 1)
+        self.assertEqual(frequencies, {self.keys[0]: {1: 1, 3: 1}, self.keys[1]: {}})
+        self.assertEqual(self.counters.get_frequency(self.keys[0], 'barney'), 3)
+
+    def test_reset_index(self):
+        self.counters.increment_many([(key, 'fred', 1, TEST_KEY) for key in self.keys])
+        self.counters.reset_index(TEST_KEY)
+        self.assertEqual(self.counters.get_multi(self.keys)[0], dict((key, 0) for key in self.keys))
+
+    def test_ring_is_stable(self):
+        ring = counters.HashRing([0, 1], ['a', 'b'])
+        grown = counters.HashRing([0, 1, 2], ['a', 'b', 'c'])
+        moved = [key for key in self.keys if grown.get_node(key) != ring.get_node(key)]
+        self.assertTrue(all(grown.get_node(key) == 2 for key in moved))
+
+
+class ExperimentCounterBufferTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name='CounterBufferTestCase')
+        self.experiment_counter = ExperimentCounter()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def goal_count_outside_buffer(self):
+        return self.experiment_counter.counters.get(GOAL_KEY % (self.experiment.name, 'blue', 'buy'))
+
+    def test_increments_are_written_when_buffer_exits(self):
+        with self.experiment_counter.buffer():
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred')
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred', 2)
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'barney')
+            self.assertEqual(self.goal_count_outside_buffer(), 0)
+        self.assertEqual(self.goal_count_outside_buffer(), 2)
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'blue', 'buy'), {1: 1, 3: 1})
+
+    def test_nested_buffers_write_once(self):
+        with self.experiment_counter.buffer():
+            with ExperimentCounter().buffer():
+                self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred')
+            self.assertEqual(self.goal_count_outside_buffer(), 0)
+        self.assertEqual(self.goal_count_outside_buffer(), 1)
+
+    def test_buffer_left_open_by_a_request_is_written(self):
+        middleware = ExperimentsCounterBufferMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred')
+        # process_response never runs for this request
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertEqual(self.goal_count_outside_buffer(), 1)
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'barney')
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(self.goal_count_outside_buffer(), 2)
+
+    def test_reads_see_buffered_increments(self):
+        with self.experiment_counter.buffer():
+            self.experiment_counter.increment_participant_count(self.experiment, 'blue', 'fred')
+            self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'blue'), 1)
+
+
+class ExperimentSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name='SnapshotTestCase', alternatives={'control': {}, 'blue': {}})
+        self.experiment_counter = ExperimentCounter()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def test_snapshot_matches_single_reads(self):
+        self.experiment_counter.increment_participant_count(self.experiment, 'control', 'fred')
+        self.experiment_counter.increment_participant_count(self.experiment, 'blue', 'barney')
+        self.experiment_counter.increment_participant_count(self.experiment, 'blue', 'george')
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'barney', 3)
+
+        snapshot = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        for alternative in ('control', 'blue'):
+            self.assertEqual(snapshot.participant_count(alternative), self.experiment_counter.participant_count(self.experiment, alternative))
+            self.assertEqual(snapshot.goal_count(alternative, 'buy'), self.experiment_counter.goal_count(self.experiment, alternative, 'buy'))
+            self.assertEqual(snapshot.goal_distribution(alternative, 'buy'), self.experiment_counter.goal_distribution(self.experiment, alternative, 'buy'))
+        self.assertEqual(snapshot.goal_distribution('blue', 'buy'), {3: 1})
+
+    def test_snapshot_is_immutable(self):
+        snapshot = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        snapshot.goal_distribution('blue', 'buy')[0] = 10
+        self.assertEqual(snapshot.goal_distribution('blue', 'buy'), {})
+        self.assertRaises(AttributeError, setattr, snapshot, '_goals', {})
+
+
+class HyperLogLogGoalTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name='HyperLogLogGoalTestCase', alternatives={'control': {}, 'blue': {}})
+        self.experiment_counter = ExperimentCounter()
+        self.hll_goals = patch.object(conf, 'HLL_GOALS', frozenset(['buy']))
+        self.hll_goals.start()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+        self.hll_goals.stop()
+
+    @requires_redis
+    def test_counts_unique_participants(self):
+        for participant in ('fred', 'barney', 'fred'):
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', participant, 2)
+        with self.experiment_counter.buffer():
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'george')
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'blue', 'buy'), 3)
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'blue', 'buy'), {})
+        self.assertEqual(self.experiment_counter.counters.get(GOAL_KEY % (self.experiment.name, 'blue', 'buy')), 0)
+
+        snapshot = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        self.assertEqual(snapshot.goal_count('blue', 'buy'), 3)
+        self.assertEqual(snapshot.goal_distribution('blue', 'buy'), {})
+
+    @requires_redis
+    def test_error_bound(self):
+        self.assertAlmostEqual(self.experiment_counter.goal_count_error('buy'), 0.0081, places=4)
+        self.assertEqual(self.experiment_counter.goal_count_error(conf.VISIT_PRESENT_COUNT_GOAL), 0)
+
+    def test_delete(self):
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred')
+        self.experiment_counter.delete(self.experiment)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'blue', 'buy'), 0)
+
+
+class CompactParticipantTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name='CompactParticipantTestCase', alternatives={'control': {}, 'blue': {}})
+        self.experiment_counter = ExperimentCounter()
+        self.goal_key = GOAL_KEY % (self.experiment.name, 'blue', 'buy')
+        self.all_goals = patch.object(conf, 'ALL_GOALS', conf.ALL_GOALS + ('buy',))
+        self.all_goals.start()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+        self.all_goals.stop()
+
+    def test_compact_identifiers(self):
+        with patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True):
+            self.experiment_counter.increment_participant_count(self.experiment, 'blue', 'session:abc')
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'session:abc', 2)
+            self.assertEqual(dict(self.experiment_counter.participant_goal_frequencies(self.experiment, 'blue', 'session:abc'))['buy'], 2)
+            self.assertEqual(list(self.experiment_counter.counters.scan_participants(self.goal_key)), [(self.experiment_counter.counter_participant('session:abc'), 2)])
+
+            self.experiment_counter.remove_participant(self.experiment, 'blue', 'session:abc')
+            self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'blue'), 0)
+            self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'blue', 'buy'), 0)
+
+    def test_hex_identifiers_for_text_backends(self):
+        experiment_counter = ExperimentCounter()
+        experiment_counter.counters = counters.DatabaseCounters()
+        with patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True):
+            self.assertEqual(len(experiment_counter.counter_participant('user:1')), 16)
+
+    @requires_redis
+    def test_compact_existing_participants(self):
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'user:1', 2)
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'user:2', 3)
+        with patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True):
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'user:1', 1)
+            self.assertEqual(self.experiment_counter.compact_participants(self.experiment, batch_size=1), 2)
+
+            self.assertEqual(dict(self.experiment_counter.participant_goal_frequencies(self.experiment, 'blue', 'user:1'))['buy'], 3)
+            self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'blue', 'buy'), 2)
+            self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'blue', 'buy'), {3: 2})
+            self.assertEqual(self.experiment_counter.compact_participants(self.experiment), 0)
+
+
+class ExperimentArchiveTestCase(DjangoTestCase):
+    def setUp(self):
+        Experiment.objects.bulk_create([Experiment(name='ArchiveTestCase', alternatives={'control': {}, 'blue': {}}, state=CONTROL_STATE)])
+        self.experiment = Experiment.objects.get(name='ArchiveTestCase')
+        self.experiment_counter = ExperimentCounter()
+        for participant in ('fred', 'barney'):
+            self.experiment_counter.increment_participant_count(self.experiment, 'blue', participant)
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'fred', 3)
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def test_archive(self):
+        # 'buy' isn't in EXPERIMENTS_GOALS, it is found through the experiment's index
+        before = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        self.experiment_counter.archive(self.experiment)
+
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'blue'), 0)
+        after = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        self.assertEqual(after.participant_count('blue'), before.participant_count('blue'))
+        self.assertEqual(after.goal_count('blue', 'buy'), 1)
+        self.assertEqual(after.goal_distribution('blue', 'buy'), {3: 1})
+
+        # Anything counted after archiving is added to the archived counts
+        self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'barney', 3)
+        snapshot = self.experiment_counter.experiment_snapshot(self.experiment, ['buy'], distribution_goals=['buy'])
+        self.assertEqual(snapshot.goal_count('blue', 'buy'), 2)
+        self.assertEqual(snapshot.goal_distribution('blue', 'buy'), {3: 2})
+
+        self.experiment_counter.delete(self.experiment)
+        self.assertFalse(ExperimentArchive.objects.exists())
+
+    def test_archive_command(self):
+        Experiment.objects.filter(name=self.experiment.name).update(end_date=now() - timedelta(days=conf.ARCHIVE_AFTER_DAYS - 1))
+        call_command('archive_experiments', verbosity=0)
+        self.assertFalse(ExperimentArchive.objects.exists())
+
+        Experiment.objects.filter(name=self.experiment.name).update(end_date=now() - timedelta(days=conf.ARCHIVE_AFTER_DAYS + 1))
+        call_command('archive_experiments', verbosity=0)
+        self.assertEqual(ExperimentArchive.objects.get().snapshot['participants'], {'blue': 2, 'control': 0})
+
+
+class ExportParticipantsTestCase(DjangoTestCase):
+    def setUp(self):
+        Experiment.objects.bulk_create([Experiment(name='ExportTestCase', alternatives={'control': {}, 'blue': {}})])
+        self.experiment = Experiment.objects.get(name='ExportTestCase')
+        self.experiment_counter = ExperimentCounter()
+        for i in range(5):
+            self.experiment_counter.increment_participant_count(self.experiment, 'blue', 'user:%d' % i)
+            self.experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'user:%d' % i, i)
+        self.experiment_counter.increment_participant_count(self.experiment, 'control', 'user:9')
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def test_export(self):
+        rows = list(self.experiment_counter.export_participants(self.experiment, ['buy'], batch_size=2))
+        self.assertEqual(sorted(rows), [('blue', 'user:%d' % i, [i]) for i in range(5)] + [('control', 'user:9', [0])])
+
+    def test_export_backends(self):
+        for backend in (counters.LocalCounters, counters.DatabaseCounters):
+            if isinstance(self.experiment_counter.counters, backend):
+                # Already holds the counts written in setUp
+                continue
+            experiment_counter = ExperimentCounter()
+            experiment_counter.counters = backend()
+            experiment_counter.increment_participant_count(self.experiment, 'blue', 'user:1')
+            experiment_counter.increment_goal_count(self.experiment, 'blue', 'buy', 'user:1', 2)
+            self.assertEqual(list(experiment_counter.export_participants(self.experiment, ['buy'])), [('blue', 'user:1', [2])])
+            experiment_counter.delete(self.experiment)
+
+    def test_export_command(self):
+        output = StringIO()
+        call_command('export_experiment_counters', 'ExportTestCase', goals='buy', format='jsonl', stdout=output)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertIn({'alternative': 'blue', 'participant': 'user:3', 'buy': 3}, rows)
+
+        output = StringIO()
+        call_command('export_experiment_counters', 'ExportTestCase', goals='buy', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'alternative,participant,buy')
+        self.assertIn('control,user:9,0', lines)
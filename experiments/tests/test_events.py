@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.utils.unittest import TestCase
+
+from experiments.events import EventPipeline, FileSink, LoggingSink
+
+
+class ListSink(object):
+    def __init__(self, enabled=True):
+        self.is_enabled = enabled
+        self.batches = []
+
+    def enabled(self):
+        return self.is_enabled
+
+    def write(self, events):
+        self.batches.append([data for timestamp, data in events])
+
+
+class EventPipelineTestCase(TestCase):
+    def pipeline(self, sinks, **kwargs):
+        options = dict(buffer_size=100, batch_size=2, flush_interval=60, background=False)
+        options.update(kwargs)
+        return EventPipeline(sinks, **options)
+
+    def test_emit(self):
+        sink = ListSink()
+        self.pipeline([sink]).emit('goal_hit', {'goal': 'buy'})
+        self.assertEqual(sink.batches, [[{'type': 'goal_hit', 'goal': 'buy'}]])
+
+    def test_disabled_sinks_skip_work(self):
+        sink = ListSink(enabled=False)
+        pipeline = self.pipeline([sink])
+        pipeline.emit('goal_hit', {'goal': 'buy'})
+        self.assertEqual(len(pipeline.events), 0)
+        self.assertEqual(sink.batches, [])
+
+    def test_batches_and_ring_buffer(self):
+        sink = ListSink()
+        pipeline = self.pipeline([sink], buffer_size=3, background=True)
+        pipeline._pid = os.getpid()  # Keep the thread from starting
+        for i in range(5):
+            pipeline.emit('participant_add', {'participant': i})
+        self.assertEqual(pipeline.dropped, 2)
+        pipeline.flush()
+        self.assertEqual(sink.batches, [[{'type': 'participant_add', 'participant': 2}, {'type': 'participant_add', 'participant': 3}],
+                                        [{'type': 'participant_add', 'participant': 4}]])
+
+    def test_background_thread(self):
+        sink = ListSink()
+        pipeline = self.pipeline([sink], batch_size=1, background=True)
+        pipeline.emit('confirm_human', {'participant': 'fred'})
+        for _ in range(100):
+            if sink.batches:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sink.batches, [[{'type': 'confirm_human', 'participant': 'fred'}]])
+
+    def test_logging_sink_follows_logger_level(self):
+        sink = LoggingSink('experiments.tests.events')
+        sink.logger.setLevel(logging.WARNING)
+        self.assertFalse(sink.enabled())
+        sink.logger.setLevel(logging.INFO)
+        self.assertTrue(sink.enabled())
+
+    def test_file_sink(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'events.jsonl')
+            self.pipeline([FileSink(path)]).emit('goal_hit', {'goal': 'buy'})
+            with open(path) as events:
+                event = json.loads(events.readline())
+            self.assertEqual(event['type'], 'goal_hit')
+            self.assertIn('timestamp', event)
+        finally:
+            shutil.rmtree(directory)
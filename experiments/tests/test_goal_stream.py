@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+
+import json
+
+from django.test import TestCase as DjangoTestCase
+from django.utils.unittest import TestCase
+from mock import MagicMock, patch
+from redis.exceptions import ConnectionError
+
+from experiments import goal_stream
+from experiments.counters import Counters
+from experiments.experiment_counters import ExperimentCounter
+from experiments.manager import experiment_manager
+from experiments.models import Experiment
+from experiments.tests.utils import requires_redis
+from experiments.utils import AuthenticatedUser, EnrollmentData
+
+EXPERIMENT_NAME = 'goal_stream_test'
+
+
+@requires_redis
+class GoalStreamTestCase(DjangoTestCase):
+    def setUp(self):
+        Experiment.objects.bulk_create([Experiment(name=EXPERIMENT_NAME)])
+        experiment_manager.refresh()
+        self.experiment = experiment_manager[EXPERIMENT_NAME]
+        self.experiment_counter = ExperimentCounter()
+        self.client = goal_stream._client()
+        self.stream = patch('experiments.conf.GOAL_STREAM', 'experiments:goals:test')
+        self.stream.start()
+
+    def tearDown(self):
+        self.stream.stop()
+        self.experiment_counter.delete(self.experiment)
+        self.client.delete('experiments:goals:test')
+        for key in self.client.keys(goal_stream.APPLIED_KEY % '*'):
+            self.client.delete(key)
+
+    def entry(self, entry_id, participant='user:1', goal='buy', count=1, enrollments=((EXPERIMENT_NAME, 'red'),)):
+        return (entry_id, {'p': participant, 'g': goal, 'c': str(count), 'e': json.dumps(enrollments)})
+
+    def apply(self, entries):
+        return goal_stream.apply_entries(entries)
+
+    def test_apply_entries(self):
+        applied = self.apply([
+            self.entry('1-0', 'user:1', count=2),
+            self.entry('1-1', 'user:2'),
+            self.entry('1-2', 'user:1', enrollments=[(EXPERIMENT_NAME, 'red'), ('deleted_experiment', 'red')]),
+        ])
+        self.assertEqual(applied, 3)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'red', 'buy'), 2)
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'red', 'buy'), {1: 1, 3: 1})
+        # Not auto created again by the worker
+        self.assertFalse(Experiment.objects.filter(name='deleted_experiment').exists())
+
+    @patch('experiments.goal_stream._acknowledge')
+    def test_failed_writes_leave_entries_pending(self, acknowledge):
+        # The worker's pending entries are read again until they are acknowledged
+        entries = [self.entry('1-0', 'user:1'), self.entry('1-1', 'user:2')]
+        with patch('experiments.goal_stream._read_group', return_value=entries):
+            with patch.object(Counters, '_increment_script', side_effect=ConnectionError):
+                self.assertRaises(ConnectionError, goal_stream.consume, 'worker')
+            self.assertFalse(acknowledge.called)
+            self.assertEqual(self.client.keys(goal_stream.APPLIED_KEY % '*'), [])
+            self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'red', 'buy'), 0)
+
+            self.assertEqual(goal_stream.consume('worker'), 2)
+        acknowledge.assert_called_once_with(goal_stream._client(), ['1-0', '1-1'])
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'red', 'buy'), 2)
+
+    def test_redelivered_entries_are_counted_once(self):
+        self.apply([self.entry('1-0', 'user:1')])
+        applied = self.apply([self.entry('1-0', 'user:1'), self.entry('1-1', 'user:2'), ('1-2', None)])
+        self.assertEqual(applied, 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'red', 'buy'), 2)
+        # user:1 counted once, not twice
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'red', 'buy'), {1: 2})
+
+    def test_parse_entries(self):
+        self.assertEqual(goal_stream._entries([
+            [b'1-0', [b'p', b'user:1', b'c', b'1']],
+            (b'1-1', {b'p': b'user:2'}),
+            [b'1-2', None],
+            None,
+        ]), [('1-0', {'p': 'user:1', 'c': '1'}), ('1-1', {'p': 'user:2'}), ('1-2', None)])
+
+
+@patch('experiments.conf.ASYNC_GOALS', True)
+class AsyncGoalTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name=EXPERIMENT_NAME)
+        self.experiment.is_displaying_alternatives = lambda: True
+        self.user = AuthenticatedUser(MagicMock(pk=7))
+        self.user._get_all_enrollments = lambda: [EnrollmentData(self.experiment, 'red', None, None)]
+        self.user._experiment_goal = MagicMock()
+
+    @patch('experiments.goal_stream.enqueue_goal', return_value=True)
+    def test_goal_is_enqueued(self, enqueue_goal):
+        self.user.goal('buy', 3)
+        enqueue_goal.assert_called_once_with('user:7', 'buy', 3, [(EXPERIMENT_NAME, 'red')])
+        self.assertFalse(self.user._experiment_goal.called)
+
+    @patch('experiments.goal_stream.enqueue_goal', return_value=False)
+    def test_falls_back_to_counting_synchronously(self, enqueue_goal):
+        self.user.goal('buy')
+        self.user._experiment_goal.assert_called_once_with(self.experiment, 'red', 'buy', 1)
@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+from django.db import DatabaseError
+from django.utils.unittest import TestCase
+from mock import patch
+
+from experiments import last_seen
+from experiments.dateutils import now
+from experiments.tests.utils import requires_redis
+
+USER_PK = 4242
+
+
+@requires_redis
+class LastSeenFlushTestCase(TestCase):
+    def tearDown(self):
+        client = last_seen._client()
+        client.delete(last_seen.USER_LAST_SEEN_KEY % USER_PK)
+        client.srem(last_seen.DIRTY_USERS_KEY, USER_PK)
+
+    def test_failed_flush_keeps_the_buffered_values(self):
+        seen = now().replace(microsecond=0)
+        last_seen.buffer_last_seen(USER_PK, ['flushed_experiment'], seen)
+        with patch('experiments.last_seen._update_enrollments', side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, last_seen.flush)
+        self.assertEqual(last_seen.buffered_last_seen(USER_PK), {'flushed_experiment': seen})
+
+    def test_restore_keeps_newer_visits(self):
+        seen = now().replace(microsecond=0)
+        last_seen.buffer_last_seen(USER_PK, ['flushed_experiment'], seen)
+
+        def visit_during_flush(user_pks, results):
+            last_seen.buffer_last_seen(USER_PK, ['flushed_experiment'], seen + timedelta(hours=1))
+            raise DatabaseError
+
+        with patch('experiments.last_seen._update_enrollments', side_effect=visit_during_flush):
+            self.assertRaises(DatabaseError, last_seen.flush)
+        self.assertEqual(last_seen.buffered_last_seen(USER_PK), {'flushed_experiment': seen + timedelta(hours=1)})
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+from django.db import DatabaseError, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from mock import patch
+
+from experiments.manager import ExperimentManager, check_registry_cache
+from experiments.models import Experiment, ENABLED_STATE
+
+
+class ExperimentManagerTestCase(TestCase):
+    def setUp(self):
+        self.manager = ExperimentManager(Experiment)
+
+    def test_lookup(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test', state=ENABLED_STATE)])
+        self.manager.refresh()
+        self.assertEqual(self.manager['registry_test'].state, ENABLED_STATE)
+        self.assertTrue('registry_test' in self.manager)
+        self.assertIsNone(self.manager.get_experiment('missing_experiment'))
+        self.assertRaises(KeyError, lambda: self.manager['missing_experiment'])
+
+    def test_lookups_do_not_query_between_polls(self):
+        self.manager.refresh()
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                self.manager.get_experiment('missing_experiment')
+
+    def test_stats(self):
+        self.manager.refresh()
+        stats = self.manager.stats()
+        self.assertEqual(stats['experiments'], 0)
+        self.assertEqual(stats['refresh_count'], 1)
+        self.assertLess(stats['staleness'], 5)
+
+    def test_ensure_alternative_exists_does_not_write(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test', alternatives={})])
+        self.manager.refresh()
+        experiment = self.manager['registry_test']
+        with self.assertNumQueries(0):
+            self.manager.ensure_alternative_exists(experiment, 'blue', 2)
+            self.manager.ensure_alternative_exists(experiment, 'blue', 2)
+            self.manager.ensure_alternative_exists(experiment, 'control')
+        self.assertEqual(experiment.alternatives['blue'], {'enabled': True, 'weight': 2.0})
+        self.assertEqual(Experiment.objects.get(name='registry_test').alternatives, {})
+
+        self.manager.store_pending_alternatives()
+        self.assertEqual(Experiment.objects.get(name='registry_test').alternatives, {
+            'blue': {'enabled': True, 'weight': 2.0},
+            'control': {'enabled': True},
+        })
+        self.assertEqual(sorted(self.manager['registry_test'].alternatives), ['blue', 'control'])
+
+    def test_alternatives_are_queued_again_after_a_failed_store(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test', alternatives={})])
+        self.manager.refresh()
+        experiment = self.manager['registry_test']
+        self.manager.ensure_alternative_exists(experiment, 'blue')
+        with patch.object(self.manager, '_store_alternatives', side_effect=DatabaseError):
+            self.manager.store_pending_alternatives()
+        self.assertEqual(Experiment.objects.get(name='registry_test').alternatives, {})
+
+        # The in-memory experiment already has the alternative, as on a later render
+        experiment.alternatives = {}
+        self.manager.ensure_alternative_exists(experiment, 'blue')
+        self.manager.store_pending_alternatives()
+        self.assertEqual(sorted(Experiment.objects.get(name='registry_test').alternatives), ['blue'])
+
+    def test_reload_forgets_queued_alternatives(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test', alternatives={})])
+        self.manager.refresh()
+        self.manager.ensure_alternative_exists(self.manager['registry_test'], 'blue')
+        self.manager.store_pending_alternatives()
+        # Removed in the admin, then rendered again
+        Experiment.objects.filter(name='registry_test').update(alternatives={})
+        self.manager.refresh()
+        self.manager.ensure_alternative_exists(self.manager['registry_test'], 'blue')
+        self.manager.store_pending_alternatives()
+        self.assertEqual(sorted(Experiment.objects.get(name='registry_test').alternatives), ['blue'])
+
+
+class ExperimentManagerTransactionTestCase(TransactionTestCase):
+    def setUp(self):
+        self.manager = ExperimentManager(Experiment)
+
+    def test_delete_refreshes_registry(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test')])
+        self.manager.refresh()
+        refresh_count = self.manager.refresh_count
+        Experiment.objects.filter(name='registry_test').delete()
+        self.assertFalse('registry_test' in self.manager)
+        self.assertGreater(self.manager.refresh_count, refresh_count)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_version_is_bumped_after_commit(self):
+        Experiment.objects.bulk_create([Experiment(name='registry_test')])
+        self.manager.refresh()
+        with transaction.atomic():
+            Experiment.objects.filter(name='registry_test').delete()
+            version_in_transaction = self.manager._remote_version()
+        # Where the change can't be hooked to the commit, it is announced again after the request
+        self.manager._request_finished()
+        self.assertNotEqual(self.manager._remote_version(), version_in_transaction)
+        self.assertFalse('registry_test' in self.manager)
+
+
+class CheckRegistryCacheTestCase(TestCase):
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_process_local_cache(self):
+        self.assertEqual([warning.id for warning in check_registry_cache()], ['experiments.W001'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}})
+    def test_shared_cache(self):
+        self.assertEqual(check_registry_cache(), [])
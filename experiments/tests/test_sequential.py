@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+
+from django.test import TestCase
+from mock import patch
+
+from experiments import conf, sequential
+from experiments.experiment_counters import ExperimentCounter
+from experiments.models import Experiment, ENABLED_STATE, CONTROL_STATE
+from experiments.significance import msprt_p_value
+from experiments.signals import experiment_stopped
+
+EXPERIMENT_NAME = 'sequential_test'
+
+
+class MSPRTTestCase(TestCase):
+    def test_no_difference(self):
+        self.assertEqual(msprt_p_value(1000, 100, 1000, 100, 0.01), 1.0)
+
+    def test_undefined(self):
+        self.assertIsNone(msprt_p_value(0, 0, 1000, 100, 0.01))
+        self.assertIsNone(msprt_p_value(1000, 0, 1000, 0, 0.01))
+
+    def test_evidence_grows_with_the_sample(self):
+        p_values = [msprt_p_value(n, n // 10, n, n // 8, 0.01) for n in (1000, 10000, 100000)]
+        self.assertGreater(p_values[0], 0.5)
+        self.assertLess(p_values[1], p_values[0])
+        self.assertLess(p_values[2], p_values[1])
+        self.assertLess(p_values[2], 0.001)
+
+    def test_likelihood_ratio(self):
+        # Lambda = sqrt(V / (V + tau^2)) * exp(tau^2 * theta^2 / (2 * V * (V + tau^2)))
+        variance = 0.1 * 0.9 / 10000 + 0.15 * 0.85 / 10000
+        likelihood_ratio = (variance / (variance + 0.0001)) ** 0.5 * 2.718281828459045 ** (0.0001 * 0.05 ** 2 / (2 * variance * (variance + 0.0001)))
+        self.assertAlmostEqual(msprt_p_value(10000, 1000, 10000, 1500, 0.01), 1 / likelihood_ratio)
+
+
+class AlwaysValidPValuesTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name=EXPERIMENT_NAME, alternatives={'control': {}, 'blue': {}}, relevant_chi2_goals='buy', state=ENABLED_STATE)
+        self.counters = ExperimentCounter().counters
+
+    def tearDown(self):
+        self.counters.reset(sequential.SEQUENTIAL_STATE_KEY % EXPERIMENT_NAME)
+
+    def p_value(self, alternative_conversions, version=1):
+        comparisons = [('buy', 'blue', 10000, alternative_conversions, 10000, 1000)]
+        return sequential.always_valid_p_values(self.experiment, version, comparisons, self.counters)[('buy', 'blue')]
+
+    def test_running_minimum(self):
+        low = self.p_value(1500)
+        self.assertAlmostEqual(low, msprt_p_value(10000, 1500, 10000, 1000, 0.01), delta=low * 1e-5)
+        self.assertEqual(self.p_value(1000), low)
+        self.assertLess(self.p_value(1600), low)
+
+    def test_reset_with_the_counters(self):
+        self.p_value(1500)
+        self.assertEqual(self.p_value(1000, version=2), 1.0)
+
+    def test_too_few_participants(self):
+        comparisons = [('buy', 'blue', 99, 50, 10000, 1000)]
+        self.assertEqual(sequential.always_valid_p_values(self.experiment, 1, comparisons), {('buy', 'blue'): None})
+
+
+class CheckExperimentTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name=EXPERIMENT_NAME, alternatives={'control': {}, 'blue': {}}, relevant_chi2_goals='buy', state=ENABLED_STATE)
+        self.experiment_counter = ExperimentCounter()
+        # Only goals in EXPERIMENTS_GOALS can stop an experiment
+        self.all_goals = patch.object(conf, 'ALL_GOALS', conf.ALL_GOALS + ('buy',))
+        self.all_goals.start()
+
+    def tearDown(self):
+        self.all_goals.stop()
+        self.experiment_counter.delete(self.experiment)
+        self.experiment_counter.counters.reset(sequential.SEQUENTIAL_STATE_KEY % EXPERIMENT_NAME)
+
+    def enroll(self, alternative, participants, conversions):
+        with self.experiment_counter.buffer():
+            for i in range(participants):
+                participant = '%s:%d' % (alternative, i)
+                self.experiment_counter.increment_participant_count(self.experiment, alternative, participant)
+                if i < conversions:
+                    self.experiment_counter.increment_goal_count(self.experiment, alternative, 'buy', participant)
+
+    @patch.object(Experiment, 'save')
+    def test_keeps_running(self, save):
+        self.enroll('control', 1000, 100)
+        self.enroll('blue', 1000, 110)
+        self.assertIsNone(sequential.check_experiment(self.experiment, self.experiment_counter))
+        self.assertEqual(self.experiment.state, ENABLED_STATE)
+        self.assertFalse(save.called)
+
+    @patch.object(Experiment, 'save')
+    def test_stops(self, save):
+        self.enroll('control', 1000, 100)
+        self.enroll('blue', 1000, 300)
+        stopped = []
+        handler = lambda sender, **kwargs: stopped.append(kwargs['alternative'])
+        experiment_stopped.connect(handler)
+        try:
+            goal, alternative, p_value = sequential.check_experiment(self.experiment, self.experiment_counter)
+        finally:
+            experiment_stopped.disconnect(handler)
+        self.assertEqual((goal, alternative), ('buy', 'blue'))
+        self.assertLess(p_value, 0.05)
+        self.assertEqual(self.experiment.state, CONTROL_STATE)
+        self.assertTrue(save.called)
+        self.assertEqual(stopped, ['blue'])
+
+    def test_needs_relevant_goals(self):
+        self.experiment.relevant_chi2_goals = ''
+        self.assertIsNone(sequential.check_experiment(self.experiment, self.experiment_counter))
@@ -1,7 +1,11 @@
-from django.utils.unittest import TestCase
+from django.utils.unittest import TestCase, skipIf
+from mock import patch
 import random
 
-from experiments.significance import mann_whitney, chi_square_p_value
+from experiments import significance
+from experiments.significance import (mann_whitney, mann_whitney_many, chi_square_p_value, chi_square_p_values,
+                                      chi_square_contingency, kruskal_wallis)
+from experiments.stats import zprob, zprob_array, chisqprob, chisqprob_array
 
 
 # The hardcoded p and u values in these tests were calculated using scipy
@@ -73,3 +77,104 @@ class ChiSquare(TestCase):
         self.assertAlmostEqual(observed_test_statistic_result, observed_test_statistic, accuracy, 'Wrong observed result')
         self.assertAlmostEqual(p_value_result, p_value, accuracy, 'Wrong P Value')
 
+
+
+def random_distribution(max_value):
+    return dict((random.randint(0, max_value), random.randint(0, 200)) for _ in range(random.randint(0, 60)))
+
+
+class BatchedSignificanceTestCase(TestCase):
+    """The batched functions have to agree with the ones above, with or without numpy"""
+
+    def setUp(self):
+        self.random = random.getstate()
+        random.seed(42)
+
+    def tearDown(self):
+        random.setstate(self.random)
+
+    def assertClose(self, first, second, tolerance=1e-12):
+        self.assertEqual(first is None, second is None, '%r != %r' % (first, second))
+        if first is not None:
+            self.assertLessEqual(abs(first - second), tolerance * max(1, abs(second)), '%r != %r' % (first, second))
+
+    @skipIf(significance.numpy is None, 'numpy is not installed')
+    def test_zprob_array(self):
+        values = [random.uniform(-8, 8) for _ in range(1000)] + [0.0, 1.0, -1.0, 2.0, 6.0, -6.0]
+        for value, result in zip(values, zprob_array(values)):
+            self.assertClose(result, zprob(value))
+
+    @skipIf(significance.numpy is None, 'numpy is not installed')
+    def test_chisqprob_array(self):
+        values = [random.uniform(0, 100) for _ in range(200)] + [0.0, -1.0, 39.9, 40.0, 40.1]
+        for df in range(0, 12):
+            for value, result in zip(values, chisqprob_array(values, df)):
+                self.assertClose(result, chisqprob(value, df))
+
+    def test_mann_whitney_many(self):
+        pairs = [(random_distribution(max_value), random_distribution(max_value)) for max_value in [3, 50, 1000] * 50]
+        pairs.append((dict((x, 1) for x in range(10000)), dict((x + 1, 1) for x in range(10000))))
+        pairs.append(({0: 1000000, 1: 5}, {0: 2000000, 2: 7}))
+        pairs.append(({}, {}))
+        for numpy in self.numpy_modes():
+            with patch.object(significance, 'numpy', numpy):
+                for (a, b), (u, p) in zip(pairs, mann_whitney_many(pairs)):
+                    expected_u, expected_p = mann_whitney(a, b)
+                    self.assertClose(u, expected_u)
+                    self.assertClose(p, expected_p)
+            self.assertEqual(mann_whitney_many([]), [])
+
+    def test_chi_square_p_values(self):
+        for size in (2, 3, 5):
+            matrices = [[[random.randint(0, 50) for _ in range(size)] for _ in range(size)] for _ in range(200)]
+            matrices.extend([[[0] * size] * size, [[1] * size] * (size - 1) + [[-1] * size]])
+            for numpy in self.numpy_modes():
+                with patch.object(significance, 'numpy', numpy):
+                    for matrix, (statistic, p) in zip(matrices, chi_square_p_values(matrices)):
+                        expected_statistic, expected_p = chi_square_p_value(matrix)
+                        self.assertClose(statistic, expected_statistic)
+                        self.assertClose(p, expected_p)
+
+    def test_chi_square_p_values_mixed_shapes(self):
+        matrices = [((36, 14), (30, 25)), ((100, 50, 10), (110, 50, 10), (140, 55, 11)), ((1,), (1, 2))]
+        self.assertEqual(chi_square_p_values(matrices), [chi_square_p_value(matrix) for matrix in matrices])
+
+    def numpy_modes(self):
+        return [significance.numpy, None] if significance.numpy is not None else [None]
+
+
+# Reference values from scipy.stats.kruskal and scipy.stats.chi2_contingency(correction=False)
+class KruskalWallisTestCase(TestCase):
+    def test_tied_histograms(self):
+        h, p = kruskal_wallis([{0: 100, 1: 50, 2: 10}, {0: 110, 1: 60, 2: 5}, {0: 90, 1: 70, 2: 20}])
+        self.assertAlmostEqual(h, 9.934032595764785)
+        self.assertAlmostEqual(p, 0.006963895256613351)
+
+    def test_two_samples_match_mann_whitney(self):
+        a, b = {0: 100, 1: 50, 3: 7}, {0: 110, 1: 60, 2: 30}
+        h, p = kruskal_wallis([a, b])
+        self.assertAlmostEqual(p, 2 * mann_whitney(a, b, use_continuity=False)[1], 12)
+
+    def test_too_few_values(self):
+        self.assertEqual(kruskal_wallis([{0: 100}, {0: 100, 1: 10}, {1: 19}]), (0, None))
+        self.assertEqual(kruskal_wallis([{0: 100}]), (0, None))
+        self.assertEqual(kruskal_wallis([{0: 100}, {0: 50}]), (0, None), "All values tied")
+
+
+class ChiSquareContingencyTestCase(TestCase):
+    def test_k_by_2(self):
+        statistic, p = chi_square_contingency([[90, 10], [80, 20], [85, 15]])
+        self.assertAlmostEqual(statistic, 3.9215686274509807)
+        self.assertAlmostEqual(p, 0.14074798704123068)
+        statistic, p = chi_square_contingency([[100, 50], [210, 110], [300, 140], [50, 40]])
+        self.assertAlmostEqual(statistic, 5.358284268712076)
+        self.assertAlmostEqual(p, 0.14736481006326826)
+
+    def test_matches_square_matrices(self):
+        matrix = ((100, 50, 10), (110, 70, 20), (140, 55, 6))
+        self.assertEqual(chi_square_contingency(matrix), chi_square_p_value(matrix))
+
+    def test_is_none(self):
+        self.assertEqual(chi_square_contingency([[10, 0], [20, 0]]), (None, None))
+        self.assertEqual(chi_square_contingency([[10, 1]]), (None, None))
+        self.assertEqual(chi_square_contingency([[10, 1], [1]]), (None, None))
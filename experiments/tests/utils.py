@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django.utils.unittest import skipUnless
+
+from experiments import counters
+
+
+def _redis_backend_selected():
+    backend = getattr(settings, 'EXPERIMENTS_COUNTER_BACKEND', None)
+    return not backend or issubclass(import_string(backend), counters.Counters)
+
+
+# Selecting a backend other than redis (see testrunner.py) runs the suite without a redis server
+requires_redis = skipUnless(_redis_backend_selected(), 'Needs a redis server, EXPERIMENTS_COUNTER_BACKEND selects another backend')
@@ -1,21 +1,17 @@
-from django.db import IntegrityError
-
-from experiments.models import Enrollment
+from experiments.models import Enrollment, weighted_choice
 from experiments.manager import experiment_manager
-from experiments.dateutils import now, fix_awareness, datetime_from_timestamp, timestamp_from_datetime
+from experiments.dateutils import now, fix_awareness, datetime_from_timestamp, timestamp_from_datetime, truncate_datetime
 from experiments.signals import user_enrolled
 from experiments.experiment_counters import ExperimentCounter
-from experiments import conf
+from experiments import enrollment_cache
+from experiments import last_seen as last_seen_buffer
+from experiments import conf, events, goal_stream
 
 from collections import namedtuple
 from datetime import timedelta
 
 import collections
 import numbers
-import logging
-import json
-
-logger = logging.getLogger('experiments')
 
 
 def participant(request=None, session=None, user=None):
@@ -54,6 +50,63 @@ def _get_participant(request, session, user):
         return DummyUser()
 
 
+def bulk_enroll(users, experiment_name, alternatives, batch_size=1000):
+    """
+    Enroll a cohort of authenticated users in an experiment, e.g. before emailing them.
+
+    alternatives is a list of alternatives to choose from at random, or a dict mapping
+    alternatives to weights. Users who are already enrolled keep their alternative. Enrollments
+    are inserted and participant counts incremented in batches of batch_size users, regardless of
+    whether the experiment is accepting new users. Returns the number of users enrolled.
+    """
+    experiment = experiment_manager.get_experiment(experiment_name)
+    if not experiment:
+        return 0
+
+    experiment_manager.ensure_alternative_exists(experiment, conf.CONTROL_GROUP)
+    if isinstance(alternatives, collections.Mapping):
+        choices = list(alternatives.items())
+        for alternative, weight in choices:
+            experiment_manager.ensure_alternative_exists(experiment, alternative, weight)
+    else:
+        choices = [(alternative, 1) for alternative in alternatives]
+        for alternative in alternatives:
+            experiment_manager.ensure_alternative_exists(experiment, alternative)
+    experiment_manager.store_pending_alternatives()
+
+    enrolled = 0
+    batch = []
+    for user in users:
+        batch.append(user)
+        if len(batch) >= batch_size:
+            enrolled += _bulk_enroll_batch(batch, experiment, choices, batch_size)
+            batch = []
+    if batch:
+        enrolled += _bulk_enroll_batch(batch, experiment, choices, batch_size)
+
+    # The rows were written without model signals
+    enrollment_cache.invalidate_all()
+    return enrolled
+
+
+def _bulk_enroll_batch(users, experiment, choices, batch_size):
+    already_enrolled = set(Enrollment.objects.filter(experiment=experiment, user__in=users).values_list('user_id', flat=True))
+    new_users = [user for user in users if user.pk not in already_enrolled]
+    enrollment_date = now()
+    assigned = [(user, weighted_choice(choices)) for user in new_users]
+
+    Enrollment.objects.bulk_upsert([(user.pk, experiment.name, alternative, enrollment_date, None) for user, alternative in assigned],
+                                   update=False, batch_size=batch_size)
+
+    experiment_counter = ExperimentCounter()
+    with experiment_counter.buffer():
+        for user, alternative in assigned:
+            experiment_user = AuthenticatedUser(user)
+            experiment_counter.increment_participant_count(experiment, alternative, experiment_user._participant_identifier())
+            user_enrolled.send(experiment_user, experiment=experiment.name, alternative=alternative, user=user, session=None)
+    return len(assigned)
+
+
 EnrollmentData = namedtuple('EnrollmentData', ['experiment', 'alternative', 'enrollment_date', 'last_seen'])
 
 
@@ -77,13 +130,13 @@ class WebUser(object):
             if experiment.is_displaying_alternatives():
                 if isinstance(alternatives, collections.Mapping):
                     if conf.CONTROL_GROUP not in alternatives:
-                        experiment.ensure_alternative_exists(conf.CONTROL_GROUP, 1)
+                        experiment_manager.ensure_alternative_exists(experiment, conf.CONTROL_GROUP, 1)
                     for alternative, weight in alternatives.items():
-                        experiment.ensure_alternative_exists(alternative, weight)
+                        experiment_manager.ensure_alternative_exists(experiment, alternative, weight)
                 else:
                     alternatives_including_control = alternatives + [conf.CONTROL_GROUP]
                     for alternative in alternatives_including_control:
-                        experiment.ensure_alternative_exists(alternative)
+                        experiment_manager.ensure_alternative_exists(experiment, alternative)
 
                 assigned_alternative = self._get_enrollment(experiment)
                 if assigned_alternative:
@@ -132,9 +185,14 @@ class WebUser(object):
         """Record that this user has performed a particular goal
 
         This will update the goal stats for all experiments the user is enrolled in."""
-        for enrollment in self._get_all_enrollments():
-            if enrollment.experiment.is_displaying_alternatives():
-                self._experiment_goal(enrollment.experiment, enrollment.alternative, goal_name, count)
+        enrollments = [enrollment for enrollment in self._get_all_enrollments() if enrollment.experiment.is_displaying_alternatives()]
+        if enrollments and conf.ASYNC_GOALS and self._counts_goals():
+            # Counted later by the process_goal_stream command; falls back to counting here if redis is unavailable
+            if goal_stream.enqueue_goal(self._participant_identifier(), goal_name, count,
+                                        [(enrollment.experiment.name, enrollment.alternative) for enrollment in enrollments]):
+                return
+        for enrollment in enrollments:
+            self._experiment_goal(enrollment.experiment, enrollment.alternative, goal_name, count)
 
     def confirm_human(self):
         """Mark that this is a real human being (not a bot) and thus results should be counted"""
@@ -159,6 +217,8 @@ class WebUser(object):
 
     def visit(self):
         """Record that the user has visited the site for the purposes of retention tracking"""
+        visit_time = now()
+        seen_experiments = []
         for enrollment in self._get_all_enrollments():
             if enrollment.experiment.is_displaying_alternatives():
                 # We have two different goals, VISIT_NOT_PRESENT_COUNT_GOAL and VISIT_PRESENT_COUNT_GOAL.
@@ -170,11 +230,15 @@ class WebUser(object):
 
                 if not enrollment.last_seen:
                     self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_NOT_PRESENT_COUNT_GOAL, 1)
-                    self._set_last_seen(enrollment.experiment, now())
-                elif now() - enrollment.last_seen >= timedelta(hours=conf.SESSION_LENGTH):
+                    seen_experiments.append(enrollment.experiment)
+                elif visit_time - enrollment.last_seen >= timedelta(hours=conf.SESSION_LENGTH):
                     self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_NOT_PRESENT_COUNT_GOAL, 1)
                     self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_PRESENT_COUNT_GOAL, 1)
-                    self._set_last_seen(enrollment.experiment, now())
+                    seen_experiments.append(enrollment.experiment)
+
+        # A single write for all the experiments, at LAST_SEEN_GRANULARITY resolution
+        if seen_experiments:
+            self._set_last_seen_many(seen_experiments, truncate_datetime(visit_time, conf.LAST_SEEN_GRANULARITY))
 
     def _get_enrollment(self, experiment):
         """Get the name of the alternative this user is enrolled in for the specified experiment
@@ -215,10 +279,19 @@ class WebUser(object):
         "Record a goal against a particular experiment and alternative"
         raise NotImplementedError
 
+    def _counts_goals(self):
+        "Whether _experiment_goal goes straight to the counters, so goals can be counted asynchronously"
+        return False
+
     def _set_last_seen(self, experiment, last_seen):
         "Set the last time the user was seen associated with this experiment"
         raise NotImplementedError
 
+    def _set_last_seen_many(self, experiments, last_seen):
+        "Set the last time the user was seen for several experiments at once"
+        for experiment in experiments:
+            self._set_last_seen(experiment, last_seen)
+
 
 class DummyUser(WebUser):
     def _get_enrollment(self, experiment):
@@ -258,42 +331,49 @@ class DummyUser(WebUser):
 
 class AuthenticatedUser(WebUser):
     def __init__(self, user, request=None):
-        self._enrollment_cache = {}
+        # experiment name -> (alternative, enrollment_date, last_seen), loaded on first use
+        self._enrollments = None
+        self._enrollments_version = None
         self.user = user
         self.request = request
         super(AuthenticatedUser, self).__init__()
 
+    def _load_enrollments(self):
+        "Fetch all of the user's enrollments from the enrollment cache, or else with a single query"
+        if self._enrollments is None:
+            enrollments, self._enrollments_version = enrollment_cache.get_enrollments(self.user.pk)
+            if enrollments is None:
+                rows = Enrollment.objects.filter(user=self.user).values_list('experiment_id', 'alternative', 'enrollment_date', 'last_seen')
+                enrollments = dict((experiment_name, (alternative, enrollment_date, last_seen)) for experiment_name, alternative, enrollment_date, last_seen in rows)
+                if conf.LAST_SEEN_BUFFER:
+                    # The database lags behind the last_seen buffer until it is flushed
+                    for experiment_name, last_seen in last_seen_buffer.buffered_last_seen(self.user.pk).items():
+                        if experiment_name in enrollments:
+                            alternative, enrollment_date, _ = enrollments[experiment_name]
+                            enrollments[experiment_name] = (alternative, enrollment_date, last_seen)
+                enrollment_cache.set_enrollments(self.user.pk, enrollments, self._enrollments_version)
+            self._enrollments = enrollments
+        return self._enrollments
+
+    def _enrollments_changed(self):
+        "Write the changed enrollments through to the enrollment cache"
+        if self._enrollments is None:
+            enrollment_cache.invalidate_user(self.user.pk)
+        else:
+            enrollment_cache.set_enrollments(self.user.pk, self._enrollments, self._enrollments_version)
+
     def _get_enrollment(self, experiment):
-        if experiment.name not in self._enrollment_cache:
-            try:
-                self._enrollment_cache[experiment.name] = Enrollment.objects.get(user=self.user, experiment=experiment).alternative
-            except Enrollment.DoesNotExist:
-                self._enrollment_cache[experiment.name] = None
-        return self._enrollment_cache[experiment.name]
+        enrollment = self._load_enrollments().get(experiment.name)
+        return enrollment[0] if enrollment else None
 
     def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None):
-        if experiment.name in self._enrollment_cache:
-            del self._enrollment_cache[experiment.name]
+        # A single upsert, so concurrent enrollments of the same user can't race
+        Enrollment.objects.upsert(self.user, experiment, alternative, enrollment_date, last_seen)
 
-        try:
-            enrollment, _ = Enrollment.objects.get_or_create(user=self.user, experiment=experiment, defaults={'alternative': alternative})
-        except IntegrityError:
-            # Already registered (db race condition under high load)
-            return
-        # Update alternative if it doesn't match
-        enrollment_changed = False
-        if enrollment.alternative != alternative:
-            enrollment.alternative = alternative
-            enrollment_changed = True
-        if enrollment_date:
-            enrollment.enrollment_date = enrollment_date
-            enrollment_changed = True
-        if last_seen:
-            enrollment.last_seen = last_seen
-            enrollment_changed = True
-
-        if enrollment_changed:
-            enrollment.save()
+        if self._enrollments is not None:
+            _, previous_enrollment_date, previous_last_seen = self._enrollments.get(experiment.name, (None, None, None))
+            self._enrollments[experiment.name] = (alternative, enrollment_date or previous_enrollment_date or now(), last_seen or previous_last_seen)
+        self._enrollments_changed()
 
         self.experiment_counter.increment_participant_count(experiment, alternative, self._participant_identifier())
 
@@ -303,25 +383,41 @@ class AuthenticatedUser(WebUser):
         return 'user:%d' % (self.user.pk, )
 
     def _get_all_enrollments(self):
-        enrollments = Enrollment.objects.filter(user=self.user).select_related("experiment")
-        if enrollments:
-            for enrollment in enrollments:
-                yield EnrollmentData(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen)
+        for experiment_name, (alternative, enrollment_date, last_seen) in list(self._load_enrollments().items()):
+            experiment = experiment_manager.get_experiment(experiment_name)
+            if experiment:
+                yield EnrollmentData(experiment, alternative, enrollment_date, last_seen)
 
     def _cancel_enrollment(self, experiment):
-        try:
-            enrollment = Enrollment.objects.get(user=self.user, experiment=experiment)
-        except Enrollment.DoesNotExist:
-            pass
-        else:
-            self.experiment_counter.remove_participant(experiment, enrollment.alternative, self._participant_identifier())
-            enrollment.delete()
+        enrollment = self._load_enrollments().pop(experiment.name, None)
+        if enrollment:
+            self.experiment_counter.remove_participant(experiment, enrollment[0], self._participant_identifier())
+            Enrollment.objects.filter(user=self.user, experiment=experiment).delete()
+            self._enrollments_changed()
 
     def _experiment_goal(self, experiment, alternative, goal_name, count):
         self.experiment_counter.increment_goal_count(experiment, alternative, goal_name, self._participant_identifier(), count)
 
+    def _counts_goals(self):
+        return True
+
     def _set_last_seen(self, experiment, last_seen):
-        Enrollment.objects.filter(user=self.user, experiment=experiment).update(last_seen=last_seen)
+        self._set_last_seen_many([experiment], last_seen)
+
+    def _set_last_seen_many(self, experiments, last_seen):
+        enrollments = self._load_enrollments()
+        # Nothing to write for enrollments that already have this last_seen
+        experiment_names = [experiment.name for experiment in experiments
+                            if experiment.name in enrollments and enrollments[experiment.name][2] != last_seen]
+        if not experiment_names:
+            return
+
+        if not (conf.LAST_SEEN_BUFFER and last_seen_buffer.buffer_last_seen(self.user.pk, experiment_names, last_seen)):
+            Enrollment.objects.filter(user=self.user, experiment__in=experiment_names).update(last_seen=last_seen)
+        for experiment_name in experiment_names:
+            alternative, enrollment_date, _ = enrollments[experiment_name]
+            enrollments[experiment_name] = (alternative, enrollment_date, last_seen)
+        self._enrollments_changed()
 
 
 def _session_enrollment_latest_version(data):
@@ -360,13 +456,13 @@ class SessionUser(WebUser):
         if self._is_verified_human():
             self.experiment_counter.increment_participant_count(experiment, alternative, self._participant_identifier())
         else:
-            logger.info(json.dumps({'type':'participant_unconfirmed', 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
+            events.emit('participant_unconfirmed', experiment=experiment.name, alternative=alternative, participant=self._participant_identifier())
 
         user_enrolled.send(self, experiment=experiment.name, alternative=alternative, user=None, session=self.session)
 
     def confirm_human(self):
         self.session[conf.CONFIRM_HUMAN_SESSION_KEY] = True
-        logger.info(json.dumps({'type': 'confirm_human', 'participant': self._participant_identifier()}))
+        events.emit('confirm_human', participant=self._participant_identifier())
 
         # Replay enrollments
         for enrollment in self._get_all_enrollments():
@@ -421,13 +517,20 @@ class SessionUser(WebUser):
             goals = self.session.get('experiments_goals', [])
             goals.append((experiment.name, alternative, goal_name, count))
             self.session['experiments_goals'] = goals
-            logger.info(json.dumps({'type': 'goal_hit_unconfirmed', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
+            events.emit('goal_hit_unconfirmed', goal=goal_name, goal_count=count, experiment=experiment.name, alternative=alternative, participant=self._participant_identifier())
+
+    def _counts_goals(self):
+        return self._is_verified_human()
 
     def _set_last_seen(self, experiment, last_seen):
+        self._set_last_seen_many([experiment], last_seen)
+
+    def _set_last_seen_many(self, experiments, last_seen):
         enrollments = self.session.get('experiments_enrollments', {})
-        alternative, unused, enrollment_date, _ = _session_enrollment_latest_version(enrollments[experiment.name])
-        enrollments[experiment.name] = (alternative, unused, timestamp_from_datetime(enrollment_date), timestamp_from_datetime(last_seen))
+        for experiment in experiments:
+            alternative, unused, enrollment_date, _ = _session_enrollment_latest_version(enrollments[experiment.name])
+            enrollments[experiment.name] = (alternative, unused, timestamp_from_datetime(enrollment_date), timestamp_from_datetime(last_seen))
         self.session['experiments_enrollments'] = enrollments
 
 
-__all__ = ['participant']
+__all__ = ['participant', 'bulk_enroll']
@@ -29,6 +29,9 @@ def runtests():
                         'waffle',
                         'experiments',),
         ROOT_URLCONF='experiments.tests.urls',
+        # e.g. experiments.counters.LocalCounters to run the suite without a redis server,
+        # skipping the tests of the redis specific features (see experiments.tests.utils)
+        EXPERIMENTS_COUNTER_BACKEND=os.environ.get('EXPERIMENTS_COUNTER_BACKEND'),
         MIDDLEWARE_CLASSES = (
             'django.contrib.sessions.middleware.SessionMiddleware',
             'django.middleware.csrf.CsrfViewMiddleware',